@@ -9,6 +9,7 @@ from __future__ import (
 import os
 import re
 import sys
+import threading
 
 sys.path.append('/curtin')
 from curtin import (
@@ -17,6 +18,8 @@ from curtin import (
     util,
     )
 
+import finalize
+
 """
 CentOS 6
 
@@ -63,28 +66,92 @@ title MAAS
 """
 
 
-def get_block_devices(target):
+# Host paths read by the hook, pointed at a synthetic tree by the offline
+# hook benchmark (mib.testing.hookbench).
+PROC_CMDLINE = '/proc/cmdline'
+PROC_MOUNTS = '/proc/mounts'
+SYS_CLASS_BLOCK = '/sys/class/block'
+SYS_CLASS_NET = '/sys/class/net'
+
+
+class BlockInventory(object):
+    """Snapshot of the block devices, read once for the whole hook run.
+
+    lsblk and /proc/mounts are read when the inventory is created and
+    the devices are indexed by name, device path, label and mountpoint.
+    Partition parents are resolved from sysfs, once for each device.
+    """
+
+    def __init__(self):
+        self.devices = block._lsblock()
+        self.by_path = {}
+        self.by_label = {}
+        for name, info in self.devices.items():
+            self.by_path[info.get('device_path', '/dev/%s' % name)] = info
+            self.by_path['/dev/%s' % name] = info
+            if info.get('LABEL'):
+                self.by_label.setdefault(info['LABEL'], info)
+        self.mounts = {}
+        with open(PROC_MOUNTS, 'r') as stream:
+            for line in stream:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0].startswith('/dev/'):
+                    self.mounts[fields[1]] = os.path.realpath(fields[0])
+        self.parents = {}
+
+    def get_devices_for_mp(self, mountpoint):
+        """Returns the devices mounted at the mountpoint."""
+        device = self.mounts.get(os.path.normpath(mountpoint))
+        if device is None:
+            return []
+        return [device]
+
+    def get_device(self, path):
+        """Returns the lsblk information for the device path."""
+        info = self.devices.get(os.path.basename(path))
+        if info is None:
+            info = self.by_path.get(path)
+        return info
+
+    def get_blockdev_for_partition(self, path):
+        """Returns the disk holding the partition and the partition
+        number, or the device itself and None when it is not a
+        partition."""
+        if path not in self.parents:
+            name = os.path.basename(os.path.realpath(path))
+            sys_path = os.path.join(SYS_CLASS_BLOCK, name)
+            partition_path = os.path.join(sys_path, 'partition')
+            if os.path.exists(partition_path):
+                with open(partition_path, 'r') as stream:
+                    partition = int(stream.read().strip())
+                parent = os.path.basename(
+                    os.path.dirname(os.path.realpath(sys_path)))
+                self.parents[path] = ('/dev/%s' % parent, partition)
+            else:
+                self.parents[path] = (path, None)
+        return self.parents[path]
+
+
+def get_block_devices(inventory, target):
     """Returns list of block devices for the given target."""
-    devs = block.get_devices_for_mp(target)
+    devs = inventory.get_devices_for_mp(target)
     blockdevs = set()
     for maybepart in devs:
-        (blockdev, part) = block.get_blockdev_for_partition(maybepart)
+        (blockdev, part) = inventory.get_blockdev_for_partition(maybepart)
         blockdevs.add(blockdev)
     return list(blockdevs)
 
 
-def get_root_info(target):
+def get_root_info(inventory, target):
     """Returns the root partitions information."""
-    rootpath = block.get_devices_for_mp(target)[0]
-    rootdev = os.path.basename(rootpath)
-    blocks = block._lsblock()
-    return blocks[rootdev]
+    rootpath = inventory.get_devices_for_mp(target)[0]
+    return inventory.get_device(rootpath)
 
 
 def read_file(path):
     """Returns content of a file."""
     with open(path, 'rb') as stream:
-        return stream.read().encode('utf-8')
+        return stream.read().decode('utf-8')
 
 
 def write_fstab(target, curtin_fstab):
@@ -132,10 +199,10 @@ def get_boot_file(target, filename):
     return files[0]
 
 
-def write_grub_conf(target, grub_root, extra=[]):
+def write_grub_conf(inventory, target, grub_root, extra=[]):
     """Writes a new /boot/grub/grub.conf with the correct
     boot arguments."""
-    root_info = get_root_info(target)
+    root_info = get_root_info(inventory, target)
     grub_path = os.path.join(target, 'boot', 'grub', 'grub.conf')
     extra_opts = ' '.join(extra)
     vmlinuz = get_boot_file(target, 'vmlinuz')
@@ -150,14 +217,13 @@ def write_grub_conf(target, grub_root, extra=[]):
                 extra_opts=extra_opts) + '\n')
 
 
-def get_extra_kernel_parameters():
+def get_extra_kernel_parameters(cmdline):
     """Extracts the extra kernel commands from /proc/cmdline
     that should be placed onto the host.
 
     Any command following the '--' entry should be placed
     onto the host.
     """
-    cmdline = read_file('/proc/cmdline')
     cmdline = cmdline.split()
     if '--' not in cmdline:
         return []
@@ -203,21 +269,8 @@ def grub_install(target, root):
             data=data)
 
 
-def set_autorelabel(target):
-    """Creates file /.autorelabel.
-
-    This is used by SELinux to relabel all of the
-    files on the filesystem to have the correct
-    security context. Without this SSH login will
-    fail.
-    """
-    path = os.path.join(target, '.autorelabel')
-    open(path, 'a').close()
-
-
-def get_boot_mac():
+def get_boot_mac(cmdline):
     """Return the mac address of the booting interface."""
-    cmdline = read_file('/proc/cmdline')
     cmdline = cmdline.split()
     try:
         bootif = [
@@ -234,7 +287,7 @@ def get_boot_mac():
 
 def get_interface_names():
     """Return a dictionary mapping mac addresses to interface names."""
-    sys_path = "/sys/class/net"
+    sys_path = SYS_CLASS_NET
     ifaces = {}
     for iname in os.listdir(sys_path):
         mac = read_file(os.path.join(sys_path, iname, "address"))
@@ -309,6 +362,31 @@ def write_network_config(target, mac):
         })
 
 
+def run_concurrently(*funcs):
+    """Runs each function in its own thread and waits for all of them.
+
+    Raises the first error raised by any of the functions.
+    """
+    errors = []
+
+    def run(func):
+        try:
+            func()
+        except Exception as error:
+            errors.append(error)
+
+    threads = [
+        threading.Thread(target=run, args=(func,))
+        for func in funcs
+        ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
 def main():
     state = util.load_command_environment()
     target = state['target']
@@ -319,23 +397,56 @@ def main():
     if fstab is None:
         print("/etc/fstab output was not provided in the environment.")
         sys.exit(1)
-    bootmac = get_boot_mac()
+    curtin_config = finalize.load_config(state['config'])
+    if finalize.get_maas_debconf_selections(curtin_config) is None:
+        print("Failed to get the debconf_selections.")
+        sys.exit(1)
+    cmdline = read_file(PROC_CMDLINE)
+    bootmac = get_boot_mac(cmdline)
     if bootmac is None:
         print("Unable to determine boot interface.")
         sys.exit(1)
-    devices = get_block_devices(target)
+    timer = finalize.StepTimer('curtin-hooks')
+    with timer.step('block_inventory'):
+        inventory = BlockInventory()
+    devices = get_block_devices(inventory, target)
     if not devices:
         print("Unable to find block device for: %s" % target)
         sys.exit(1)
+    extra = get_extra_kernel_parameters(cmdline)
+
+    def install_bootloader():
+        with timer.step('get_grub_root'):
+            grub_root = get_grub_root(target)
+        with timer.step('write_grub_conf'):
+            write_grub_conf(inventory, target, grub_root, extra=extra)
+        with timer.step('grub_install'):
+            grub_install(target, grub_root)
+
+    def write_config():
+        with timer.step('write_fstab'):
+            write_fstab(target, fstab)
+        with timer.step('write_network_config'):
+            write_network_config(target, bootmac)
+        with timer.step('write_cloud_init'):
+            finalize.write_cloud_init(target, curtin_config)
 
-    write_fstab(target, fstab)
-
-    grub_root = get_grub_root(target)
-    write_grub_conf(target, grub_root, extra=get_extra_kernel_parameters())
-    grub_install(target, grub_root)
-
-    set_autorelabel(target)
-    write_network_config(target, bootmac)
+    try:
+        run_concurrently(install_bootloader, write_config)
+        # Written before relabeling, so they are labeled as well
+        finalize.mark_finalized(target)
+        finalize.create_hooks_log(target)
+        with timer.step('relabel_files'):
+            finalize.relabel_files(target, [
+                '/etc/fstab',
+                '/boot/grub',
+                '/etc/sysconfig/network-scripts',
+                '/etc/cloud/cloud.cfg.d',
+                '/' + finalize.FINALIZED,
+                '/' + os.path.dirname(finalize.HOOKS_LOG),
+                ])
+    finally:
+        timer.report(target)
 
 
 if __name__ == "__main__":
@@ -9,6 +9,8 @@ from __future__ import (
 import json
 import os
 import sys
+import time
+from contextlib import contextmanager
 
 sys.path.append('/curtin')
 from curtin import util
@@ -25,6 +27,75 @@ datasource:
 """
 
 
+# Written into the image by maas-image-builder once it is SELinux labeled.
+SELINUX_PRELABELED = os.path.join('curtin', '.selinux-prelabeled')
+
+# Labeled in every image built with SELinux enabled, checked to tell
+# whether the deployment kept the labels of the image.
+SELINUX_LABELED_FILE = os.path.join('etc', 'selinux', 'config')
+
+# Timing records of the hook runs, appended to by every hook.
+HOOKS_LOG = os.path.join('var', 'log', 'maas-image-builder', 'hooks.json')
+
+# Written into the target when curtin-hooks already ran the finalize steps.
+FINALIZED = os.path.join('curtin', '.finalized')
+
+
+class StepTimer(object):
+    """Records how long each step of the hook takes."""
+
+    def __init__(self, hook):
+        self.hook = hook
+        self.start = time.time()
+        self.steps = []
+
+    @contextmanager
+    def step(self, name):
+        """Times the steps run inside the context."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.time() - start))
+
+    def get_record(self):
+        """Returns the machine-readable timing record."""
+        return {
+            'hook': self.hook,
+            'start': self.start,
+            'total': round(time.time() - self.start, 3),
+            'steps': [
+                {'name': name, 'seconds': round(elapsed, 3)}
+                for name, elapsed in self.steps
+                ],
+            }
+
+    def report(self, target):
+        """Prints the timing breakdown and appends the record to the
+        hooks log in the target. The log is rewritten in place, so it
+        keeps the SELinux label given by `create_hooks_log`."""
+        record = self.get_record()
+        print('Hook timings:')
+        for step in record['steps']:
+            print('  %-40s %7.2fs' % (step['name'], step['seconds']))
+        print('  %-40s %7.2fs' % ('total', record['total']))
+        print(json.dumps(record, sort_keys=True))
+        path = os.path.join(target, HOOKS_LOG)
+        try:
+            records = []
+            if os.path.exists(path):
+                with open(path, 'r') as stream:
+                    records = json.load(stream)
+            records.append(record)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as stream:
+                json.dump(records, stream, indent=2, sort_keys=True)
+        except (IOError, OSError, ValueError) as error:
+            # The timings are informational, never fail the deployment.
+            print("Unable to write %s: %s" % (path, error))
+
+
 def get_datasource(**kwargs):
     """Returns the format cloud-init datasource."""
     return DATASOURCE_LIST + DATASOURCE.format(**kwargs)
@@ -74,6 +145,107 @@ def write_datasource(target, data):
         stream.write(data + '\n')
 
 
+def get_file_contexts(target):
+    """Returns the path inside the target of the SELinux file contexts,
+    or None when SELinux is disabled on the target."""
+    config_path = os.path.join(target, 'etc', 'selinux', 'config')
+    if not os.path.exists(config_path):
+        return None
+    settings = {}
+    with open(config_path, 'r') as stream:
+        for line in stream:
+            line = line.strip()
+            if '=' in line and not line.startswith('#'):
+                key, value = line.split('=', 1)
+                settings[key.strip()] = value.strip()
+    if settings.get('SELINUX') == 'disabled':
+        return None
+    return os.path.join(
+        '/etc', 'selinux', settings.get('SELINUXTYPE', 'targeted'),
+        'contexts', 'files', 'file_contexts')
+
+
+def has_selinux_labels(target):
+    """Returns True when the files of the target kept their SELinux labels.
+
+    curtin only preserves the labels of the image when its extraction
+    keeps extended attributes, so a labeled image can still be deployed
+    unlabeled.
+    """
+    path = os.path.join(target, SELINUX_LABELED_FILE)
+    try:
+        return bool(os.getxattr(path, 'security.selinux'))
+    except (AttributeError, OSError):
+        # Missing label, or Python 2 which cannot read it.
+        return False
+
+
+def relabel_files(target, paths, in_chroot=None):
+    """Restores the SELinux labels of the given paths in the target.
+
+    The image is labeled when it is built, so only the files written
+    during deployment need their labels restored. When the image was not
+    labeled, or lost its labels when deployed, the whole filesystem is
+    relabeled on first boot instead.
+
+    :param in_chroot: runs commands in the target, as returned by
+        util.RunInChroot. A chroot session is opened when None.
+    """
+    file_contexts = get_file_contexts(target)
+    if file_contexts is None:
+        return
+    if (not os.path.exists(os.path.join(target, SELINUX_PRELABELED)) or
+            not has_selinux_labels(target)):
+        open(os.path.join(target, '.autorelabel'), 'a').close()
+        return
+    paths = [
+        path
+        for path in paths
+        if os.path.lexists(os.path.join(target, path.lstrip('/')))
+        ]
+    if not paths:
+        return
+    args = ['setfiles', '-F', file_contexts] + paths
+    if in_chroot is not None:
+        in_chroot(args)
+        return
+    with util.RunInChroot(target) as in_chroot:
+        in_chroot(args)
+
+
+def write_cloud_init(target, config):
+    """Writes the cloud-init configuration for the curtin config.
+
+    Returns False when the config has no MAAS debconf selections.
+    """
+    debconf = get_maas_debconf_selections(config)
+    if debconf is None:
+        return False
+
+    params = extract_maas_parameters(debconf)
+    datasource = get_datasource(**params)
+    write_datasource(target, datasource)
+    return True
+
+
+def create_hooks_log(target):
+    """Creates the empty hooks log in the target, so it exists when the
+    files written during deployment are relabeled."""
+    path = os.path.join(target, HOOKS_LOG)
+    if os.path.exists(path):
+        return
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as stream:
+        json.dump([], stream)
+
+
+def mark_finalized(target):
+    """Records that the finalize steps ran as part of curtin-hooks, so the
+    finalize hook does not run them a second time."""
+    open(os.path.join(target, FINALIZED), 'a').close()
+
+
 def main():
     state = util.load_command_environment()
     target = state['target']
@@ -85,15 +257,21 @@ def main():
         print("Config was not provided in the environment.")
         sys.exit(1)
     config = load_config(config_f)
-    
-    debconf = get_maas_debconf_selections(config)
-    if debconf is None:
-        print("Failed to get the debconf_selections.")
-        sys.exit(1)
-
-    params = extract_maas_parameters(debconf)
-    datasource = get_datasource(**params)
-    write_datasource(target, datasource)
+    timer = StepTimer('finalize')
+    try:
+        with timer.step('write_cloud_init'):
+            written = write_cloud_init(target, config)
+        if not written:
+            print("Failed to get the debconf_selections.")
+            sys.exit(1)
+        create_hooks_log(target)
+        with timer.step('relabel_files'):
+            relabel_files(target, [
+                '/etc/cloud/cloud.cfg.d',
+                '/' + os.path.dirname(HOOKS_LOG),
+                ])
+    finally:
+        timer.report(target)
 
 
 if __name__ == "__main__":
@@ -6,10 +6,12 @@ from __future__ import (
     unicode_literals,
     )
 
+import json
 import os
 import re
 import sys
 import shutil
+import threading
 
 sys.path.append('/curtin')
 from curtin import (
@@ -18,6 +20,8 @@ from curtin import (
     util,
     )
 
+import finalize
+
 """
 RedHat Enterprise Linux 7
 
@@ -55,30 +59,103 @@ GRUB_DISABLE_OS_PROBER=true
 """
 
 
-def get_block_devices(target):
+# Host paths read by the hook, pointed at a synthetic tree by the offline
+# hook benchmark (mib.testing.hookbench).
+PROC_CMDLINE = '/proc/cmdline'
+PROC_MOUNTS = '/proc/mounts'
+SYS_CLASS_BLOCK = '/sys/class/block'
+SYS_CLASS_NET = '/sys/class/net'
+
+
+# Scratch directory in /boot holding the EFI tree of the image while the
+# UEFI partition is mounted over it.
+EFI_STAGING = '.efi-staging'
+
+
+# Templates written into the image by maas-image-builder.
+GRUB_TEMPLATE_DIR = os.path.join('curtin', 'grub')
+
+# Kernels with a generic initramfs, written by maas-image-builder.
+INITRAMFS_MANIFEST = os.path.join('curtin', 'initramfs.json')
+
+
+class BlockInventory(object):
+    """Snapshot of the block devices, read once for the whole hook run.
+
+    lsblk and /proc/mounts are read when the inventory is created and
+    the devices are indexed by name, device path, label and mountpoint.
+    Partition parents are resolved from sysfs, once for each device.
+    """
+
+    def __init__(self):
+        self.devices = block._lsblock()
+        self.by_path = {}
+        self.by_label = {}
+        for name, info in self.devices.items():
+            self.by_path[info.get('device_path', '/dev/%s' % name)] = info
+            self.by_path['/dev/%s' % name] = info
+            if info.get('LABEL'):
+                self.by_label.setdefault(info['LABEL'], info)
+        self.mounts = {}
+        with open(PROC_MOUNTS, 'r') as stream:
+            for line in stream:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0].startswith('/dev/'):
+                    self.mounts[fields[1]] = os.path.realpath(fields[0])
+        self.parents = {}
+
+    def get_devices_for_mp(self, mountpoint):
+        """Returns the devices mounted at the mountpoint."""
+        device = self.mounts.get(os.path.normpath(mountpoint))
+        if device is None:
+            return []
+        return [device]
+
+    def get_device(self, path):
+        """Returns the lsblk information for the device path."""
+        info = self.devices.get(os.path.basename(path))
+        if info is None:
+            info = self.by_path.get(path)
+        return info
+
+    def get_blockdev_for_partition(self, path):
+        """Returns the disk holding the partition and the partition
+        number, or the device itself and None when it is not a
+        partition."""
+        if path not in self.parents:
+            name = os.path.basename(os.path.realpath(path))
+            sys_path = os.path.join(SYS_CLASS_BLOCK, name)
+            partition_path = os.path.join(sys_path, 'partition')
+            if os.path.exists(partition_path):
+                with open(partition_path, 'r') as stream:
+                    partition = int(stream.read().strip())
+                parent = os.path.basename(
+                    os.path.dirname(os.path.realpath(sys_path)))
+                self.parents[path] = ('/dev/%s' % parent, partition)
+            else:
+                self.parents[path] = (path, None)
+        return self.parents[path]
+
+
+def get_block_devices(inventory, target):
     """Returns list of block devices for the given target."""
-    devs = block.get_devices_for_mp(target)
+    devs = inventory.get_devices_for_mp(target)
     blockdevs = set()
     for maybepart in devs:
-        (blockdev, part) = block.get_blockdev_for_partition(maybepart)
+        (blockdev, part) = inventory.get_blockdev_for_partition(maybepart)
         blockdevs.add(blockdev)
     return list(blockdevs)
 
 
-def get_root_info(target):
+def get_root_info(inventory, target):
     """Returns the root partitions information."""
-    rootpath = block.get_devices_for_mp(target)[0]
-    rootdev = os.path.basename(rootpath)
-    blocks = block._lsblock()
-    return blocks[rootdev]
+    rootpath = inventory.get_devices_for_mp(target)[0]
+    return inventory.get_device(rootpath)
 
 
-def get_uefi_partition():
+def get_uefi_partition(inventory):
     """Return the UEFI partition."""
-    for _, value in block._lsblock().items():
-        if value['LABEL'] == 'uefi-boot':
-            return value
-    return None
+    return inventory.by_label.get('uefi-boot')
 
 
 def read_file(path):
@@ -87,7 +164,6 @@ def read_file(path):
         return stream.read()
 
 def load_config(path):
-    import json
     """Loads the curtin config."""
     with open(path, 'r') as stream:
         return json.load(stream)
@@ -119,14 +195,13 @@ def strip_kernel_params(params, strip_params=[]):
     return new_params
 
 
-def get_extra_kernel_parameters():
+def get_extra_kernel_parameters(cmdline):
     """Extracts the extra kernel commands from /proc/cmdline
     that should be placed onto the host.
 
     Any command following the '--' entry should be placed
     onto the host.
     """
-    cmdline = read_file('/proc/cmdline')
     cmdline = cmdline.split()
     if '--' not in cmdline:
         return []
@@ -151,92 +226,168 @@ def update_grub_default(target, extra=[]):
         # stream.write('GRUB_CMDLINE_LINUX_DEFAULT=\"%s\"\n' % kernel_cmdline)
 
 
-def grub2_install(target, root):
+def write_grub_template(inventory, target, extra=[]):
+    """Writes /etc/default/grub and grub.cfg from the templates generated
+    when the image was built.
+
+    Returns False when there are no templates, or when the kernels or
+    firmware type differ from the build and grub2-mkconfig is needed.
+    """
+    template_dir = os.path.join(target, GRUB_TEMPLATE_DIR)
+    if not os.path.isdir(template_dir):
+        return False
+    platform = 'efi' if util.is_uefi_bootable() else 'bios'
+    if read_file(os.path.join(template_dir, 'platform')).strip() != platform:
+        return False
+    kernels = sorted(
+        filename
+        for filename in os.listdir(os.path.join(target, 'boot'))
+        if filename.startswith('vmlinuz-'))
+    if read_file(os.path.join(template_dir, 'kernels')).split() != kernels:
+        return False
+    root_info = get_root_info(inventory, target)
+    root_uuid = root_info.get('UUID') if root_info else None
+    if not root_uuid:
+        return False
+    # Same options as update_grub_default.
+    kernel_cmdline = ' '.join(
+        extra + ['fsck.mode=skip', 'rootfstype=ext4'])
+    for template, path in (
+            ('default-grub', os.path.join('etc', 'default', 'grub')),
+            ('grub.cfg', os.path.join('boot', 'grub2', 'grub.cfg'))):
+        data = read_file(os.path.join(template_dir, template))
+        data = data.replace('@ROOT_UUID@', root_uuid)
+        data = data.replace('@MAAS_KERNEL_PARAMS@', kernel_cmdline)
+        with open(os.path.join(target, path), 'w') as stream:
+            stream.write(data)
+    return True
+
+
+def get_stale_initramfs_kernels(target):
+    """Returns the kernels without the generic initramfs generated when
+    the image was built."""
+    modules_path = os.path.join(target, 'lib', 'modules')
+    if not os.path.isdir(modules_path):
+        return []
+    try:
+        with open(os.path.join(target, INITRAMFS_MANIFEST), 'r') as stream:
+            recorded = json.load(stream)['kernels']
+    except (IOError, OSError, ValueError, KeyError):
+        recorded = {}
+    stale = []
+    for kernel in sorted(os.listdir(modules_path)):
+        if not os.path.exists(
+                os.path.join(target, 'boot', 'vmlinuz-%s' % kernel)):
+            continue
+        initramfs = os.path.join(target, 'boot', 'initramfs-%s.img' % kernel)
+        if (kernel not in recorded or
+                not os.path.exists(initramfs) or
+                os.path.getsize(initramfs) != recorded[kernel]['size']):
+            stale.append(kernel)
+    return stale
+
+
+def regenerate_initramfs(in_chroot, kernels):
+    """Generates a generic initramfs for the kernels."""
+    for kernel in kernels:
+        in_chroot([
+            'dracut', '--force', '--no-hostonly',
+            '/boot/initramfs-%s.img' % kernel, kernel])
+
+
+def grub2_install(in_chroot, root):
     """Installs grub2 to the root."""
-    with util.RunInChroot(target) as in_chroot:
-        in_chroot(['grub2-install', '--recheck', root])
+    in_chroot(['grub2-install', '--recheck', root])
+
+
+def grub2_install_devices(in_chroot, devices, timer):
+    """Installs grub2 to all the devices.
+
+    grub2-install copies the modules and generates core.img under
+    /boot/grub2, so it only runs for the first device. The remaining
+    devices only need core.img embedded, which grub2-bios-setup does
+    for each device concurrently.
+    """
+    devices = sorted(devices)
+    with timer.step('grub2_install %s' % devices[0]):
+        grub2_install(in_chroot, devices[0])
+    errors = []
+
+    def bios_setup(dev):
+        try:
+            with timer.step('grub2_bios_setup %s' % dev):
+                in_chroot([
+                    'grub2-bios-setup',
+                    '--directory', '/boot/grub2/i386-pc',
+                    '--device-map', '/boot/grub2/device.map',
+                    dev])
+        except Exception as error:
+            errors.append(error)
+
+    threads = [
+        threading.Thread(target=bios_setup, args=(dev,))
+        for dev in devices[1:]
+        ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
 
 
-def grub2_mkconfig(target):
+def grub2_mkconfig(in_chroot):
     """Writes the new grub2 config."""
-    with util.RunInChroot(target) as in_chroot:
-        in_chroot(['grub2-mkconfig', '-o', '/boot/grub2/grub.cfg'])
+    in_chroot(['grub2-mkconfig', '-o', '/boot/grub2/grub.cfg'])
 
 
-def install_efi(target, uefi_path):
-    """Install the EFI data from /boot into efi partition."""
-    # Create temp mount point for uefi partition.
-    tmp_efi = os.path.join(target, 'boot', 'efi_part')
-    os.mkdir(tmp_efi)
-    util.subp(['mount', uefi_path, tmp_efi])
+def install_efi(inventory, target, uefi_path, in_chroot):
+    """Install the EFI data from /boot into efi partition.
 
-    # Copy the data over.
-    try:
-        efi_path = os.path.join(target, 'boot', 'efi')
-        if os.path.exists(os.path.join(tmp_efi, 'EFI')):
-            shutil.rmtree(os.path.join(tmp_efi, 'EFI'))
-        # bug  does not have a dir  EFI
-        #No such file or directory: '/tmp/tmpab9g_us0/target/boot/efi/EFI'
-        #os.mkdir(os.path.join(tmp_efi, 'EFI'))
-        if os.path.exists(os.path.join(efi_path, 'EFI')):
-            shutil.copytree(
-                os.path.join(efi_path, 'EFI'),
-                os.path.join(tmp_efi, 'EFI'))
-        else:
-            shutil.copytree(
-                os.path.join(target, "yxp"),
-                os.path.join(tmp_efi, 'EFI'))
-    finally:
-        # Clean up tmp mount
-        util.subp(['umount', tmp_efi])
-        os.rmdir(tmp_efi)
+    When curtin mounted the UEFI partition on /boot/efi before extracting
+    the image, the EFI tree is already on it. Otherwise the tree extracted
+    onto the root filesystem is moved aside, the UEFI partition is mounted
+    on /boot/efi once and the tree is copied onto it.
 
-    # Mount and do grub install
-    mount_flag = True
+    The UEFI partition is never mounted twice: removing its EFI directory
+    through a second mount used to remove the tree being copied as well.
+    """
+    efi_path = os.path.join(target, 'boot', 'efi')
+    efi_tree = os.path.join(efi_path, 'EFI')
+    if inventory.get_devices_for_mp(efi_path):
+        grub2_install_efi_loader(in_chroot)
+        return
+
+    staging = os.path.join(target, 'boot', EFI_STAGING)
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    if os.path.isdir(efi_tree):
+        os.rename(efi_tree, staging)
     try:
         util.subp(['mount', uefi_path, efi_path])
-    except Exception as e:
         try:
+            if os.path.isdir(staging):
+                if os.path.exists(efi_tree):
+                    shutil.rmtree(efi_tree)
+                shutil.copytree(staging, efi_tree)
+            grub2_install_efi_loader(in_chroot)
+        finally:
             util.subp(['umount', efi_path])
-            util.subp(['mount', uefi_path, efi_path])
-        except Exception as e:
-            mount_flag = False
-            print(e)
-            print("cant not mount %s" %uefi_path)
-
-    #  check the  EFI directory
-    if not check_efi_dir(target):
-        shutil.copytree(
-            os.path.join(target, "yxp"),
-            os.path.join(efi_path, 'EFI'))
-        print("check why dont have the file")
-
-    try:
-        with util.RunInChroot(target) as in_chroot:
-            in_chroot([
-                'grub2-install', '--target=x86_64-efi',
-                '--efi-directory', '/boot/efi',
-                '--recheck'])
     finally:
-        if mount_flag:
-            util.subp(['umount', efi_path])
-
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
 
-def set_autorelabel(target):
-    """Creates file /.autorelabel.
 
-    This is used by SELinux to relabel all of the
-    files on the filesystem to have the correct
-    security context. Without this SSH login will
-    fail.
-    """
-    path = os.path.join(target, '.autorelabel')
-    open(path, 'a').close()
+def grub2_install_efi_loader(in_chroot):
+    """Installs the grub2 EFI loader to the mounted UEFI partition."""
+    in_chroot([
+        'grub2-install', '--target=x86_64-efi',
+        '--efi-directory', '/boot/efi',
+        '--recheck'])
 
 
-def get_boot_mac():
+def get_boot_mac(cmdline):
     """Return the mac address of the booting interface."""
-    cmdline = read_file('/proc/cmdline')
     cmdline = cmdline.split()
     try:
         bootif = [
@@ -253,7 +404,7 @@ def get_boot_mac():
 
 def get_interface_names():
     """Return a dictionary mapping mac addresses to interface names."""
-    sys_path = "/sys/class/net"
+    sys_path = SYS_CLASS_NET
     ifaces = {}
     for iname in os.listdir(sys_path):
         mac = read_file(os.path.join(sys_path, iname, "address"))
@@ -354,40 +505,35 @@ def get_nertwork_config(curtin_config):
     return  curtin_config['network']['config']
 
 
-def check_efi_dir(target):
-    try:
-        print(os.listdir(os.path.join(target, "boot", "efi")))
-        print(os.path.exists(os.path.join(target, "boot", "efi", "EFI")))
-        print("if exists EFI dir")
-        if os.path.exists(os.path.join(target, "boot", "efi", "EFI")):
-            print("check efi EFI dir")
-            print(os.listdir(os.path.join(target, "boot", "efi", "EFI")))
-            return True
-        return False
-    except Exception as e:
-        print(e)
-        return False
+def run_concurrently(*funcs):
+    """Runs each function in its own thread and waits for all of them.
 
-def tmp_dir_EFI_dir(target):
+    Raises the first error raised by any of the functions.
     """
-    发现，targe EFI文件，一直会变化，镜像copytree时报错，no file or directory，
-    先使用这种方式，看看是否可以解决此bug。
-    :param target:
-    :return:
-    """
-    if os.path.exists(os.path.join(target, "boot", "efi", "EFI")):
-        EFI_path = os.path.join(target, "boot", "efi", "EFI")
-        shutil.copytree(EFI_path, os.path.join(target, "yxp"))
-        print("ok")
-    else:
-        print("no such file or directory")
+    errors = []
+
+    def run(func):
+        try:
+            func()
+        except Exception as error:
+            errors.append(error)
+
+    threads = [
+        threading.Thread(target=run, args=(func,))
+        for func in funcs
+        ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
 
 
 def main():
     state = util.load_command_environment()
     target = state['target']
     print(target)
-    tmp_dir_EFI_dir(target)
     print("target message")
     if target is None:
         print("Target was not provided in the environment.")
@@ -396,38 +542,84 @@ def main():
     if fstab is None:
         print("/etc/fstab output was not provided in the environment.")
         sys.exit(1)
-    bootmac = get_boot_mac()
+    curtin_config = finalize.load_config(state['config'])
+    print(curtin_config)
+    if finalize.get_maas_debconf_selections(curtin_config) is None:
+        print("Failed to get the debconf_selections.")
+        sys.exit(1)
+    cmdline = read_file(PROC_CMDLINE)
+    bootmac = get_boot_mac(cmdline)
     if bootmac is None:
         print("Unable to determine boot interface.")
         sys.exit(1)
-    devices = get_block_devices(target)
+    timer = finalize.StepTimer('curtin-hooks')
+    with timer.step('block_inventory'):
+        inventory = BlockInventory()
+    devices = get_block_devices(inventory, target)
     if not devices:
         print("Unable to find block device for: %s" % target)
         sys.exit(1)
-
-    write_fstab(target, fstab)
-    update_grub_default(
-        target, extra=get_extra_kernel_parameters())
-    grub2_mkconfig(target)
+    uefi_part = None
     if util.is_uefi_bootable():
-        uefi_part = get_uefi_partition()
+        uefi_part = get_uefi_partition(inventory)
         if uefi_part is None:
             print('Unable to determine UEFI parition.')
             sys.exit(1)
         print("分区信息")
         print(uefi_part)
-        print("testing efi dir")
-        install_efi(target, uefi_part['device_path'])
-    else:
-        for dev in devices:
-            grub2_install(target, dev)
-
-    curtin_config = load_config(state['config'])
-    print(curtin_config)
     network_config = get_nertwork_config(curtin_config)
     print(network_config)
-    set_autorelabel(target)
-    write_network_config(target, bootmac, network_config)
+    extra = get_extra_kernel_parameters(cmdline)
+
+    try:
+        with util.RunInChroot(target) as in_chroot:
+
+            def install_bootloader():
+                with timer.step('get_stale_initramfs_kernels'):
+                    stale_kernels = get_stale_initramfs_kernels(target)
+                if stale_kernels:
+                    with timer.step('regenerate_initramfs'):
+                        regenerate_initramfs(in_chroot, stale_kernels)
+                with timer.step('write_grub_template'):
+                    templated = write_grub_template(
+                        inventory, target, extra=extra)
+                if not templated:
+                    with timer.step('update_grub_default'):
+                        update_grub_default(target, extra=extra)
+                    with timer.step('grub2_mkconfig'):
+                        grub2_mkconfig(in_chroot)
+                if uefi_part is not None:
+                    with timer.step('install_efi'):
+                        install_efi(
+                            inventory, target, uefi_part['device_path'],
+                            in_chroot)
+                else:
+                    grub2_install_devices(in_chroot, devices, timer)
+
+            def write_config():
+                with timer.step('write_fstab'):
+                    write_fstab(target, fstab)
+                with timer.step('write_network_config'):
+                    write_network_config(target, bootmac, network_config)
+                with timer.step('write_cloud_init'):
+                    finalize.write_cloud_init(target, curtin_config)
+
+            run_concurrently(install_bootloader, write_config)
+            # Written before relabeling, so they are labeled as well
+            finalize.mark_finalized(target)
+            finalize.create_hooks_log(target)
+            with timer.step('relabel_files'):
+                finalize.relabel_files(target, [
+                    '/etc/fstab',
+                    '/etc/default/grub',
+                    '/boot',
+                    '/etc/sysconfig/network-scripts',
+                    '/etc/cloud/cloud.cfg.d',
+                    '/' + finalize.FINALIZED,
+                    '/' + os.path.dirname(finalize.HOOKS_LOG),
+                    ], in_chroot=in_chroot)
+    finally:
+        timer.report(target)
 
 
 if __name__ == "__main__":
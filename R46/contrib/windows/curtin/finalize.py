@@ -9,6 +9,8 @@ from __future__ import (
 import os
 import sys
 import json
+import time
+from contextlib import contextmanager
 
 sys.path.append('/curtin')
 from curtin import util
@@ -29,6 +31,64 @@ Remove-Item $MyInvocation.InvocationName
 """
 
 
+# Timing records of the hook runs, appended to by every hook.
+HOOKS_LOG = os.path.join('ProgramData', 'maas-image-builder', 'hooks.json')
+
+
+class StepTimer(object):
+    """Records how long each step of the hook takes."""
+
+    def __init__(self, hook):
+        self.hook = hook
+        self.start = time.time()
+        self.steps = []
+
+    @contextmanager
+    def step(self, name):
+        """Times the steps run inside the context."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.time() - start))
+
+    def get_record(self):
+        """Returns the machine-readable timing record."""
+        return {
+            'hook': self.hook,
+            'start': self.start,
+            'total': round(time.time() - self.start, 3),
+            'steps': [
+                {'name': name, 'seconds': round(elapsed, 3)}
+                for name, elapsed in self.steps
+                ],
+            }
+
+    def report(self, target):
+        """Prints the timing breakdown and appends the record to the
+        hooks log in the target."""
+        record = self.get_record()
+        print('Hook timings:')
+        for step in record['steps']:
+            print('  %-40s %7.2fs' % (step['name'], step['seconds']))
+        print('  %-40s %7.2fs' % ('total', record['total']))
+        print(json.dumps(record, sort_keys=True))
+        path = os.path.join(target, HOOKS_LOG)
+        try:
+            records = []
+            if os.path.exists(path):
+                with open(path, 'r') as stream:
+                    records = json.load(stream)
+            records.append(record)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as stream:
+                json.dump(records, stream, indent=2, sort_keys=True)
+        except (IOError, OSError, ValueError) as error:
+            # The timings are informational, never fail the deployment.
+            print("Unable to write %s: %s" % (path, error))
+
+
 def load_config(path):
     """Loads the curtin config."""
     with open(path, 'r') as stream:
@@ -152,13 +212,20 @@ def main():
         print("Failed to get the debconf_selections.")
         sys.exit(1)
 
-    params = extract_maas_parameters(debconf)
-    write_cloudbase_init(target, params)
-    write_network_config(target, config)
-
-    license_key = get_license_key(config)
-    if license_key is not None:
-        write_license_key_script(target, license_key)
+    timer = StepTimer('finalize')
+    try:
+        params = extract_maas_parameters(debconf)
+        with timer.step('write_cloudbase_init'):
+            write_cloudbase_init(target, params)
+        with timer.step('write_network_config'):
+            write_network_config(target, config)
+
+        license_key = get_license_key(config)
+        if license_key is not None:
+            with timer.step('write_license_key_script'):
+                write_license_key_script(target, license_key)
+    finally:
+        timer.report(target)
 
 
 if __name__ == "__main__":
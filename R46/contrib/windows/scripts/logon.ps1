@@ -1,5 +1,24 @@
 $ErrorActionPreference = "Stop"
 
+# Drive of the install iso, found by its SCRIPTS label when launched, as
+# the letter changes with the drives attached to the VM.
+$installDrive = Split-Path -Qualifier $MyInvocation.MyCommand.Path
+
+function Write-Status ($message, $status = "STATUS") {
+    # The builder follows COM2, logging every status and aborting the
+    # installation as soon as an error is written.
+    $Host.UI.RawUI.WindowTitle = $message
+    try {
+        $port = New-Object System.IO.Ports.SerialPort COM2,115200,None,8,One
+        $port.Open()
+        $port.WriteLine("MIB-$status " + ($message -replace "\s+", " "))
+        $port.Close()
+    }
+    catch {
+        # COM2 is only there when the builder listens to it.
+    }
+}
+
 function WaitForNetwork ($seconds) {
     while (1) {
         # Get a list of DHCP-enabled interfaces that have a
@@ -30,58 +49,46 @@ try
     # seconds for the network to be active.
     WaitForNetwork 60
 
+    # Send Windows Update through the proxy given to the builder
+    $proxyPath = "$installDrive\scripts\proxy.txt"
+    if (Test-Path -Path $proxyPath)
+    {
+        $proxy = [Uri](Get-Content $proxyPath | Select-Object -First 1)
+        netsh.exe winhttp set proxy proxy-server="$($proxy.Host):$($proxy.Port)"
+    }
+
     # Install PSWindowsUpdate modules for PowerShell
     if (!(Test-Path -Path "$ENV:SystemRoot\System32\WindowsPowerShell\v1.0\Modules\PSWindowsUpdate"))
     {
-        $Host.UI.RawUI.WindowTitle = "Installing PSWindowsUpdate..."
-        Copy-Item E:\PSWindowsUpdate $ENV:SystemRoot\System32\WindowsPowerShell\v1.0\Modules -recurse
+        Write-Status "Installing PSWindowsUpdate..."
+        Copy-Item $installDrive\PSWindowsUpdate $ENV:SystemRoot\System32\WindowsPowerShell\v1.0\Modules -recurse
     }
 
     # Start the Update process.
     Import-Module PSWindowsUpdate
-    $Host.UI.RawUI.WindowTitle = "Installing updates..."
+    Write-Status "Installing updates..."
     Get-WUInstall -AcceptAll -IgnoreReboot -IgnoreUserInput -NotCategory "Language packs"
     if (Get-WURebootStatus -Silent)
     {
-        $Host.UI.RawUI.WindowTitle = "Updates installation finished. Rebooting."
+        Write-Status "Updates installation finished. Rebooting."
         shutdown /r /t 0
     }
     else
     {
-        # Inject extra drivers if the infs directory is present on the attached iso
-        if (Test-Path -Path "E:\infs")
+        # Inject extra drivers if the drivers iso is attached
+        $driversVolume = Get-WmiObject Win32_Volume -Filter "Label='DRIVERS'"
+        if ($driversVolume)
         {
-            # To install extra drivers the Windows Driver Kit is needed for dpinst.exe.
-            # Sadly you cannot just download dpinst.exe. The whole driver kit must be
-            # installed.
-
-            # Download the WDK installer.
-            $Host.UI.RawUI.WindowTitle = "Downloading Windows Driver Kit..."
-            $webclient = New-Object System.Net.WebClient
-            $wdksetup = [IO.Path]::GetFullPath("$ENV:TEMP\wdksetup.exe")
-            $wdkurl = "http://download.microsoft.com/download/0/8/C/08C7497F-8551-4054-97DE-60C0E510D97A/wdk/wdksetup.exe"
-            $webclient.DownloadFile($wdkurl, $wdksetup)
-
-            # Run the installer.
-            $Host.UI.RawUI.WindowTitle = "Installing Windows Driver Kit..."
-            $p = Start-Process -PassThru -Wait -FilePath "$wdksetup" -ArgumentList "/features OptionId.WindowsDriverKitComplete /q /ceip off /norestart"
-            if ($p.ExitCode -ne 0)
-            {
-                throw "Installing $wdksetup failed."
+            # pnputil.exe ships with Windows, so no driver kit is needed to
+            # stage and install the drivers.
+            Write-Status "Injecting Windows drivers..."
+            Get-ChildItem -Path "$($driversVolume.DriveLetter)\" -Recurse -Filter *.inf | ForEach-Object {
+                pnputil.exe -i -a "$($_.FullName)"
             }
-
-            # Run dpinst.exe with the path to the drivers.
-            $Host.UI.RawUI.WindowTitle = "Injecting Windows drivers..."
-            $dpinst = "$ENV:ProgramFiles\Windows Kits\8.1\redist\DIFx\dpinst\EngMui\$archDir\dpinst.exe"
-            Start-Process -Wait -FilePath "$dpinst" -ArgumentList "/S /C /F /SA /Path E:\infs"
-
-            # Uninstall the WDK
-            $Host.UI.RawUI.WindowTitle = "Uninstalling Windows Driver Kit..."
-            Start-Process -Wait -FilePath "$wdksetup" -ArgumentList "/features + /q /uninstall /norestart"
         }
 
-        $Host.UI.RawUI.WindowTitle = "Installing Cloudbase-Init..."
-        $cloudbaseInitPath = "E:\cloudbase\cloudbase_init.msi"
+        Write-Status "Installing Cloudbase-Init..."
+        $cloudbaseInitPath = "$installDrive\cloudbase\cloudbase_init.msi"
         $cloudbaseInitLog = "$ENV:Temp\cloudbase_init.log"
         $serialPortName = @(Get-WmiObject Win32_SerialPort)[0].DeviceId
         $p = Start-Process -Wait -PassThru -FilePath msiexec -ArgumentList "/i $cloudbaseInitPath /qn /l*v $cloudbaseInitLog LOGGINGSERIALPORTNAME=$serialPortName"
@@ -90,17 +97,23 @@ try
             throw "Installing $cloudbaseInitPath failed. Log: $cloudbaseInitLog"
         }
 
+        # The proxy is only reachable from the build host
+        if (Test-Path -Path $proxyPath)
+        {
+            netsh.exe winhttp reset proxy
+        }
+
         # We're done, remove LogonScript and disable AutoLogon
         Remove-ItemProperty -Path "HKLM:\SOFTWARE\Microsoft\Windows\CurrentVersion\Run" -Name Unattend*
         Remove-ItemProperty -Path "HKLM:\SOFTWARE\Microsoft\Windows NT\CurrentVersion\Winlogon" -Name AutoLogonCount
 
-        $Host.UI.RawUI.WindowTitle = "Running SetSetupComplete..."
+        Write-Status "Running SetSetupComplete..."
         & "$ENV:ProgramFiles\Cloudbase Solutions\Cloudbase-Init\bin\SetSetupComplete.cmd"
 
         # Write success, this is used to check that this process made it this far
         New-Item -Path C:\success.tch -Type file -Force
 
-        $Host.UI.RawUI.WindowTitle = "Running Sysprep..."
+        Write-Status "Running Sysprep..."
         $unattendedXmlPath = "$ENV:ProgramFiles\Cloudbase Solutions\Cloudbase-Init\conf\Unattend.xml"
         & "$ENV:SystemRoot\System32\Sysprep\Sysprep.exe" `/generalize `/oobe `/shutdown `/unattend:"$unattendedXmlPath"
     }
@@ -108,5 +121,6 @@ try
 catch
 {
     $_ | Out-File C:\error_log.txt
+    Write-Status ($_ | Out-String) "ERROR"
     shutdown /s /f /t 0
 }
@@ -0,0 +1,463 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Boot benchmark of built images.
+
+The image is unpacked onto a scratch disk, the curtin hooks of the image
+are run against it as they would be on deployment, and the disk is booted
+in qemu. The serial console and the forwarded SSH port give the time the
+kernel started, cloud-init finished and sshd answered."""
+
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+
+from mib import loop, utils, virt
+from mib.builders import BuildError
+from mib.progress import ESCAPE_PATTERN
+
+# Boot interface of the virtual machine, configured with the addresses of
+# the qemu user network.
+BENCH_MAC = '52:54:00:12:34:56'
+
+# Kernel command line the hooks read instead of /proc/cmdline. Everything
+# after '--' ends up on the kernel command line of the deployed image.
+BENCH_CMDLINE = (
+    'BOOTIF=01-%s -- console=tty0 console=ttyS0,115200\n' %
+    BENCH_MAC.replace(':', '-'))
+
+BENCH_CONFIG = {
+    'debconf_selections': {
+        'maas': (
+            'cloud-init cloud-init/maas-metadata-url string '
+            'http://127.0.0.1:5240/MAAS/metadata/\n'
+            'cloud-init cloud-init/maas-metadata-credentials string '
+            'oauth_consumer_key=bench&oauth_token_key=bench&'
+            'oauth_token_secret=bench\n'),
+        },
+    'network': {
+        'version': 1,
+        'config': [{
+            'type': 'physical',
+            'name': 'eth0',
+            'mac_address': BENCH_MAC,
+            'subnets': [{
+                'type': 'static',
+                'address': '10.0.2.15/24',
+                'gateway': '10.0.2.2',
+                }],
+            }],
+        },
+    }
+
+# Runs the hook in its own mount namespace, with the fake kernel command
+# line and network interfaces, and without EFI firmware so the hooks
+# install for the BIOS qemu boots with.
+HOOK_SHELL = (
+    'mount --bind "$1" /proc/cmdline && '
+    'mount --bind "$2" /sys/class/net && '
+    '{ [ ! -d /sys/firmware/efi ] || mount -t tmpfs none /sys/firmware; } && '
+    'shift 2 && exec "$@"')
+
+# Written after the hooks, so cloud-init uses the seed below instead of
+# the MAAS datasource the hooks configured.
+NOCLOUD_CONFIG = os.path.join(
+    'etc', 'cloud', 'cloud.cfg.d', '99_mib_bench.cfg')
+NOCLOUD_SEED = os.path.join('var', 'lib', 'cloud', 'seed', 'nocloud')
+NOCLOUD_META_DATA = """\
+instance-id: mib-bench
+local-hostname: mib-bench
+"""
+NOCLOUD_USER_DATA = """\
+#cloud-config
+ssh_pwauth: false
+"""
+
+# Log of the hook step timings written by the hooks into the target.
+HOOKS_LOG = os.path.join('var', 'log', 'maas-image-builder', 'hooks.json')
+
+# Older kernels cannot mount ext4 created with these features.
+MKFS_ARGS = ['mkfs.ext4', '-q', '-F', '-O', '^metadata_csum,^64bit']
+
+# Markers of the boot on the serial console.
+BOOT_MARKERS = [
+    ('kernel', re.compile(r'Linux version \d')),
+    ('cloud_init_final', re.compile(r'Cloud-init v\. \S+ finished at')),
+    ]
+
+# Results of the benchmark, in the order they happen.
+BOOT_RESULTS = ['kernel', 'cloud_init_final', 'sshd']
+
+
+def populate_parser(parser):
+    """Add the options of the bench-boot sub-command."""
+    parser.add_argument(
+        'image', help="Tarball or ddtgz built by maas-image-builder.")
+    parser.add_argument(
+        '--timeout',
+        default=600, type=int,
+        help=(
+            "Seconds to wait for the image to finish booting. "
+            "Default: 600"))
+    parser.add_argument(
+        '--disk-size',
+        default=8, type=int,
+        help="Size in GiB of the scratch disk. Default: 8")
+    parser.add_argument(
+        '--curtin',
+        help=(
+            "Directory containing the curtin package, used by the hooks. "
+            "Default: the curtin installed on this system."))
+    parser.add_argument(
+        '--console-log',
+        help="Write the serial console of the boot to this file.")
+    parser.add_argument(
+        '--record', action='store_true',
+        help="Record the result as the first boot time in the manifest "
+             "of the image.")
+
+
+def is_ddtgz(image):
+    """Returns True when image is a tarball holding a single disk image,
+    rather than a root filesystem."""
+    with tarfile.open(image, 'r:gz') as tar:
+        member = tar.next()
+    return (
+        member is not None and member.isfile() and
+        '/' not in member.name.lstrip('./'))
+
+
+def get_curtin_path(curtin_path=None):
+    """Returns the directory the curtin package is imported from."""
+    if curtin_path is None:
+        try:
+            import curtin  # pylint: disable=import-error
+        except ImportError:
+            raise BuildError(
+                "curtin is needed to run the curtin hooks, install it or "
+                "pass --curtin.")
+        curtin_path = os.path.dirname(os.path.dirname(curtin.__file__))
+    if not os.path.isdir(os.path.join(curtin_path, 'curtin')):
+        raise BuildError("No curtin package in %s." % curtin_path)
+    return curtin_path
+
+
+def get_accelerator():
+    """Returns the qemu accelerator to use, KVM when this host has it."""
+    if os.access('/dev/kvm', os.R_OK | os.W_OK):
+        return 'kvm'
+    return 'tcg'
+
+
+def get_free_port():
+    """Returns a free local TCP port."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def write_file(path, data):
+    """Writes data to path, creating its directory."""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as stream:
+        stream.write(data)
+
+
+def create_root_disk(disk_path, size):
+    """Creates a disk with a single bootable partition at disk_path.
+
+    :return: `loop.LoopDevice` of the disk, with its partition scanned.
+    """
+    with open(disk_path, 'wb') as stream:
+        stream.truncate(size * 1024 * 1024 * 1024)
+    utils.subp([
+        'parted', '-s', disk_path,
+        'mklabel', 'msdos',
+        'mkpart', 'primary', 'ext4', '1MiB', '100%',
+        'set', '1', 'boot', 'on',
+        ])
+    loop_device = loop.attach(disk_path)
+    try:
+        utils.subp(
+            MKFS_ARGS + ['-L', 'root', loop_device.get_partition(1)])
+    except (loop.LoopError, utils.ProcessExecutionError):
+        loop.detach(disk_path)
+        raise
+    return loop_device
+
+
+def get_uuid(device):
+    """Returns the filesystem UUID of device."""
+    out, _ = utils.subp(
+        ['blkid', '-o', 'value', '-s', 'UUID', device], capture=True)
+    return out.strip()
+
+
+def run_hooks(workdir, target, curtin_path, root_uuid):
+    """Runs the curtin hooks of the image mounted at target.
+
+    :return: Seconds the hooks took and the step timings they recorded,
+        or None when the image has no hooks.
+    """
+    hook_path = os.path.join(target, 'curtin', 'curtin-hooks.py')
+    if not os.path.exists(hook_path):
+        return None
+    cmdline_path = os.path.join(workdir, 'cmdline')
+    write_file(cmdline_path, BENCH_CMDLINE)
+    net_path = os.path.join(workdir, 'net')
+    write_file(os.path.join(net_path, 'eth0', 'address'), BENCH_MAC + '\n')
+    config_path = os.path.join(workdir, 'config.json')
+    write_file(config_path, json.dumps(BENCH_CONFIG))
+    fstab_path = os.path.join(workdir, 'fstab')
+    write_file(fstab_path, 'UUID=%s / ext4 defaults 0 0\n' % root_uuid)
+    env = dict(
+        os.environ,
+        TARGET_MOUNT_POINT=target,
+        CONFIG=config_path,
+        OUTPUT_FSTAB=fstab_path,
+        PYTHONPATH=curtin_path)
+    start = time.time()
+    utils.subp([
+        'unshare', '--mount', '--propagation', 'private',
+        'sh', '-c', HOOK_SHELL, 'sh', cmdline_path, net_path,
+        sys.executable, hook_path,
+        ], env=env)
+    seconds = time.time() - start
+    steps = None
+    try:
+        with open(os.path.join(target, HOOKS_LOG), 'r') as stream:
+            steps = json.load(stream)[-1]['steps']
+    except (IOError, ValueError, IndexError, KeyError):
+        pass
+    return {'seconds': round(seconds, 3), 'steps': steps}
+
+
+def write_nocloud_seed(target):
+    """Makes cloud-init in target use a NoCloud seed."""
+    write_file(
+        os.path.join(target, NOCLOUD_CONFIG),
+        'datasource_list: [ NoCloud, None ]\n')
+    seed_path = os.path.join(target, NOCLOUD_SEED)
+    write_file(os.path.join(seed_path, 'meta-data'), NOCLOUD_META_DATA)
+    write_file(os.path.join(seed_path, 'user-data'), NOCLOUD_USER_DATA)
+
+
+def prepare_root_disk(workdir, image, disk_path, size, curtin_path):
+    """Unpacks the root tarball onto a new disk and deploys it with the
+    curtin hooks of the image.
+
+    :return: Result of `run_hooks`.
+    """
+    loop_device = create_root_disk(disk_path, size)
+    try:
+        partition = loop_device.get_partition(1)
+        target = os.path.join(workdir, 'target')
+        os.mkdir(target)
+        utils.subp(['mount', partition, target])
+        try:
+            utils.subp([
+                'tar', '--selinux', '--xattrs', '--xattrs-include=*',
+                '-xzpf', image, '-C', target,
+                ])
+            hooks = run_hooks(
+                workdir, target, curtin_path, get_uuid(partition))
+            write_nocloud_seed(target)
+        finally:
+            utils.subp(['umount', target])
+        loop_device.sync()
+    finally:
+        loop.detach(disk_path)
+    return hooks
+
+
+def prepare_dd_disk(workdir, image, disk_path):
+    """Unpacks the disk image of the ddtgz to disk_path."""
+    dd_dir = os.path.join(workdir, 'dd')
+    os.mkdir(dd_dir)
+    utils.subp(['tar', '-xzSf', image, '-C', dd_dir])
+    names = os.listdir(dd_dir)
+    if len(names) != 1:
+        raise BuildError("Expected one disk image in %s." % image)
+    os.rename(os.path.join(dd_dir, names[0]), disk_path)
+
+
+class BootMonitor:
+    """Follows the serial console and the SSH port of a booting virtual
+    machine, recording when each of `BOOT_RESULTS` happened."""
+
+    def __init__(self, process, ssh_port, console_log=None):
+        self.process = process
+        self.ssh_port = ssh_port
+        self.console_log = console_log
+        self.start = time.time()
+        self.results = {}
+        self.finished = threading.Event()
+
+    def record(self, name):
+        """Records that name happened now."""
+        if name not in self.results:
+            self.results[name] = round(time.time() - self.start, 3)
+            if all(result in self.results for result in BOOT_RESULTS):
+                self.finished.set()
+
+    def follow_console(self):
+        """Reads the serial console until qemu exits."""
+        log = None
+        if self.console_log is not None:
+            log = open(self.console_log, 'w')
+        try:
+            for line in iter(self.process.stdout.readline, b''):
+                line = line.decode('utf-8', 'replace')
+                if log is not None:
+                    log.write(line)
+                line = ESCAPE_PATTERN.sub('', line)
+                for name, pattern in BOOT_MARKERS:
+                    if pattern.search(line) is not None:
+                        self.record(name)
+        finally:
+            if log is not None:
+                log.close()
+            self.finished.set()
+
+    def probe_ssh(self):
+        """Waits for sshd in the guest to send its banner."""
+        while not self.finished.is_set():
+            try:
+                sock = socket.create_connection(
+                    ('127.0.0.1', self.ssh_port), timeout=2)
+                try:
+                    banner = sock.recv(4)
+                finally:
+                    sock.close()
+            except (IOError, OSError):
+                banner = b''
+            if banner == b'SSH-':
+                self.record('sshd')
+                return
+            self.finished.wait(0.5)
+
+    def wait(self, timeout):
+        """Waits for the boot to finish. Returns False when it did not
+        finish in timeout seconds."""
+        threads = [
+            threading.Thread(target=self.follow_console),
+            threading.Thread(target=self.probe_ssh),
+            ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return self.finished.wait(timeout)
+
+
+def boot(disk_path, arch, ram, vcpus, timeout, console_log=None):
+    """Boots disk_path in qemu and measures the boot.
+
+    :return: Seconds from the start of qemu to each of `BOOT_RESULTS`,
+        None for the ones that did not happen.
+    """
+    accelerator = get_accelerator()
+    ssh_port = get_free_port()
+    args = [
+        'qemu-system-%s' % virt.ARCH_MAP.get(arch, arch),
+        '-machine', 'accel=%s' % accelerator,
+        '-m', '%s' % ram,
+        '-smp', '%s' % vcpus,
+        '-nodefaults', '-display', 'none',
+        '-serial', 'stdio',
+        '-drive', 'file=%s,format=raw,if=virtio,cache=unsafe' % disk_path,
+        '-netdev', 'user,id=net0,hostfwd=tcp:127.0.0.1:%d-:22' % ssh_port,
+        '-device', 'virtio-net-pci,netdev=net0,mac=%s' % BENCH_MAC,
+        ]
+    if accelerator == 'kvm':
+        args.extend(['-cpu', 'host'])
+    process = subprocess.Popen(
+        args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+    monitor = BootMonitor(process, ssh_port, console_log=console_log)
+    try:
+        finished = monitor.wait(timeout)
+    finally:
+        process.kill()
+        process.wait()
+    results = {
+        name: monitor.results.get(name)
+        for name in BOOT_RESULTS
+        }
+    results['accelerator'] = accelerator
+    results['timed_out'] = not finished
+    return results
+
+
+def bench_boot(params):
+    """Runs the boot benchmark of params.image and prints the result as
+    JSON."""
+    image = os.path.abspath(params.image)
+    if not os.path.isfile(image):
+        raise BuildError("No image at %s." % image)
+    dd_image = is_ddtgz(image)
+    with utils.tempdir(prefix=b'mib-bench-') as workdir:
+        disk_path = os.path.join(workdir, 'disk.img')
+        if dd_image:
+            hooks = None
+            prepare_dd_disk(workdir, image, disk_path)
+        else:
+            hooks = prepare_root_disk(
+                workdir, image, disk_path, params.disk_size,
+                get_curtin_path(params.curtin))
+        result = boot(
+            disk_path, params.arch, params.ram, params.vcpus,
+            params.timeout, console_log=params.console_log)
+    result['image'] = image
+    result['format'] = 'ddtgz' if dd_image else 'tgz'
+    result['hooks'] = hooks
+    print(json.dumps(result, indent=4, sort_keys=True))
+    if params.record:
+        utils.update_manifest(image, {'first_boot': result})
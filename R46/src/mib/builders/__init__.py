@@ -47,14 +47,55 @@ from abc import (
     abstractmethod,
     abstractproperty,
     )
+import json
+import logging
 import os
+import re
 import shutil
+import subprocess
 
 from mib import (
+    cloudinit,
+    kickstart,
+    net,
+    progress,
     utils,
     virt,
+    vm,
+    watchdog,
     )
 
+LOG = logging.getLogger(__name__)
+
+# Settings the curtin hooks add to /etc/default/grub of RHEL and CentOS.
+GRUB_PREPEND = """\
+# Set by MAAS fast-path installer.
+GRUB_TIMEOUT=0
+GRUB_TERMINAL_OUTPUT=console
+GRUB_DISABLE_OS_PROBER=true
+"""
+
+# Placeholders in the grub templates, replaced by the curtin hooks.
+GRUB_ROOT_UUID = '@ROOT_UUID@'
+GRUB_KERNEL_PARAMS = '@MAAS_KERNEL_PARAMS@'
+
+# Storage and network drivers put into the generic initramfs, so a deployed
+# image boots on any hardware these cover. Drivers the kernel of the image
+# does not ship are skipped.
+GENERIC_INITRAMFS_DRIVERS = [
+    # Storage
+    'aacraid', 'ahci', 'ata_piix', 'hpsa', 'hv_storvsc', 'isci',
+    'megaraid_sas', 'mpt2sas', 'mpt3sas', 'mptsas', 'nvme', 'sd_mod',
+    'smartpqi', 'virtio_blk', 'virtio_scsi', 'vmw_pvscsi', 'xen_blkfront',
+    # Network
+    'be2net', 'bnx2', 'bnx2x', 'bnxt_en', 'e1000', 'e1000e', 'hv_netvsc',
+    'i40e', 'ice', 'igb', 'ixgbe', 'mlx4_en', 'mlx5_core', 'qede', 'tg3',
+    'virtio_net', 'vmxnet3', 'xen_netfront',
+    ]
+
+# Kernels with a generic initramfs, read by the curtin hooks.
+INITRAMFS_MANIFEST = os.path.join('curtin', 'initramfs.json')
+
 
 class BuildError(Exception):
     """Error class for any build error."""
@@ -65,6 +106,10 @@ class Builder:
 
     __metaclass__ = ABCMeta
 
+    # Defaults of --vm-backend and --device-profile.
+    vm_backend = 'auto'
+    device_profile = 'virtio'
+
     @abstractproperty
     def name(self):
         """Name of the builder."""
@@ -85,11 +130,39 @@ class Builder:
         builder."""
         return utils.get_contrib_path(self.name, path)
 
+    def get_vm_backend(self, params, machine):
+        """Returns the backend running machine, chosen on the command
+        line or the default of the builder."""
+        backend = vm.get_backend(params.vm_backend or self.vm_backend)
+        try:
+            backend.check(machine)
+        except vm.VMError as error:
+            raise BuildError(str(error))
+        return backend
+
+    def run_vm(self, backend, machine):  # pylint: disable=no-self-use
+        """Runs the installation machine with backend.
+
+        :return: Statistics of the installation, for the image manifest.
+        """
+        try:
+            stats = backend.run(machine)
+        except vm.VMError as error:
+            raise BuildError(str(error))
+        stats['backend'] = backend.name
+        LOG.info(
+            "Installation with %s took %.0f seconds.",
+            backend.name, stats['seconds'])
+        return stats
+
 
 class VirtInstallBuilder(Builder):
     """Builder that uses virt-install."""
 
-    nic_model = None
+    # Written into the image once it is labeled, so the curtin hooks only
+    # relabel the files they write instead of the whole filesystem.
+    selinux_marker = os.path.join('curtin', '.selinux-prelabeled')
+
     extra_arguments = None
     initrd_inject = None
     install_location = None
@@ -111,10 +184,196 @@ class VirtInstallBuilder(Builder):
         """Return the name of the first part of the generated image."""
         return '%s-%s' % (self.name, params.arch)
 
+    def populate_parser(self, parser):
+        """Add parser options shared by the virt-install builders."""
+        parser.add_argument(
+            '--skip-preflight', action='store_true',
+            help=(
+                "Do not check that the kickstart packages can be resolved "
+                "before starting the installation."))
+        parser.add_argument(
+            '--cloud-init-fast-path', action='store_true',
+            help=(
+                "Configure cloud-init to only use the MAAS datasource and "
+                "the modules MAAS deployments need, shortening the first "
+                "boot."))
+
+    def preflight(self, params, kickstart_path, base_urls=None):
+        """Checks that the packages in the kickstart can be installed from
+        its repositories and base_urls, before any virtual machine is
+        started."""
+        if params.skip_preflight:
+            return
+        try:
+            result = kickstart.preflight(
+                kickstart_path, params.arch, base_urls=base_urls)
+        except kickstart.PreflightError as error:
+            raise BuildError("Kickstart pre-flight failed: %s" % error)
+        for line in kickstart.format_unresolved(result):
+            LOG.warning('Kickstart pre-flight: %s', line)
+        report = kickstart.format_result(result)
+        if report:
+            raise BuildError("Kickstart pre-flight failed:\n%s" % report)
+
     def modify_mount(self, mount_path):
         """Allows modification of the files before the final image
         is generated."""
 
+    def write_grub_template(self, mount_path):  # pylint: disable=no-self-use
+        """Generates grub.cfg and /etc/default/grub templates into the
+        curtin directory of the image.
+
+        The curtin hooks fill in the root UUID and kernel parameters,
+        instead of running grub2-mkconfig on every deployment. The kernels
+        and firmware type are recorded, so the hooks can fall back to
+        grub2-mkconfig when the deployed system differs.
+        """
+        template_dir = os.path.join(mount_path, 'curtin', 'grub')
+        default_path = os.path.join(mount_path, 'etc', 'default', 'grub')
+        with open(default_path, 'r') as stream:
+            default = stream.read()
+        default_template = default + GRUB_PREPEND + (
+            'GRUB_CMDLINE_LINUX="%s"\n' % GRUB_KERNEL_PARAMS)
+        try:
+            with open(default_path, 'w') as stream:
+                stream.write(default_template)
+            with utils.chroot(mount_path) as in_chroot:
+                out, _ = in_chroot(['grub2-mkconfig'], capture=True)
+        except utils.ProcessExecutionError:
+            # Not fatal, the hooks run grub2-mkconfig without a template.
+            return
+        finally:
+            with open(default_path, 'w') as stream:
+                stream.write(default)
+        match = re.search(r'root=UUID=(\S+)', out)
+        if match is None:
+            return
+        boot_path = os.path.join(mount_path, 'boot')
+        kernels = sorted(
+            filename
+            for filename in os.listdir(boot_path)
+            if filename.startswith('vmlinuz-'))
+        platform = 'efi' if os.path.isdir('/sys/firmware/efi') else 'bios'
+        os.makedirs(template_dir, exist_ok=True)
+        for filename, data in (
+                ('default-grub', default_template),
+                ('grub.cfg', out.replace(match.group(1), GRUB_ROOT_UUID)),
+                ('kernels', '\n'.join(kernels) + '\n'),
+                ('platform', platform + '\n')):
+            with open(os.path.join(template_dir, filename), 'w') as stream:
+                stream.write(data)
+
+    def write_generic_initramfs(self, mount_path):
+        """Regenerates the initramfs of every kernel in the image without
+        host-only mode and with the storage and network drivers in
+        `GENERIC_INITRAMFS_DRIVERS`.
+
+        The kernels are recorded in the curtin directory, so the curtin
+        hooks only run dracut for kernels that changed after the build.
+        """
+        kernels = self.get_kernel_versions(mount_path)
+        manifest = {'drivers': [], 'kernels': {}}
+        # Failures are not fatal, the hooks regenerate the initramfs of
+        # the kernels that are not recorded.
+        try:
+            with utils.chroot(mount_path) as in_chroot:
+                for kernel in kernels:
+                    drivers = self.get_available_drivers(
+                        mount_path, kernel, GENERIC_INITRAMFS_DRIVERS)
+                    initramfs = '/boot/initramfs-%s.img' % kernel
+                    try:
+                        in_chroot([
+                            'dracut', '--force', '--no-hostonly',
+                            '--add-drivers', ' '.join(drivers),
+                            initramfs, kernel])
+                    except utils.ProcessExecutionError as error:
+                        LOG.warning(
+                            "Failed to generate the generic initramfs of "
+                            "%s, it is generated on deployment: %s",
+                            kernel, error)
+                        continue
+                    manifest['drivers'] = sorted(
+                        set(manifest['drivers']).union(drivers))
+                    manifest['kernels'][kernel] = {
+                        'size': os.path.getsize(
+                            os.path.join(mount_path, initramfs.lstrip('/'))),
+                        }
+        except utils.ProcessExecutionError as error:
+            LOG.warning(
+                "Failed to generate the generic initramfs, it is generated "
+                "on deployment: %s", error)
+        with open(os.path.join(mount_path, INITRAMFS_MANIFEST), 'w') as stream:
+            json.dump(manifest, stream, indent=2, sort_keys=True)
+
+    def get_kernel_versions(self, mount_path):  # pylint: disable=no-self-use
+        """Returns the versions of the kernels installed in the image."""
+        modules_path = os.path.join(mount_path, 'lib', 'modules')
+        if not os.path.isdir(modules_path):
+            return []
+        return sorted(
+            version
+            for version in os.listdir(modules_path)
+            if os.path.exists(os.path.join(
+                mount_path, 'boot', 'vmlinuz-%s' % version)))
+
+    def get_available_drivers(  # pylint: disable=no-self-use
+            self, mount_path, kernel, drivers):
+        """Returns the drivers shipped by the kernel, from modules.dep."""
+        modules_dep = os.path.join(
+            mount_path, 'lib', 'modules', kernel, 'modules.dep')
+        available = set()
+        with open(modules_dep, 'r') as stream:
+            for line in stream:
+                module = os.path.basename(line.split(':', 1)[0])
+                available.add(module.split('.ko', 1)[0].replace('-', '_'))
+        return [driver for driver in drivers if driver in available]
+
+    def label_selinux(self, mount_path):
+        """Applies the SELinux labels to the image, so deployments do not
+        need to relabel the whole filesystem on first boot."""
+        marker_path = os.path.join(mount_path, self.selinux_marker)
+        if not os.path.isdir(os.path.dirname(marker_path)):
+            return
+        # Created before labeling, so the marker is labeled as well.
+        open(marker_path, 'a').close()
+        try:
+            labeled = utils.selinux_relabel(mount_path)
+        except utils.ProcessExecutionError:
+            os.unlink(marker_path)
+            raise
+        if not labeled:
+            os.unlink(marker_path)
+
+    def get_machine(self, params, vm_name, disk_path, console_log):
+        """Returns the virtual machine installing onto disk_path, writing
+        the serial console to console_log."""
+        disks = [vm.Disk(disk_path, 'disk', None)]
+        if self.install_location:
+            boot = 'location'
+        else:
+            boot = 'cdrom'
+            disks.append(vm.Disk(self.install_cdrom, 'cdrom', None))
+        extra_args = self.extra_arguments
+        if params.http_proxy:
+            # anaconda fetches the installation and repositories through it
+            proxy = 'proxy=%s' % net.get_guest_proxy(
+                params.http_proxy, params.network_mode)
+            extra_args = ' '.join(filter(None, [extra_args, proxy]))
+        return vm.Machine(
+            vm_name, params.arch, params.ram, params.vcpus, disks,
+            network=vm.get_network(params),
+            boot=boot,
+            location=self.install_location or None,
+            initrd_inject=self.initrd_inject,
+            extra_args=extra_args,
+            os_type=self.os_type,
+            os_variant=self.os_variant,
+            console_log=console_log,
+            profile=params.device_profile or self.device_profile,
+            cache=params.disk_cache,
+            limits=vm.get_limits(params),
+            timeout=vm.get_timeout(params))
+
     def build_image(self, params):
         """Builds the image with virt-install."""
         # Check for valid location
@@ -136,51 +395,48 @@ class VirtInstallBuilder(Builder):
             disk_path = os.path.join(workdir, 'disk.img')
             virt.create_disk(disk_path, self.disk_size, disk_format='raw')
             utils.subp(['chmod', '777', disk_path])
-            disk_str = "path=%s,format=raw" % disk_path
 
             # Start the installation
             vm_name = 'img-build-%s' % full_name
-            network_str = 'bridge=%s' % params.interface
-            if self.nic_model is not None:
-                network_str = '%s,model=%s' % (
-                    network_str, self.nic_model)
-            if self.install_location:
-                virt.install_location(
-                    vm_name,
-                    params.ram,
-                    params.arch,
-                    params.vcpus,
-                    self.os_type,
-                    self.os_variant,
-                    disk_str,
-                    network_str,
-                    self.install_location,
-                    initrd_inject=self.initrd_inject,
-                    extra_args=self.extra_arguments)
-            else:
-                virt.install_cdrom(
-                    vm_name,
-                    params.ram,
-                    params.arch,
-                    params.vcpus,
-                    self.os_type,
-                    self.os_variant,
-                    disk_str,
-                    network_str,
-                    self.install_cdrom)
-
-            # Remove the finished installation from virsh
-            virt.undefine(vm_name)
+            if params.build_id is not None:
+                vm_name = '%s-%s' % (vm_name, params.build_id)
+            console_log = os.path.join(workdir, 'console.log')
+            machine = self.get_machine(
+                params, vm_name, disk_path, console_log)
+            backend = self.get_vm_backend(params, machine)
+            # Watch the installer console, aborting as soon as it fails
+            # or stops making progress
+            install_watchdog = watchdog.InstallWatchdog(
+                lambda: backend.destroy(machine),
+                stall_timeout=params.stall_timeout * 60)
+            monitor = progress.InstallMonitor(
+                console_log, full_name, line_listeners=[install_watchdog])
+            manifest = {}
+            # The installation is removed from the backend once finished,
+            # failed or interrupted
+            with install_watchdog, monitor, backend.removing(machine):
+                try:
+                    manifest['install'] = self.run_vm(backend, machine)
+                except subprocess.CalledProcessError:
+                    if install_watchdog.failure is None:
+                        raise
+                if install_watchdog.failure is not None:
+                    raise BuildError(install_watchdog.failure)
 
             # Mount the disk image
             mount_path = os.path.join(workdir, "mount")
             os.mkdir(mount_path)
+            utils.mount_loop(disk_path, mount_path)
             try:
-                utils.mount_loop(disk_path, mount_path)
-
                 # Allow the osystem module to install any needed files
                 # into the filesystem
                 self.modify_mount(mount_path)
+                if params.cloud_init_fast_path:
+                    manifest['cloud_init'] = cloudinit.write_fast_path(
+                        mount_path)
+
+                # Label the filesystem now that it is complete
+                self.label_selinux(mount_path)
 
                 # Create the tarball
                 output_path = os.path.join(workdir, "output.tar.gz")
@@ -190,3 +446,7 @@ class VirtInstallBuilder(Builder):
 
             # Place in output
             shutil.move(output_path, params.output)
+            # The first boot is filled in once a boot benchmark of the
+            # image is recorded.
+            manifest['first_boot'] = None
+            utils.update_manifest(params.output, manifest)
@@ -57,7 +57,6 @@ class CentOSBuilder(VirtInstallBuilder):
     arches = ["i386", "amd64"]
     os_type = "linux"
     disk_size = 5
-    nic_model = "virtio"
     install_location = ""
 
     @property
@@ -69,8 +68,9 @@ class CentOSBuilder(VirtInstallBuilder):
     def full_name(self, params):
         return 'centos%s-%s' % (params.edition, params.arch)
 
-    def populate_parser(self, parser):  # pylint: disable=no-self-use
+    def populate_parser(self, parser):
         """Add parser options."""
+        super(CentOSBuilder, self).populate_parser(parser)
         parser.add_argument(
             '--edition', default='7',
             help="CentOS edition to generate. (Default: 7)")
@@ -104,6 +104,9 @@ class CentOSBuilder(VirtInstallBuilder):
             return
         opt_path = os.path.join(mount_path, 'curtin')
         shutil.copytree(path, opt_path)
+        if self.edition == '7':
+            self.write_generic_initramfs(mount_path)
+            self.write_grub_template(mount_path)
 
     def build_image(self, params):
         self.validate_params(params)
@@ -152,7 +155,15 @@ class CentOSBuilder(VirtInstallBuilder):
                 tmp_file_path)
             self.initrd_inject = tmp_file_path
 
-        super(CentOSBuilder, self).build_image(params)
-
-        if params.custom_kickstart is not None:
-            os.remove(self.initrd_inject)
+        try:
+            # The tree at install_location is the base repository, unless
+            # it points to an iso.
+            base_urls = []
+            if not self.install_location.endswith('.iso'):
+                base_urls.append(self.install_location)
+            self.preflight(params, self.initrd_inject, base_urls=base_urls)
+
+            super(CentOSBuilder, self).build_image(params)
+        finally:
+            if params.custom_kickstart is not None:
+                os.remove(self.initrd_inject)
@@ -67,10 +67,10 @@ class RHELBuilder(VirtInstallBuilder):
     os_type = "linux"
     os_variant = "rhel7.0"
     disk_size = 5
-    nic_model = "virtio"
 
     def populate_parser(self, parser):
         """Add parser arguments."""
+        super(RHELBuilder, self).populate_parser(parser)
         parser.add_argument(
             '--rhel-iso', required=True,
             help="Path to RHEL installation ISO.")
@@ -158,6 +158,8 @@ class RHELBuilder(VirtInstallBuilder):
             return
         opt_path = os.path.join(mount_path, 'curtin')
         shutil.copytree(path, opt_path)
+        self.write_generic_initramfs(mount_path)
+        self.write_grub_template(mount_path)
 
     def build_image(self, params):
         self.validate_params(params)
@@ -175,6 +177,12 @@ class RHELBuilder(VirtInstallBuilder):
             # Write the kickstarter config.
             self.write_ks(output_dir, params.custom_kickstart)
 
+            # Check the packages against the ISO and the kickstart
+            # repositories.
+            self.preflight(
+                params, os.path.join(output_dir, 'ks.cfg'),
+                base_urls=[output_dir])
+
             # Update isolinux to not have a timeout.
             self.set_timeout_zero(output_dir)
 
@@ -42,16 +42,20 @@
 
 """Builder for Windows."""
 
+import logging
 import os
 import re
 import shutil
+import subprocess
 import tempfile
 
 from tempita import Template
 
-from mib import net, utils
+from mib import loop, net, progress, utils, vm
 from mib.builders import Builder, BuildError
 
+LOG = logging.getLogger(__name__)
+
 EDITIONS = {
     'win2008r2': "Windows Server 2008 R2 SERVERSTANDARD",
     'win2008hvr2': "Windows Server 2008 R2 SERVERHYPERCORE",
@@ -63,12 +67,46 @@ EDITIONS = {
     'win2016hv': "Hyper-V Server 2016 SERVERHYPERCORE",
     }
 
+MB = 1024 * 1024
+SECTOR_SIZE = 512
+
+# Prefixes of the lines written by Write-Status in the install scripts.
+STATUS_PREFIX = 'MIB-STATUS '
+ERROR_PREFIX = 'MIB-ERROR '
+
+
+class StatusListener:
+    """Reads the status lines the install scripts write to COM2.
+
+    Every status is logged. On the first error on_abort is called, and
+    `failure` holds the error.
+
+    :param on_abort: callable that stops the installation.
+    """
+
+    def __init__(self, on_abort):
+        self.on_abort = on_abort
+        self.failure = None
+
+    def __call__(self, line):
+        """Handles one line written by the guest."""
+        line = line.strip('\r\n\x00 ')
+        if line.startswith(STATUS_PREFIX):
+            LOG.info('Windows: %s', line[len(STATUS_PREFIX):])
+        elif line.startswith(ERROR_PREFIX) and self.failure is None:
+            self.failure = 'Windows installation failed: %s' % (
+                line[len(ERROR_PREFIX):])
+            LOG.error('%s, aborting installation.', self.failure)
+            self.on_abort()
+
 
 class WindowsOSBuilder(Builder):
-    """Builds the Windows image using kvm-spice."""
+    """Builds the Windows image, by default with qemu."""
 
     name = "windows"
     arches = ["i386", "amd64"]
+    vm_backend = 'qemu'
+    device_profile = 'legacy'
 
     def populate_parser(self, parser):
         """Add parser options."""
@@ -95,6 +133,31 @@ class WindowsOSBuilder(Builder):
             '--windows-language',
             default='en-US',
             help="Windows installation language. Default: en-US")
+        parser.add_argument(
+            '--windows-shrink-headroom',
+            default=1024, type=int,
+            help=(
+                "Free space in MB left on the Windows partition when it is "
+                "shrunk before the image is generated. Default: 1024"))
+        parser.add_argument(
+            '--windows-no-shrink', action='store_true',
+            help=(
+                "Keep the full size disk instead of shrinking the Windows "
+                "partition to its minimum size plus headroom."))
+        parser.add_argument(
+            '--windows-phase-timeout',
+            default=0, type=int,
+            help=(
+                "Minutes Windows may run without rebooting before the "
+                "installation is aborted, 0 to wait forever. Only with the "
+                "qemu backend. Default: 0"))
+        parser.add_argument(
+            '--windows-screendump-interval',
+            default=60, type=int,
+            help=(
+                "Seconds between the screendumps taken of the installation, "
+                "which are kept when it fails. Only with the qemu backend. "
+                "Default: 60"))
         parser.add_argument(
             '--cloudbase-init',
             help=(
@@ -127,6 +190,16 @@ class WindowsOSBuilder(Builder):
         if drivers is not None and not os.path.isdir(drivers):
             raise BuildError(
                 "Invalid driver path: %s" % drivers)
+        if params.windows_shrink_headroom < 0:
+            raise BuildError(
+                "Invalid shrink headroom: %d" % params.windows_shrink_headroom)
+        if params.windows_phase_timeout < 0:
+            raise BuildError(
+                "Invalid phase timeout: %d" % params.windows_phase_timeout)
+        if params.windows_screendump_interval <= 0:
+            raise BuildError(
+                "Invalid screendump interval: %d" % (
+                    params.windows_screendump_interval))
 
     def validate_license_key(self, license_key):  # pylint: disable=no-self-use
         """Validates that license key is in the correct format. It does not
@@ -248,17 +321,39 @@ class WindowsOSBuilder(Builder):
             '-d', dest,
             ])
 
-    def create_iso(self, output, source):  # pylint: disable=no-self-use
+    def create_iso(  # pylint: disable=no-self-use
+            self, output, source, volume_id='SCRIPTS'):
         """Creates iso at output, containing files at source."""
         utils.subp([
             'genisoimage',
             '-o', output,
-            '-V', 'SCRIPTS',
+            '-V', volume_id,
             '-J', source
             ])
 
+    def prepare_drivers_iso(self, drivers_path):
+        """Returns the path to an iso containing the drivers at drivers_path.
+
+        The iso is kept in the cache keyed by the digest of the drivers, so
+        it is only generated the first time a driver set is used."""
+        digest = utils.digest_tree(drivers_path)
+        iso_path = utils.get_cache_path('drivers', '%s.iso' % digest)
+        if os.path.exists(iso_path):
+            return iso_path
+
+        # Generate next to the final location and rename into place, so
+        # concurrent builds never attach a partially written iso.
+        tmp_path = '%s.%d.tmp' % (iso_path, os.getpid())
+        try:
+            self.create_iso(tmp_path, drivers_path, volume_id='DRIVERS')
+            os.rename(tmp_path, iso_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        return iso_path
+
     def build_install_iso(self, workdir, arch, with_updates=False,
-                          drivers_path=None, cloudbase_init=None):
+                          cloudbase_init=None, http_proxy=None):
         """Builds the iso that is mounted to Windows, to complete the
         installation process."""
         install_path = os.path.join(workdir, 'install')
@@ -275,20 +370,20 @@ class WindowsOSBuilder(Builder):
         scripts_path = os.path.join(install_path, 'scripts')
         shutil.copytree(contrib_path, scripts_path)
 
-        # Copy the drivers if provided
-        if drivers_path is not None:
-            shutil.copytree(
-                drivers_path,
-                os.path.join(install_path, 'infs'))
-
         # Place PSWindowsUpdate modules if using with_updates
         if with_updates:
             zip_path = self.download_ps_windows_update(workdir)
             self.unzip_archive(zip_path, install_path)
 
-        # Create the iso
+            # logon.ps1 sets the proxy Windows Update goes through
+            if http_proxy:
+                proxy_path = os.path.join(scripts_path, 'proxy.txt')
+                with open(proxy_path, 'w') as stream:
+                    stream.write('%s\r\n' % http_proxy)
+
+        # Create the iso, found by Autounattend.xml from its SCRIPTS label
         output_iso = os.path.join(workdir, 'install.iso')
-        self.create_iso(output_iso, install_path)
+        self.create_iso(output_iso, install_path, volume_id='SCRIPTS')
         shutil.rmtree(install_path)
         return output_iso
 
@@ -301,32 +396,62 @@ class WindowsOSBuilder(Builder):
             output_path, size
             ])
 
-    def spawn_vm(  # pylint: disable=no-self-use
-            self, ram, vcpus, cdrom, floppy, install_iso, disk,
-            tap=None):
-        """Spawns the qemu vm for Windows to install."""
-        args = [
-            'kvm-spice',
-            '-m', '%s' % ram, '-smp', vcpus,
-            '-cdrom', cdrom,
-            '-drive', 'file=%s,index=0,format=raw,if=ide,media=disk' % disk,
-            '-drive', 'file=%s,index=1,format=raw,if=floppy' % floppy,
-            '-drive', 'file=%s,index=3,format=raw,if=ide,media=cdrom' % install_iso,
+    def get_monitor(self, params, directory):
+        """Returns the `vm.Monitor` saving screendumps into directory, or
+        None when the VM is not run by qemu."""
+        if (params.vm_backend or self.vm_backend) != 'qemu':
+            return None
+        phase_timeout = None
+        if params.windows_phase_timeout:
+            phase_timeout = params.windows_phase_timeout * 60
+        return vm.Monitor(
+            directory, params.windows_screendump_interval, phase_timeout)
+
+    def get_machine(
+            self, params, cdrom, floppy, install_iso, disk,
+            drivers_iso=None, screens_path=None, status_log=None):
+        """Returns the virtual machine installing Windows onto disk."""
+        # The drivers iso takes the IDE slot before the isos, which moves
+        # their drive letters; Autounattend.xml finds the install iso by
+        # its SCRIPTS label instead.
+        disks = [
+            vm.Disk(cdrom, 'cdrom', 2),
+            vm.Disk(disk, 'disk', 0),
+            vm.Disk(floppy, 'floppy', 1),
+            vm.Disk(install_iso, 'cdrom', 3),
             ]
-        if tap is not None:
-            mac = net.get_random_qemu_mac()
-            args.extend([
-                '-device', 'rtl8139,netdev=net00,mac=%s' % mac,
-                '-netdev',
-                'type=tap,id=net00,script=no,downscript=no,ifname=%s' % tap,
-                ])
-        args.extend([
-            '-boot', 'd', '-vga', 'std',
-            '-k', 'en-us',
-            # Debug *Remove*
-            '-vnc', ':1',
-            ])
-        utils.subp(args)
+        if drivers_iso is not None:
+            disks.append(vm.Disk(drivers_iso, 'cdrom', 1))
+        monitor = None
+        if screens_path is not None:
+            monitor = self.get_monitor(params, screens_path)
+        network = None
+        if params.windows_updates:
+            # The VM needs access to microsoft.com.
+            network = vm.get_network(params)
+        return vm.Machine(
+            'img-build-windows-%s' % (params.build_id or os.getpid()),
+            params.arch, params.ram, params.vcpus, disks,
+            network=network,
+            profile=params.device_profile or self.device_profile,
+            cache=params.disk_cache,
+            limits=vm.get_limits(params),
+            timeout=vm.get_timeout(params),
+            monitor=monitor,
+            status_log=status_log,
+            graphics=True,
+            reboot=True)
+
+    def save_screendumps(  # pylint: disable=no-self-use
+            self, screens_path, save_path):
+        """Copies the screendumps of the installation to save_path.
+
+        :return: True when there were screendumps to copy.
+        """
+        if not os.listdir(screens_path):
+            return False
+        shutil.copytree(screens_path, save_path)
+        return True
 
     def mount_partition(  # pylint: disable=no-self-use
             self, workdir, disk_path, partition):
@@ -336,15 +461,72 @@ class WindowsOSBuilder(Builder):
         utils.mount_loop(disk_path, mount_path, partition)
         return mount_path
 
-    def umount_partition(  # pylint: disable=no-self-use
-            self, disk_path, target, partition):
-        """Un-mounts the target, marks ntfs as clean, and removes loopback."""
-        utils.subp(['umount', target])
-        devs = utils.kpartx_list(disk_path)
-        utils.subp(['ntfsfix', '-d', devs[partition]])
-        utils.fs_sync()
-        utils.kpartx_del(disk_path)
+    def umount_partition(
+            self, disk_path, target, partition, shrink_headroom=None):
+        """Un-mounts the target, marks ntfs as clean, and removes loopback.
+
+        When shrink_headroom is given the ntfs filesystem is resized to its
+        minimum size plus shrink_headroom MB, and the partition and disk
+        are shrunk to match."""
+        fs_size = None
+        try:
+            utils.subp(['umount', target])
+            loop_device = loop.get(disk_path)
+            device = loop_device.get_partition(partition + 1)
+            if shrink_headroom is not None:
+                fs_size = self.resize_ntfs(device, shrink_headroom)
+            utils.subp(['ntfsfix', '-d', device])
+            loop_device.sync()
+        finally:
+            loop.detach(disk_path)
         os.rmdir(target)
+        if fs_size is not None:
+            self.shrink_disk(disk_path, partition, fs_size)
+
+    def resize_ntfs(  # pylint: disable=no-self-use
+            self, device, headroom):
+        """Resizes the ntfs filesystem on device to its minimum size plus
+        headroom MB. Returns the new size in bytes, or None when the
+        filesystem could not be made smaller."""
+        out, _ = utils.subp([
+            'ntfsresize', '--info', '--force', '--no-progress-bar', device,
+            ], capture=True)
+        match = re.search(r'You might resize at (\d+) bytes', out)
+        if match is None:
+            return None
+        current, _ = utils.subp(
+            ['blockdev', '--getsize64', device], capture=True)
+        size = int(match.group(1)) + headroom * MB
+        size = -(-size // MB) * MB
+        if size >= int(current):
+            return None
+        # ntfsresize asks for confirmation even with --force.
+        utils.subp([
+            'ntfsresize', '--force', '--no-progress-bar',
+            '--size', '%d' % size, device,
+            ], data=b'y\n')
+        return size
+
+    def shrink_disk(  # pylint: disable=no-self-use
+            self, disk_path, partition, fs_size):
+        """Shrinks the partition at index partition to hold fs_size bytes
+        and truncates the disk after its end."""
+        number = partition + 1
+        out, _ = utils.subp(['sfdisk', '--dump', disk_path], capture=True)
+        match = re.search(
+            r'^\S*\D%d\s*:\s*start=\s*(\d+)' % number, out, re.MULTILINE)
+        if match is None:
+            raise BuildError(
+                "Unable to find partition %d on %s." % (number, disk_path))
+        start = int(match.group(1))
+        sectors = fs_size // SECTOR_SIZE
+        # Only the size changes, sfdisk keeps the type and boot flag.
+        utils.subp([
+            'sfdisk', '--no-reread', '-N', '%d' % number, disk_path,
+            ], data=('%d,%d\n' % (start, sectors)).encode('ascii'))
+        disk_size = (start + sectors) * SECTOR_SIZE
+        disk_size = -(-disk_size // MB) * MB
+        os.truncate(disk_path, disk_size)
 
     def convert_to_unix(self, file_path):  # pylint: disable=no-self-use
         """Converts file to unix to easily view."""
@@ -429,11 +611,20 @@ class WindowsOSBuilder(Builder):
         with utils.tempdir() as workdir:
 
             # Build the install.iso
+            http_proxy = None
+            if params.http_proxy:
+                http_proxy = net.get_guest_proxy(
+                    params.http_proxy, params.network_mode)
             install_iso = self.build_install_iso(
                 workdir, params.arch,
                 with_updates=params.windows_updates,
-                drivers_path=params.windows_drivers,
-                cloudbase_init=params.cloudbase_init)
+                cloudbase_init=params.cloudbase_init,
+                http_proxy=http_proxy)
+
+            # Reuse or generate the iso holding the drivers
+            drivers_iso = None
+            if params.windows_drivers is not None:
+                drivers_iso = self.prepare_drivers_iso(params.windows_drivers)
 
             # Create the floppy with the Autounattend.xml
             floppy_path = self.prepare_floppy_disk(
@@ -446,26 +637,45 @@ class WindowsOSBuilder(Builder):
             disk_path = os.path.join(workdir, 'output.img')
             self.create_disk_image(disk_path, '16G')
 
-            # Create tap device, if installing Windows updates
-            # as the VM needs access to microsoft.com
-            tap_name = None
-            if params.windows_updates:
-                tap_name = net.create_tap(params.interface)
-
+            # Start the Windows installation
+            screens_path = os.path.join(workdir, 'screens')
+            os.mkdir(screens_path)
+            status_log = os.path.join(workdir, 'status.log')
+            machine = self.get_machine(
+                params, params.windows_iso, floppy_path, install_iso,
+                disk_path, drivers_iso=drivers_iso,
+                screens_path=screens_path, status_log=status_log)
+            backend = self.get_vm_backend(params, machine)
+            if backend.name != 'qemu':
+                # libvirt runs the VM as another user
+                utils.subp(['chmod', '755', workdir])
+            # Follow the status of the install scripts, stopping the VM
+            # as soon as they report an error
+            listener = StatusListener(lambda: backend.destroy(machine))
+            follower = progress.ConsoleFollower(status_log, [listener])
+            follower.start()
             try:
-                # Start the Windows installation
-                self.spawn_vm(
-                    params.ram, params.vcpus, params.windows_iso,
-                    floppy_path, install_iso,
-                    disk_path, tap=tap_name)
+                with backend.removing(machine):
+                    self.run_vm(backend, machine)
+            except subprocess.CalledProcessError:
+                if listener.failure is None:
+                    raise
+            except BuildError as error:
+                save_path = os.path.join(
+                    tempfile.mkdtemp(prefix="mib-windows"), 'screens')
+                if self.save_screendumps(screens_path, save_path):
+                    raise BuildError(
+                        '%s Screendumps placed in %s.' % (error, save_path))
+                raise
             finally:
-                # Destroy the tap
-                if tap_name is not None:
-                    net.delete_tap(tap_name)
+                follower.stop()
+            if listener.failure is not None:
+                raise BuildError(listener.failure)
 
             # Installation has finished, mount the disk
             mount_path = self.mount_partition(workdir, disk_path, 1)
 
+            shrink_headroom = None
             try:
                 # Check that installation went as expected
                 error_filename = 'windows-%s-%s-error.log' % (
@@ -480,9 +690,15 @@ class WindowsOSBuilder(Builder):
                 # Remove serial output from cloudbase-init.conf
                 self.remove_serial_log(mount_path)
 
+                # Shrink the partition and disk now that the image is
+                # complete; cloudbase-init extends it again on deploy.
+                if not params.windows_no_shrink:
+                    shrink_headroom = params.windows_shrink_headroom
+
             finally:
                 # Unmount and clean
-                self.umount_partition(disk_path, mount_path, 1)
+                self.umount_partition(
+                    disk_path, mount_path, 1, shrink_headroom=shrink_headroom)
 
             # Convert to raw, to save on some sparse space
             clean_disk_path = os.path.join(workdir, 'clean-output.img')
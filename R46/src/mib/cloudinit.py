@@ -0,0 +1,150 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Cloud-init configuration written into Linux images."""
+
+import os
+
+from mib import utils
+
+# Written into /etc/cloud/cloud.cfg.d of images built with
+# --cloud-init-fast-path. The curtin hooks write the MAAS credentials into
+# 90_datasource.cfg, which is read after this file.
+FAST_PATH_CONFIG = os.path.join(
+    'etc', 'cloud', 'cloud.cfg.d', '10_maas_fast_path.cfg')
+
+# Modules still run on first boot. The modules of the stock cloud.cfg
+# left out configure services MAAS deployments do not use (Red Hat
+# subscriptions, Spacewalk, configuration management agents, disk setup).
+FAST_PATH_MODULES = [
+    ('cloud_init_modules', [
+        'migrator',
+        'bootcmd',
+        'write-files',
+        'growpart',
+        'resizefs',
+        'set_hostname',
+        'update_hostname',
+        'update_etc_hosts',
+        'rsyslog',
+        'users-groups',
+        'ssh',
+        ]),
+    ('cloud_config_modules', [
+        'mounts',
+        'locale',
+        'set-passwords',
+        'ntp',
+        'timezone',
+        'yum-add-repo',
+        'package-update-upgrade-install',
+        'runcmd',
+        ]),
+    ('cloud_final_modules', [
+        'scripts-per-once',
+        'scripts-per-boot',
+        'scripts-per-instance',
+        'scripts-user',
+        'ssh-authkey-fingerprints',
+        'keys-to-console',
+        'phone-home',
+        'final-message',
+        'power-state-change',
+        ]),
+    ]
+
+FAST_PATH_HEADER = """\
+# Written by maas-image-builder --cloud-init-fast-path.
+#
+# Only the MAAS datasource is tried, so first boot does not probe for
+# other clouds, and unused modules are not run.
+datasource_list: [ MAAS ]
+datasource:
+  MAAS:
+    max_wait: 120
+    timeout: 10
+"""
+
+# Prints where the cloudinit package is installed in the image.
+CLOUDINIT_LOCATION_SCRIPT = (
+    "import os, cloudinit; print(os.path.dirname(cloudinit.__file__))")
+
+
+def render_fast_path_config():
+    """Returns the contents of the fast path configuration."""
+    lines = [FAST_PATH_HEADER.rstrip('\n')]
+    for section, modules in FAST_PATH_MODULES:
+        lines.append('%s:' % section)
+        lines.extend(' - %s' % module for module in modules)
+    return '\n'.join(lines) + '\n'
+
+
+def write_fast_path(mount_path):
+    """Writes the fast path configuration into the image mounted at
+    mount_path and compiles the cloud-init bytecode, so the first boot
+    does not compile it.
+
+    :return: Description of the fast path, for the image manifest.
+    """
+    config_path = os.path.join(mount_path, FAST_PATH_CONFIG)
+    with open(config_path, 'w') as stream:
+        stream.write(render_fast_path_config())
+    precompiled = None
+    with utils.chroot(mount_path) as in_chroot:
+        for python in ('python3', 'python'):
+            python_path = os.path.join(mount_path, 'usr', 'bin', python)
+            if not os.path.exists(python_path):
+                continue
+            try:
+                out, _ = in_chroot(
+                    [python, '-c', CLOUDINIT_LOCATION_SCRIPT], capture=True)
+                in_chroot([python, '-m', 'compileall', '-q', out.strip()])
+            except utils.ProcessExecutionError:
+                continue
+            precompiled = python
+            break
+    return {
+        'config': '/' + FAST_PATH_CONFIG,
+        'datasource': 'MAAS',
+        'modules': dict(FAST_PATH_MODULES),
+        'precompiled': precompiled,
+        }
@@ -46,45 +46,60 @@ import logging
 import os
 import sys
 import traceback
+from functools import partial
 
-from stevedore.extension import ExtensionManager
+from mib import registry
+from mib.parser import get_command, get_command_module, load_parser
 
-from mib.parser import load_parser
-
-# Enable basic logging to console.
-logging.basicConfig()
+# Enable basic logging to console, including installation progress.
+logging.basicConfig(level=logging.INFO)
 
 
 def execute():
     """Main execution of the application."""
-    # Check that have root privledges
-    if os.geteuid() != 0:
-        print('Error: must run with root privileges.')
-        sys.exit(1)
-
-    # Load all extensions.
-    manager = ExtensionManager("mib.builder", invoke_on_load=True)
-    builders = {
-        extension.obj.name: extension.obj
-        for extension in manager
-        }
+    # Only import the builder that is used. The daemon checks the
+    # arguments of the jobs it is given against all builders.
+    command = get_command()
+    builders = []
+    if command == 'serve':
+        builders = registry.load_all()
+    elif command is not None and get_command_module(command) is None:
+        builder = registry.load_builder(command)
+        if builder is not None:
+            builders.append(builder)
 
     # Load and parse the arguments.
-    parser = load_parser(builders.values())
+    parser = load_parser(builders, command=command)
     args = parser.parse_args()
 
-    # Check that the output directory exists.
-    args.output = os.path.abspath(args.output)
-    dirpath = os.path.dirname(args.output)
-    if not os.path.exists(dirpath):
-        print('Error: unable to write to output file in directory: %s' % (
-            dirpath))
+    # Check that have root privledges
+    if os.geteuid() != 0:
+        print('Error: must run with root privileges.')
         sys.exit(1)
 
-    # Build the image.
-    builder = builders[args.builder]
+    if args.builder == 'bench-boot':
+        # Benchmark the boot of a built image.
+        run = get_command_module(args.builder).bench_boot
+    elif args.builder == 'serve':
+        # Run the builds submitted to the daemon.
+        run = partial(
+            get_command_module(args.builder).serve, parser=parser,
+            builders=[builder.name for builder in builders])
+    else:
+        # Check that the output directory exists.
+        if args.output is None:
+            parser.error('the following arguments are required: -o/--output')
+        args.output = os.path.abspath(args.output)
+        dirpath = os.path.dirname(args.output)
+        if not os.path.exists(dirpath):
+            print('Error: unable to write to output file in directory: %s' % (
+                dirpath))
+            sys.exit(1)
+
+        # Build the image.
+        run = builders[0].build_image
     try:
-        builder.build_image(args)
+        run(args)
     except KeyboardInterrupt:
         sys.exit(1)
     except Exception:  # pylint: disable=broad-except
@@ -92,3 +107,7 @@ def execute():
         sys.exit(1)
 
     sys.exit(0)
+
+
+if __name__ == '__main__':
+    execute()
@@ -0,0 +1,571 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Build daemon running queued builds.
+
+Jobs are stored in a spool directory, so queued jobs survive a restart of
+the daemon, and are started by priority while fewer than the maximum
+number of builds are running. Each build runs `mib.core` in its own
+process, so it can be cancelled without affecting the others.
+
+The API is served over HTTP on a Unix socket and, optionally, on a TCP
+address:
+
+    POST   /jobs                  {"args": [...], "priority": 0}
+    GET    /jobs
+    GET    /jobs/<id>
+    GET    /jobs/<id>/log         ?offset=<bytes>&follow=1
+    GET    /jobs/<id>/artifact
+    GET    /jobs/<id>/manifest
+    DELETE /jobs/<id>
+"""
+
+import contextlib
+import heapq
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import signal
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from mib import utils
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_SPOOL = '/var/lib/maas-image-builder/spool'
+DEFAULT_SOCKET = '/run/maas-image-builder.sock'
+
+# States of a job. Jobs in the last three never change state again.
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+# Seconds a cancelled build has to clean up before it is killed.
+CANCEL_TIMEOUT = 120
+
+JOB_PATH = re.compile(
+    r'^/jobs/(?P<id>[0-9a-f]+)(?:/(?P<item>log|artifact|manifest))?$')
+
+
+class JobError(Exception):
+    """Raised when a job cannot be submitted or changed."""
+
+
+def populate_parser(parser):
+    """Add the options of the serve sub-command."""
+    parser.add_argument(
+        '--spool', default=DEFAULT_SPOOL,
+        help="Directory holding the jobs. Default: %s" % DEFAULT_SPOOL)
+    parser.add_argument(
+        '--max-jobs', default=1, type=int,
+        help="Number of builds running at the same time. Default: 1")
+    parser.add_argument(
+        '--socket', default=DEFAULT_SOCKET,
+        help="Unix socket serving the API. Default: %s" % DEFAULT_SOCKET)
+    parser.add_argument(
+        '--listen',
+        help=(
+            "Also serve the API over TCP on HOST:PORT. The API has no "
+            "authentication, only listen on trusted networks."))
+
+
+class Job:  # pylint: disable=too-many-instance-attributes
+    """Build stored in its own directory of the spool."""
+
+    fields = [
+        'id', 'args', 'builder', 'priority', 'state', 'returncode',
+        'submitted', 'started', 'finished',
+        ]
+
+    def __init__(self, path, **values):
+        self.path = path
+        self.id = values.get('id')  # pylint: disable=invalid-name
+        self.args = values.get('args')
+        self.builder = values.get('builder')
+        self.priority = values.get('priority')
+        self.state = values.get('state')
+        self.returncode = values.get('returncode')
+        self.submitted = values.get('submitted')
+        self.started = values.get('started')
+        self.finished = values.get('finished')
+        self.process = None
+
+    @classmethod
+    def load(cls, path):
+        """Return the job stored at path."""
+        with open(os.path.join(path, 'job.json'), 'r') as stream:
+            return cls(path, **json.load(stream))
+
+    def save(self):
+        """Write the job into its directory."""
+        tmp_path = os.path.join(self.path, 'job.json.tmp')
+        with open(tmp_path, 'w') as stream:
+            json.dump(self.to_dict(), stream, indent=2, sort_keys=True)
+        os.rename(tmp_path, os.path.join(self.path, 'job.json'))
+
+    def to_dict(self):
+        """Return the job as sent by the API."""
+        return {field: getattr(self, field) for field in self.fields}
+
+    @property
+    def log_path(self):
+        """Output of the build."""
+        return os.path.join(self.path, 'build.log')
+
+    @property
+    def artifact_path(self):
+        """Image built by the job."""
+        return os.path.join(self.path, 'artifact')
+
+    @property
+    def sort_key(self):
+        """Higher priorities first, then in order of submission."""
+        return (-self.priority, self.submitted, self.id)
+
+    def get_command(self):
+        """Return the command running the build."""
+        return [
+            sys.executable, '-m', 'mib.core',
+            '--output', self.artifact_path,
+            '--build-id', self.id,
+            ] + self.args
+
+
+class JobQueue:
+    """Runs the jobs of the spool, at most max_jobs at a time.
+
+    :param parser: parser of the command line, used to check the
+        arguments of submitted jobs.
+    :param builders: names of the builders jobs can use.
+    """
+
+    def __init__(self, spool, max_jobs, parser, builders):
+        self.spool = spool
+        self.max_jobs = max_jobs
+        self.parser = parser
+        self.builders = builders
+        self.jobs = {}
+        self.queue = []
+        self.running = set()
+        self.condition = threading.Condition()
+        self.stopping = False
+
+    def load(self):
+        """Load the jobs of the spool. Jobs that were running when the
+        daemon stopped are marked failed, their build was interrupted."""
+        jobs_dir = os.path.join(self.spool, 'jobs')
+        os.makedirs(jobs_dir, exist_ok=True)
+        for job_id in os.listdir(jobs_dir):
+            try:
+                job = Job.load(os.path.join(jobs_dir, job_id))
+            except (IOError, ValueError) as error:
+                LOG.warning("Ignoring job %s: %s", job_id, error)
+                continue
+            if job.state == RUNNING:
+                # Running it again could clash with what is left of the
+                # interrupted build, such as its virtual machine.
+                LOG.warning("Job %s was interrupted.", job.id)
+                job.state = FAILED
+                job.finished = time.time()
+                job.save()
+            self.jobs[job.id] = job
+            if job.state == QUEUED:
+                heapq.heappush(self.queue, (job.sort_key, job.id))
+
+    def check_args(self, args):
+        """Return the builder used by args, raising `JobError` when the
+        parser rejects them."""
+        if not isinstance(args, list) or not all(
+                isinstance(arg, str) for arg in args):
+            raise JobError("args must be a list of strings.")
+        errors = io.StringIO()
+        try:
+            with contextlib.redirect_stderr(errors):
+                params = self.parser.parse_args(
+                    ['--output', 'artifact', '--build-id', 'job'] + args)
+        except SystemExit:
+            # Only keep the error, not the usage printed before it.
+            raise JobError(errors.getvalue().strip().splitlines()[-1])
+        if params.builder not in self.builders:
+            raise JobError("Unknown builder: %s" % params.builder)
+        if params.output != 'artifact' or params.build_id != 'job':
+            raise JobError(
+                "The output and build id are chosen by the daemon.")
+        return params.builder
+
+    def submit(self, args, priority=0):
+        """Queue a build with the command line arguments args."""
+        if not isinstance(priority, int):
+            raise JobError("priority must be an integer.")
+        builder = self.check_args(args)
+        job_id = uuid.uuid4().hex[:12]
+        path = os.path.join(self.spool, 'jobs', job_id)
+        os.makedirs(path)
+        job = Job(
+            path, id=job_id, args=args, builder=builder, priority=priority,
+            state=QUEUED, submitted=time.time())
+        job.save()
+        with self.condition:
+            self.jobs[job.id] = job
+            heapq.heappush(self.queue, (job.sort_key, job.id))
+            self.condition.notify_all()
+        LOG.info("Queued job %s: %s", job.id, ' '.join(args))
+        return job
+
+    def get(self, job_id):
+        """Return the job with job_id, or None."""
+        return self.jobs.get(job_id)
+
+    def list(self):
+        """Return all jobs, in order of submission."""
+        return sorted(self.jobs.values(), key=lambda job: job.submitted)
+
+    def cancel(self, job_id):
+        """Cancel the job, interrupting its build when it is running."""
+        with self.condition:
+            job = self.jobs[job_id]
+            if job.state in FINISHED_STATES:
+                raise JobError("Job %s already %s." % (job.id, job.state))
+            if job.state == QUEUED:
+                self.finish(job, CANCELLED)
+                return job
+            job.state = CANCELLED
+            job.save()
+            process = job.process
+        # SIGINT lets the build destroy and remove its virtual machine,
+        # which libvirt runs outside of the process group, and unmount
+        # its disks before exiting.
+        LOG.info("Cancelling job %s", job.id)
+        os.killpg(process.pid, signal.SIGINT)
+        threading.Thread(
+            target=self.kill_after, args=(process, CANCEL_TIMEOUT),
+            daemon=True).start()
+        return job
+
+    def kill_after(self, process, timeout):  # pylint: disable=no-self-use
+        """Kill the build of process, when still running after timeout."""
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+
+    def finish(self, job, state, returncode=None):
+        """Mark the job finished in state. Called with the lock held."""
+        job.state = state
+        job.returncode = returncode
+        job.finished = time.time()
+        job.process = None
+        job.save()
+        self.running.discard(job.id)
+        self.condition.notify_all()
+
+    def start(self, job):
+        """Start the build of job. Called with the lock held."""
+        job.state = RUNNING
+        job.started = time.time()
+        job.returncode = None
+        job.save()
+        with open(job.log_path, 'ab') as log:
+            job.process = subprocess.Popen(
+                job.get_command(),
+                stdin=subprocess.DEVNULL, stdout=log,
+                stderr=subprocess.STDOUT, start_new_session=True,
+                env=dict(os.environ, PYTHONUNBUFFERED='1'))
+        self.running.add(job.id)
+        LOG.info("Started job %s", job.id)
+        threading.Thread(
+            target=self.wait_job, args=(job, job.process),
+            daemon=True).start()
+
+    def wait_job(self, job, process):
+        """Wait for the build of job to exit."""
+        returncode = process.wait()
+        with self.condition:
+            if job.state == CANCELLED:
+                state = CANCELLED
+            elif returncode == 0:
+                state = SUCCEEDED
+            else:
+                state = FAILED
+            self.finish(job, state, returncode)
+        LOG.info("Job %s %s", job.id, state)
+
+    def run(self):
+        """Start queued jobs until `stop` is called."""
+        with self.condition:
+            while not self.stopping:
+                while self.queue and len(self.running) < self.max_jobs:
+                    _, job_id = heapq.heappop(self.queue)
+                    job = self.jobs[job_id]
+                    if job.state == QUEUED:
+                        self.start(job)
+                self.condition.wait()
+
+    def stop(self):
+        """Stop starting jobs and interrupt the running builds, waiting
+        for them to exit."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+            processes = [
+                self.jobs[job_id].process for job_id in self.running]
+        for process in processes:
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(process.pid, signal.SIGINT)
+        deadline = time.monotonic() + CANCEL_TIMEOUT
+        for process in processes:
+            self.kill_after(process, max(0, deadline - time.monotonic()))
+        with self.condition:
+            self.condition.wait_for(lambda: not self.running)
+
+
+class APIHandler(BaseHTTPRequestHandler):
+    """Serves the API of the daemon."""
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        # The client address of a Unix socket is empty.
+        LOG.info(format, *args)
+
+    def send_json(self, data, status=200):
+        """Send data as the JSON response."""
+        body = json.dumps(data, indent=2, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        """Send an error response."""
+        self.send_json({'error': message}, status=status)
+
+    def get_job(self):
+        """Return the job and item of the path, sending an error response
+        and returning None for the job when there is none."""
+        match = JOB_PATH.match(urlparse(self.path).path)
+        job = None
+        if match is not None:
+            job = self.server.queue.get(match.group('id'))
+        if job is None:
+            self.send_error_json(404, "No such job.")
+            return None, None
+        return job, match.group('item')
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Return jobs, their logs and artifacts."""
+        if urlparse(self.path).path == '/jobs':
+            self.send_json([job.to_dict() for job in self.server.queue.list()])
+            return
+        job, item = self.get_job()
+        if job is None:
+            return
+        if item is None:
+            self.send_json(job.to_dict())
+        elif item == 'log':
+            self.send_log(job)
+        elif item == 'artifact':
+            self.send_file(
+                job, job.artifact_path, 'application/octet-stream')
+        else:
+            self.send_file(
+                job, utils.get_manifest_path(job.artifact_path),
+                'application/json')
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Submit a job."""
+        if urlparse(self.path).path != '/jobs':
+            self.send_error_json(404, "Not found.")
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            job = self.server.queue.submit(
+                request.get('args'), priority=request.get('priority', 0))
+        except (ValueError, AttributeError):
+            self.send_error_json(400, "Expected a JSON object.")
+        except JobError as error:
+            self.send_error_json(400, str(error))
+        else:
+            self.send_json(job.to_dict(), status=201)
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        """Cancel a job."""
+        job, item = self.get_job()
+        if job is None:
+            return
+        if item is not None:
+            self.send_error_json(405, "Only jobs can be cancelled.")
+            return
+        try:
+            job = self.server.queue.cancel(job.id)
+        except JobError as error:
+            self.send_error_json(409, str(error))
+        else:
+            self.send_json(job.to_dict())
+
+    def send_file(self, job, path, content_type):
+        """Send the file at path of a successful job."""
+        if job.state != SUCCEEDED or not os.path.exists(path):
+            self.send_error_json(404, "Job %s has no such file." % job.id)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as stream:
+            shutil.copyfileobj(stream, self.wfile)
+
+    def send_log(self, job):
+        """Send the build log from offset, following it until the job
+        finishes when asked to."""
+        query = parse_qs(urlparse(self.path).query)
+        try:
+            offset = int(query.get('offset', ['0'])[0])
+        except ValueError:
+            self.send_error_json(400, "offset must be an integer.")
+            return
+        follow = query.get('follow', ['0'])[0] not in ('0', '')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.end_headers()
+        try:
+            while True:
+                finished = job.state in FINISHED_STATES
+                if os.path.exists(job.log_path):
+                    with open(job.log_path, 'rb') as stream:
+                        stream.seek(offset)
+                        data = stream.read()
+                    offset += len(data)
+                    self.wfile.write(data)
+                    self.wfile.flush()
+                if not follow or finished:
+                    return
+                time.sleep(0.5)
+        except (BrokenPipeError, ConnectionResetError):
+            return
+
+
+class UnixAPIServer(
+        socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves the API on a Unix socket."""
+
+    daemon_threads = True
+
+    def __init__(self, path, queue):
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, APIHandler)
+        os.chmod(path, 0o660)
+        self.queue = queue
+
+
+class TCPAPIServer(socketserver.ThreadingMixIn, HTTPServer):
+    """Serves the API on a TCP address."""
+
+    daemon_threads = True
+
+    def __init__(self, address, queue):
+        HTTPServer.__init__(self, address, APIHandler)
+        self.queue = queue
+
+
+def parse_address(address):
+    """Return the (host, port) of HOST:PORT."""
+    host, _, port = address.rpartition(':')
+    try:
+        return host.strip('[]'), int(port)
+    except ValueError:
+        raise JobError("Invalid address: %s" % address)
+
+
+def serve(params, parser, builders):
+    """Run the daemon until interrupted.
+
+    :param parser: parser of the command line.
+    :param builders: names of the builders jobs can use.
+    """
+    queue = JobQueue(params.spool, params.max_jobs, parser, builders)
+    queue.load()
+    servers = [UnixAPIServer(params.socket, queue)]
+    if params.listen is not None:
+        servers.append(TCPAPIServer(parse_address(params.listen), queue))
+    threads = [threading.Thread(target=queue.run, daemon=True)]
+    threads.extend(
+        threading.Thread(target=server.serve_forever, daemon=True)
+        for server in servers)
+    for thread in threads:
+        thread.start()
+    LOG.info(
+        "Serving %d jobs from %s on %s", len(queue.jobs), params.spool,
+        ' and '.join(filter(None, [params.socket, params.listen])))
+    stopped = threading.Event()
+
+    def handle_signal(signum, frame):  # pylint: disable=unused-argument
+        LOG.info("Stopping on signal %d", signum)
+        stopped.set()
+
+    # The builds run in their own sessions, so they are only stopped
+    # when the daemon interrupts them.
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, handle_signal)
+    try:
+        stopped.wait()
+    finally:
+        queue.stop()
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        if os.path.exists(params.socket):
+            os.unlink(params.socket)
@@ -0,0 +1,431 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Kickstart parsing and package pre-flight resolution.
+
+The repositories and packages of a kickstart are checked against the
+repository metadata before any virtual machine is started, so missing
+packages are reported in seconds instead of deep into the installation.
+
+The resolution is name based: every requested package and group must
+exist, which fails the installation otherwise. Capabilities required by
+the selected packages that no package provides are only warned about,
+as primary.xml lists few file provides; rich dependencies and files are
+not checked, nor are version constraints.
+"""
+
+import bz2
+import fnmatch
+import gzip
+import json
+import logging
+import lzma
+import os
+import shlex
+from collections import namedtuple
+from urllib.parse import urljoin
+from urllib.request import urlopen
+from xml.etree import ElementTree
+
+from mib import utils
+
+LOG = logging.getLogger(__name__)
+
+REPO_NS = '{http://linux.duke.edu/metadata/repo}'
+COMMON_NS = '{http://linux.duke.edu/metadata/common}'
+RPM_NS = '{http://linux.duke.edu/metadata/rpm}'
+
+# RPM architectures installable for each builder architecture.
+ARCHES = {
+    'amd64': ['x86_64', 'noarch'],
+    'i386': ['i686', 'i586', 'i386', 'noarch'],
+    }
+
+# Seconds to wait on a repository before giving up.
+FETCH_TIMEOUT = 60
+
+Repository = namedtuple(
+    'Repository', ['name', 'baseurl', 'includepkgs', 'excludepkgs'])
+
+Kickstart = namedtuple(
+    'Kickstart',
+    ['repos', 'packages', 'excluded', 'groups', 'excluded_groups',
+     'options'])
+
+PreflightResult = namedtuple(
+    'PreflightResult', ['missing_packages', 'missing_groups', 'unresolved'])
+
+
+class PreflightError(Exception):
+    """Raised when the repository metadata cannot be loaded."""
+
+
+def parse_options(args):
+    """Return dictionary of the --key=value and --flag options in args."""
+    options = {}
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if not arg.startswith('--'):
+            continue
+        if '=' in arg:
+            key, value = arg[2:].split('=', 1)
+        elif args and not args[0].startswith('--'):
+            key, value = arg[2:], args.pop(0)
+        else:
+            key, value = arg[2:], True
+        options[key] = value
+    return options
+
+
+def split_list(value):
+    """Return the items of a comma separated option."""
+    if not value or value is True:
+        return []
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def parse_kickstart(path):
+    """Parse the repositories and %packages section of the kickstart."""
+    repos = []
+    packages = []
+    excluded = []
+    groups = []
+    excluded_groups = []
+    options = {}
+    section = None
+    with open(path, 'r') as stream:
+        for line in stream:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('%end'):
+                section = None
+                continue
+            if line.startswith('%'):
+                words = shlex.split(line)
+                section = words[0]
+                if section == '%packages':
+                    options.update(parse_options(words[1:]))
+                continue
+            if section == '%packages':
+                if line.startswith('-@'):
+                    excluded_groups.append(line[2:])
+                elif line.startswith('@'):
+                    groups.append(line[1:])
+                elif line.startswith('-'):
+                    excluded.append(line[1:])
+                else:
+                    packages.append(line)
+            elif section is None and line.startswith('repo '):
+                repo = parse_options(shlex.split(line)[1:])
+                if 'baseurl' not in repo:
+                    LOG.warning(
+                        'Repository %s has no baseurl, it is not checked.',
+                        repo.get('name'))
+                    continue
+                repos.append(Repository(
+                    name=repo.get('name', repo['baseurl']),
+                    baseurl=repo['baseurl'],
+                    includepkgs=split_list(repo.get('includepkgs')),
+                    excludepkgs=split_list(repo.get('excludepkgs'))))
+    return Kickstart(
+        repos=repos, packages=packages, excluded=excluded, groups=groups,
+        excluded_groups=excluded_groups, options=options)
+
+
+def fetch(url):
+    """Return the content at url, which may also be a local path."""
+    if '://' not in url:
+        url = 'file://' + os.path.abspath(url)
+    try:
+        with urlopen(url, timeout=FETCH_TIMEOUT) as response:
+            return response.read()
+    except (IOError, ValueError) as error:
+        raise PreflightError('Failed to fetch %s: %s' % (url, error))
+
+
+def get_repo_url(baseurl, path):
+    """Return the url of path inside the repository at baseurl."""
+    if not baseurl.endswith('/'):
+        baseurl += '/'
+    if '://' not in baseurl:
+        return os.path.join(baseurl, path)
+    return urljoin(baseurl, path)
+
+
+def get_repomd_locations(repomd):
+    """Return dictionary of data type to (href, checksum) from the
+    content of repomd.xml."""
+    locations = {}
+    root = ElementTree.fromstring(repomd)
+    for data in root.findall(REPO_NS + 'data'):
+        location = data.find(REPO_NS + 'location')
+        checksum = data.find(REPO_NS + 'checksum')
+        if location is None or checksum is None:
+            continue
+        locations[data.get('type')] = (location.get('href'), checksum.text)
+    return locations
+
+
+def decompress(href, data):
+    """Return the uncompressed repository metadata."""
+    if href.endswith('.gz'):
+        return gzip.decompress(data)
+    if href.endswith('.xz'):
+        return lzma.decompress(data)
+    if href.endswith('.bz2'):
+        return bz2.decompress(data)
+    return data
+
+
+def parse_primary(data):
+    """Return the package index of the content of primary.xml.
+
+    The index maps package names to their architectures, the capabilities
+    they require and the capabilities they provide, including files."""
+    index = {}
+    root = ElementTree.fromstring(data)
+    for package in root.findall(COMMON_NS + 'package'):
+        if package.get('type') != 'rpm':
+            continue
+        name = package.find(COMMON_NS + 'name').text
+        arch = package.find(COMMON_NS + 'arch').text
+        fmt = package.find(COMMON_NS + 'format')
+        entry = index.setdefault(
+            name, {'arches': [], 'requires': [], 'provides': [name]})
+        if arch not in entry['arches']:
+            entry['arches'].append(arch)
+        if fmt is None:
+            continue
+        for tag, key in (('requires', 'requires'), ('provides', 'provides')):
+            element = fmt.find(RPM_NS + tag)
+            if element is None:
+                continue
+            for capability in element.findall(RPM_NS + 'entry'):
+                cap = capability.get('name')
+                if cap.startswith('rpmlib(') or cap in entry[key]:
+                    continue
+                entry[key].append(cap)
+        for path in fmt.findall(COMMON_NS + 'file'):
+            if path.text not in entry['provides']:
+                entry['provides'].append(path.text)
+    return index
+
+
+def parse_comps(data):
+    """Return dictionary of group id to the mandatory and default package
+    names, from the content of comps.xml."""
+    groups = {}
+    root = ElementTree.fromstring(data)
+    for group in root.findall('group'):
+        names = [
+            req.text for req in group.iter('packagereq')
+            if req.get('type', 'mandatory') in ('mandatory', 'default')
+            ]
+        groups[group.findtext('id')] = {'packages': names, 'groups': []}
+    for environment in root.findall('environment'):
+        groups['^' + environment.findtext('id')] = {
+            'packages': [],
+            'groups': [
+                group.text for group in environment.iter('groupid')],
+            }
+    return groups
+
+
+def load_cached(baseurl, locations, data_type, parse):
+    """Return the parsed metadata of data_type, cached by its checksum."""
+    href, checksum = locations[data_type]
+    cache_path = utils.get_cache_path(
+        'repodata', '%s-%s.json' % (data_type, checksum))
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as stream:
+            return json.load(stream)
+    parsed = parse(decompress(href, fetch(get_repo_url(baseurl, href))))
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    with open(tmp_path, 'w') as stream:
+        json.dump(parsed, stream)
+    os.rename(tmp_path, cache_path)
+    return parsed
+
+
+def load_repository(repo):
+    """Return the (packages, groups) metadata of repo."""
+    repomd = fetch(get_repo_url(repo.baseurl, 'repodata/repomd.xml'))
+    locations = get_repomd_locations(repomd)
+    if 'primary' not in locations:
+        raise PreflightError(
+            'Repository %s has no primary metadata.' % repo.name)
+    packages = load_cached(repo.baseurl, locations, 'primary', parse_primary)
+    if repo.includepkgs:
+        packages = {
+            name: entry for name, entry in packages.items()
+            if any(fnmatch.fnmatch(name, glob) for glob in repo.includepkgs)
+            }
+    if repo.excludepkgs:
+        packages = {
+            name: entry for name, entry in packages.items()
+            if not any(
+                fnmatch.fnmatch(name, glob) for glob in repo.excludepkgs)
+            }
+    groups = {}
+    for data_type in ('group', 'group_gz'):
+        if data_type in locations:
+            groups = load_cached(
+                repo.baseurl, locations, data_type, parse_comps)
+            break
+    return packages, groups
+
+
+def resolve(kickstart, repositories, arch):
+    """Resolve the packages of the kickstart against the loaded
+    repositories. Returns a `PreflightResult`."""
+    arches = ARCHES.get(arch, ARCHES['amd64'])
+    packages = {}
+    groups = {}
+    for repo_packages, repo_groups in repositories:
+        for name, entry in repo_packages.items():
+            if name not in packages and set(entry['arches']) & set(arches):
+                packages[name] = entry
+        for group, entry in repo_groups.items():
+            groups.setdefault(group, entry)
+    provides = {}
+    for name, entry in packages.items():
+        for capability in entry['provides']:
+            provides.setdefault(capability, name)
+
+    # Expand the groups into package names.
+    requested_groups = list(kickstart.groups)
+    if 'nocore' not in kickstart.options:
+        requested_groups.append('core')
+    missing_groups = []
+    requested = list(kickstart.packages)
+    seen_groups = set()
+    while requested_groups:
+        group = requested_groups.pop(0)
+        if group in seen_groups or group in kickstart.excluded_groups:
+            continue
+        seen_groups.add(group)
+        if group not in groups:
+            missing_groups.append(group)
+            continue
+        requested.extend(groups[group]['packages'])
+        requested_groups.extend(groups[group]['groups'])
+
+    # Only explicitly listed packages must exist, group members that are
+    # missing are skipped by anaconda as well.
+    explicit = set(kickstart.packages)
+    missing_packages = []
+    unresolved = []
+    selected = set()
+    queue = [
+        name for name in requested
+        if not any(fnmatch.fnmatch(name, glob) for glob in kickstart.excluded)
+        ]
+    while queue:
+        name = queue.pop(0)
+        if name in selected:
+            continue
+        if name not in packages:
+            if name in provides:
+                queue.append(provides[name])
+            elif name in explicit:
+                missing_packages.append(name)
+            continue
+        selected.add(name)
+        for capability in packages[name]['requires']:
+            if capability in provides:
+                queue.append(provides[capability])
+            elif not is_unlisted(capability):
+                unresolved.append((name, capability))
+    return PreflightResult(
+        missing_packages=sorted(set(missing_packages)),
+        missing_groups=sorted(set(missing_groups)),
+        unresolved=sorted(set(unresolved)))
+
+
+def is_unlisted(capability):
+    """Returns True when primary.xml cannot tell whether capability is
+    provided: rich dependencies such as '(a if b)', and files, of which
+    only some are listed."""
+    return capability.startswith('(') or capability.startswith('/')
+
+
+def preflight(kickstart_path, arch, base_urls=None):
+    """Check that every package in the kickstart can be installed from its
+    repositories and the base_urls. Returns a `PreflightResult`.
+
+    :raises PreflightError: when a repository cannot be loaded.
+    """
+    kickstart = parse_kickstart(kickstart_path)
+    repos = [
+        Repository(
+            name=url, baseurl=url, includepkgs=[], excludepkgs=[])
+        for url in base_urls or []
+        ] + kickstart.repos
+    repositories = []
+    for repo in repos:
+        LOG.info('Loading metadata of repository %s.', repo.name)
+        repositories.append(load_repository(repo))
+    return resolve(kickstart, repositories, arch)
+
+
+def format_result(result):
+    """Return a human readable report of the missing packages and groups
+    in result, which fail the installation."""
+    lines = []
+    if result.missing_packages:
+        lines.append(
+            'Missing packages: %s' % ', '.join(result.missing_packages))
+    if result.missing_groups:
+        lines.append('Missing groups: %s' % ', '.join(result.missing_groups))
+    return '\n'.join(lines)
+
+
+def format_unresolved(result):
+    """Return the lines reporting the requirements in result that no
+    package provides. These are only warnings, as the resolution does not
+    check everything dnf and yum do."""
+    return [
+        '%s requires %s, which no package provides' % (name, capability)
+        for name, capability in result.unresolved
+        ]
@@ -0,0 +1,216 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Loop devices of disk images, with their partitions scanned.
+
+An image is attached to one loop device with LO_FLAGS_PARTSCAN, so its
+partitions appear as /dev/loopNpM and are mounted directly, without
+device-mapper mappings or a second loop device. The attached devices
+are tracked by image and detached at exit; they are also marked
+LO_FLAGS_AUTOCLEAR, so the kernel frees them when the process dies.
+"""
+
+import atexit
+import errno
+import fcntl
+import os
+import struct
+import threading
+import time
+
+# From linux/loop.h.
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_CTL_GET_FREE = 0x4C82
+LO_FLAGS_AUTOCLEAR = 4
+LO_FLAGS_PARTSCAN = 8
+LO_NAME_SIZE = 64
+
+LOOP_CONTROL = '/dev/loop-control'
+
+# struct loop_info64.
+LOOP_INFO64 = struct.Struct('=5Q4I%ds%ds32s2Q' % (LO_NAME_SIZE, LO_NAME_SIZE))
+
+# Attempts at getting a free loop device before giving up, as other
+# processes may take the free device between the two ioctls.
+ATTACH_RETRIES = 20
+
+# Seconds to wait for the device node of a partition.
+PARTITION_TIMEOUT = 10
+
+
+class LoopError(Exception):
+    """Raised when an image cannot be attached to a loop device."""
+
+
+class LoopDevice:
+    """Loop device attached to the image at path."""
+
+    def __init__(self, path, device, fd):
+        self.path = path
+        self.device = device
+        self.fd = fd
+
+    def get_partition(self, number, timeout=PARTITION_TIMEOUT):
+        """Returns the device of the partition number, counted from 1,
+        waiting for it to appear."""
+        partition = '%sp%d' % (self.device, number)
+        deadline = time.time() + timeout
+        while not os.path.exists(partition):
+            if time.time() > deadline:
+                raise LoopError(
+                    "Partition %d of %s did not appear on %s." % (
+                        number, self.path, self.device))
+            time.sleep(0.05)
+        return partition
+
+    def sync(self):
+        """Writes the cached data of the device to the image."""
+        os.fsync(self.fd)
+
+    def detach(self):
+        """Detaches the device from the image."""
+        try:
+            fcntl.ioctl(self.fd, LOOP_CLR_FD, 0)
+        except OSError as error:
+            # Already cleared when the device was closed elsewhere.
+            if error.errno != errno.ENXIO:
+                raise
+        finally:
+            os.close(self.fd)
+
+
+ATTACHED = {}
+ATTACHED_LOCK = threading.Lock()
+
+
+def set_fd(backing, number):
+    """Attaches backing to loop device number.
+
+    :return: The open loop device, or None when another process took it.
+    """
+    device = '/dev/loop%d' % number
+    fd = os.open(device, os.O_RDWR | os.O_CLOEXEC)
+    try:
+        fcntl.ioctl(fd, LOOP_SET_FD, backing)
+    except OSError as error:
+        os.close(fd)
+        if error.errno == errno.EBUSY:
+            return None
+        raise
+    return fd
+
+
+def attach(path):
+    """Attaches the image at path to a free loop device, scanning its
+    partitions. An image is only attached once per process.
+
+    :return: The `LoopDevice`.
+    """
+    path = os.path.abspath(path)
+    with ATTACHED_LOCK:
+        if path in ATTACHED:
+            return ATTACHED[path]
+        backing = os.open(path, os.O_RDWR | os.O_CLOEXEC)
+        try:
+            control = os.open(LOOP_CONTROL, os.O_RDWR | os.O_CLOEXEC)
+            try:
+                for _ in range(ATTACH_RETRIES):
+                    number = fcntl.ioctl(control, LOOP_CTL_GET_FREE)
+                    fd = set_fd(backing, number)
+                    if fd is not None:
+                        break
+                    time.sleep(0.05)
+                else:
+                    raise LoopError("No free loop device for %s." % path)
+            finally:
+                os.close(control)
+        except OSError as error:
+            raise LoopError("Failed to attach %s: %s" % (path, error))
+        finally:
+            # The loop device holds its own reference to the image.
+            os.close(backing)
+        loop_device = LoopDevice(path, '/dev/loop%d' % number, fd)
+        info = LOOP_INFO64.pack(
+            0, 0, 0, 0, 0, 0, 0, 0,
+            LO_FLAGS_PARTSCAN | LO_FLAGS_AUTOCLEAR,
+            os.fsencode(path)[:LO_NAME_SIZE - 1], b'', b'', 0, 0)
+        try:
+            fcntl.ioctl(fd, LOOP_SET_STATUS64, info)
+        except OSError as error:
+            loop_device.detach()
+            raise LoopError("Failed to scan %s: %s" % (path, error))
+        ATTACHED[path] = loop_device
+        return loop_device
+
+
+def get(path):
+    """Returns the `LoopDevice` the image at path is attached to."""
+    with ATTACHED_LOCK:
+        try:
+            return ATTACHED[os.path.abspath(path)]
+        except KeyError:
+            raise LoopError("%s is not attached." % path)
+
+
+def detach(path):
+    """Detaches the image at path from its loop device."""
+    with ATTACHED_LOCK:
+        loop_device = ATTACHED.pop(os.path.abspath(path), None)
+    if loop_device is not None:
+        loop_device.detach()
+
+
+def detach_all():
+    """Detaches every attached image."""
+    with ATTACHED_LOCK:
+        loop_devices = list(ATTACHED.values())
+        ATTACHED.clear()
+    for loop_device in loop_devices:
+        try:
+            loop_device.detach()
+        except OSError:
+            pass
+
+
+atexit.register(detach_all)
@@ -42,29 +42,23 @@
 
 """Utilities for networking."""
 
-import os
+import pwd
 import random
+from urllib.parse import urlsplit, urlunsplit
 
-from mib import utils
+from mib import netlink, utils
 
 TAP_PREFIX = "vmtap"
-TAP_SEARCH_PATH = '/sys/class/net'
 
+# Address of the host as seen by guests on the user-mode networks.
+USER_GATEWAY = '10.0.2.2'
 
-class NetworkError(Exception):
-    """Exception raise when error occurs creating or destroy network."""
+# Host names only reachable from the host itself.
+LOOPBACK_HOSTS = ['localhost', '127.0.0.1', '::1']
 
 
-def get_avaliable_tap_name():
-    """Gets the next available tap name."""
-    tapnum = 0
-    tappath = os.path.join(
-        TAP_SEARCH_PATH, '%s%d' % (TAP_PREFIX, tapnum))
-    while os.path.exists(tappath):
-        tapnum += 1
-        tappath = os.path.join(
-            TAP_SEARCH_PATH, '%s%d' % (TAP_PREFIX, tapnum))
-    return '%s%d' % (TAP_PREFIX, tapnum)
+class NetworkError(Exception):
+    """Exception raise when error occurs creating or destroy network."""
 
 
 def get_random_qemu_mac():
@@ -78,53 +72,45 @@ def get_random_qemu_mac():
     return ':'.join(map(lambda x: "%02x" % x, mac))
 
 
+def get_guest_proxy(proxy, network_mode):
+    """Returns the URL at which a guest on a network_mode network reaches
+    the HTTP proxy at proxy. A proxy listening on the loopback of the host
+    is reached through the gateway of the user-mode networks."""
+    parts = urlsplit(proxy)
+    if network_mode == 'bridge' or parts.hostname not in LOOPBACK_HOSTS:
+        return proxy
+    userinfo, at, _ = parts.netloc.rpartition('@')
+    netloc = userinfo + at + USER_GATEWAY
+    if parts.port is not None:
+        netloc += ':%d' % parts.port
+    return urlunsplit(parts._replace(netloc=netloc))
+
+
 def create_tap(bridge):
-    """Creates the tap device on bridge."""
-    tap_name = get_avaliable_tap_name()
+    """Creates the tap device on bridge, owned by the user that launched
+    sudo, and brings it up."""
     owner = utils.get_sudo_user()
-
-    # Create the tap device
     try:
-        utils.subp([
-            'ip', 'tuntap',
-            'add', 'mode', 'tap',
-            'user', owner,
-            tap_name,
-            ])
-    except utils.ProcessExecutionError:
+        tap_name = netlink.create_tap(
+            '%s%%d' % TAP_PREFIX, owner=pwd.getpwnam(owner).pw_uid)
+    except (KeyError, OSError) as error:
         raise NetworkError(
-            'Failed to create tap %s for %s.' % (tap_name, owner))
-
-    # Bring the tap device up
-    try:
-        utils.subp([
-            'ip', 'link',
-            'set', tap_name, 'up',
-            ])
-    except utils.ProcessExecutionError:
-        delete_tap(tap_name)
-        raise NetworkError('Failed to bring up %s.' % tap_name)
+            'Failed to create tap for %s: %s' % (owner, error))
 
-    # Add the tap device to the bridge
+    # Bring the tap device up on the bridge
     try:
-        utils.subp([
-            'ip', 'link',
-            'set', tap_name,
-            'master', bridge,
-            ])
-    except utils.ProcessExecutionError:
+        netlink.set_link(tap_name, up=True, master=bridge)
+    except OSError as error:
         delete_tap(tap_name)
-        raise NetworkError('Failed to add tap %s to %s.' % (tap_name, bridge))
+        raise NetworkError(
+            'Failed to add tap %s to %s: %s' % (tap_name, bridge, error))
     return tap_name
 
 
 def delete_tap(tap_name):
     """Deletes the tap device."""
     try:
-        utils.subp([
-            'ip', 'tuntap',
-            'del', 'mode', 'tap',
-            tap_name,
-            ])
-    except utils.ProcessExecutionError:
-        raise NetworkError('Failed to delete tap %s.' % tap_name)
+        netlink.delete_link(tap_name)
+    except OSError as error:
+        raise NetworkError(
+            'Failed to delete tap %s: %s' % (tap_name, error))
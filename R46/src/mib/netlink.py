@@ -0,0 +1,172 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Tap devices and links managed in-process.
+
+The tap devices are created through /dev/net/tun, which reserves the
+next free name of a pattern such as 'vmtap%d' atomically. The links are
+changed with rtnetlink requests, one round trip each, instead of
+forking ip(8). Failures raise `OSError` with the errno of the kernel.
+"""
+
+import fcntl
+import os
+import socket
+import struct
+
+# From linux/if_tun.h.
+TUNSETIFF = 0x400454ca
+TUNSETPERSIST = 0x400454cb
+TUNSETOWNER = 0x400454cc
+IFF_TAP = 0x0002
+IFF_NO_PI = 0x1000
+
+# From linux/if.h.
+IFF_UP = 0x1
+IFNAMSIZ = 16
+
+# From linux/netlink.h and linux/rtnetlink.h.
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+IFLA_MASTER = 10
+
+TUN_PATH = '/dev/net/tun'
+
+# struct ifreq, with the name and flags of the tun device.
+IFREQ = struct.Struct('=%dsH22x' % IFNAMSIZ)
+
+# struct nlmsghdr, struct ifinfomsg, struct rtattr and struct nlmsgerr.
+NLMSGHDR = struct.Struct('=IHHII')
+IFINFOMSG = struct.Struct('=BxHiII')
+RTATTR = struct.Struct('=HH')
+NLMSGERR = struct.Struct('=i')
+
+
+def create_tap(pattern, owner=None):
+    """Creates a persistent tap device named after pattern.
+
+    :param pattern: name of the device, where '%d' is replaced by the
+        kernel with the first free number.
+    :param owner: uid allowed to open the device, or None for root only.
+    :return: The name of the device.
+    """
+    fd = os.open(TUN_PATH, os.O_RDWR | os.O_CLOEXEC)
+    try:
+        ifreq = fcntl.ioctl(
+            fd, TUNSETIFF,
+            IFREQ.pack(pattern.encode('ascii'), IFF_TAP | IFF_NO_PI))
+        if owner is not None:
+            fcntl.ioctl(fd, TUNSETOWNER, owner)
+        # Until it is persistent, closing fd removes the device.
+        fcntl.ioctl(fd, TUNSETPERSIST, 1)
+    finally:
+        os.close(fd)
+    name, _ = IFREQ.unpack(ifreq)
+    return name.rstrip(b'\0').decode('ascii')
+
+
+def pack_attribute(kind, data):
+    """Returns the rtattr of kind holding data, padded to 4 bytes."""
+    length = RTATTR.size + len(data)
+    return RTATTR.pack(length, kind) + data + b'\0' * (-length % 4)
+
+
+def request(message_type, payload):
+    """Sends a rtnetlink request and waits for its acknowledgement."""
+    sock = socket.socket(
+        socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_CLOEXEC,
+        NETLINK_ROUTE)
+    try:
+        sock.bind((0, 0))
+        sequence = 1
+        sock.send(NLMSGHDR.pack(
+            NLMSGHDR.size + len(payload), message_type,
+            NLM_F_REQUEST | NLM_F_ACK, sequence, 0) + payload)
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + NLMSGHDR.size <= len(data):
+                length, kind, _, reply_sequence, _ = NLMSGHDR.unpack_from(
+                    data, offset)
+                if kind == NLMSG_ERROR and reply_sequence == sequence:
+                    error, = NLMSGERR.unpack_from(
+                        data, offset + NLMSGHDR.size)
+                    if error:
+                        raise OSError(-error, os.strerror(-error))
+                    return
+                offset += length + (-length % 4)
+    finally:
+        sock.close()
+
+
+def set_link(name, up=None, master=None):
+    """Changes the state and master of the link name in one request.
+
+    :param up: True to bring the link up, False to bring it down, None to
+        leave it.
+    :param master: name of the bridge to enslave the link to, or None.
+    """
+    flags = change = 0
+    if up is not None:
+        change = IFF_UP
+        flags = IFF_UP if up else 0
+    attributes = b''
+    if master is not None:
+        attributes += pack_attribute(
+            IFLA_MASTER, struct.pack('=I', socket.if_nametoindex(master)))
+    request(
+        RTM_NEWLINK,
+        IFINFOMSG.pack(
+            socket.AF_UNSPEC, 0, socket.if_nametoindex(name), flags, change) +
+        attributes)
+
+
+def delete_link(name):
+    """Deletes the link name."""
+    request(
+        RTM_DELLINK,
+        IFINFOMSG.pack(
+            socket.AF_UNSPEC, 0, socket.if_nametoindex(name), 0, 0))
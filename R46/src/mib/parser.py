@@ -40,15 +40,29 @@
 # PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGES.
 
-"""Parameter parser for maas-image-builder."""
+"""Parameter parser for maas-image-builder.
 
-from argparse import ArgumentParser
+Only the builders and sub-commands given to `load_parser` get their
+options added, so parsing the command line does not import the modules
+of every builder.
+"""
 
+import io
+from argparse import REMAINDER, ArgumentParser
+from contextlib import redirect_stderr
+from importlib import import_module
 
-def load_parser(builders):
-    """Load command line parser with the sub-commands."""
-    parser = ArgumentParser(
-        description="Image builder for the Curtin installer.")
+from mib import registry, vm
+
+# Sub-commands that are not builders, with the module implementing them.
+COMMANDS = [
+    ('bench-boot', 'mib.bench', "Measure the boot time of a built image."),
+    ('serve', 'mib.daemon', "Run builds submitted over an API."),
+    ]
+
+
+def add_global_options(parser):
+    """Add the options shared by all the sub-commands."""
     parser.add_argument(
         '--vcpus',
         default="1", help="Number of vcpus to configure for the installation.")
@@ -58,17 +72,91 @@ def load_parser(builders):
     parser.add_argument(
         '-i', '--interface',
         default='virbr0', help="Bridge interface for created virtual machine.")
+    parser.add_argument(
+        '--network-mode',
+        default='bridge', choices=vm.NETWORK_MODES,
+        help=(
+            "Network of the installation virtual machine: the bridge given "
+            "with --interface, or user-mode networking with slirp ('user') "
+            "or passt, which need no bridge. passt needs the qemu backend. "
+            "Default: bridge"))
+    parser.add_argument(
+        '--http-proxy',
+        help=(
+            "HTTP proxy used by the installation, such as a local caching "
+            "proxy. A proxy on localhost is reached through the host "
+            "address of the user-mode networks."))
     parser.add_argument(
         '-a', '--arch',
         default='amd64', choices=['amd64', 'i386'],
         help="Architecture to build. Default: amd64")
     parser.add_argument(
-        '-o', '--output', required=True,
-        help="Output file for built image.")
+        '--stall-timeout',
+        default=0, type=int,
+        help=(
+            "Minutes without installer output before the installation is "
+            "aborted, 0 to wait forever. Long silent %%post sections can "
+            "exceed it. Default: 0"))
+    parser.add_argument(
+        '-o', '--output',
+        help="Output file for built image, required by the builders.")
+    parser.add_argument(
+        '--build-id',
+        help=(
+            "Identifier added to the name of the virtual machine, so "
+            "builds of the same image can run at the same time."))
+    vm.populate_parser(parser)
+
+
+def get_command(args=None):
+    """Return the sub-command named in args, or None, without parsing
+    the options of the sub-commands."""
+    parser = ArgumentParser(add_help=False)
+    add_global_options(parser)
+    parser.add_argument('command', nargs='?')
+    parser.add_argument('options', nargs=REMAINDER)
+    try:
+        # Errors are reported when the full parser parses args.
+        with redirect_stderr(io.StringIO()):
+            params, _ = parser.parse_known_args(args)
+    except SystemExit:
+        return None
+    return params.command
+
+
+def get_command_module(name):
+    """Return the module implementing the sub-command, or None when name
+    is not one of `COMMANDS`."""
+    for command, module_name, _ in COMMANDS:
+        if command == name:
+            return import_module(module_name)
+    return None
+
+
+def load_parser(builders, command=None):
+    """Load command line parser with the sub-commands.
+
+    :param builders: builders whose options are added. The other builders
+        of `mib.registry` are listed without options.
+    :param command: only add the options of this sub-command out of
+        `COMMANDS`, rather than all of them.
+    """
+    parser = ArgumentParser(
+        description="Image builder for the Curtin installer.")
+    add_global_options(parser)
 
     # Add sub-commands from the builders.
     subparser = parser.add_subparsers(dest="builder")
-    for builder in builders:
-        builder_parser = subparser.add_parser(builder.name)
-        builder.populate_parser(builder_parser)
+    subparser.required = True
+    builders = {builder.name: builder for builder in builders}
+    for info in registry.BUILDERS:
+        builder_parser = subparser.add_parser(info.name, help=info.help)
+        if info.name in builders:
+            builders.pop(info.name).populate_parser(builder_parser)
+    for builder in builders.values():
+        builder.populate_parser(subparser.add_parser(builder.name))
+    for name, _, help_text in COMMANDS:
+        command_parser = subparser.add_parser(name, help=help_text)
+        if command is None or command == name:
+            get_command_module(name).populate_parser(command_parser)
     return parser
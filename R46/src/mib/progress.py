@@ -0,0 +1,352 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Progress of installations read from the serial console."""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+
+from mib import utils
+
+LOG = logging.getLogger(__name__)
+
+# Stages of an anaconda installation, in the order they happen.
+STAGES = ['setup', 'download', 'install', 'post', 'complete']
+
+STAGE_PATTERNS = [
+    ('setup', re.compile(
+        r'Starting installer|Setting up the installation environment|'
+        r'Running pre-installation scripts')),
+    ('download', re.compile(
+        r'Downloading packages|Downloading \d+ RPMs')),
+    ('install', re.compile(
+        r'Starting package installation process|'
+        r'Running pre-installation tasks|Preparing transaction')),
+    ('post', re.compile(
+        r'Running post-installation scripts|Running %post|'
+        r'Performing post-installation setup tasks|'
+        r'Configuring installed system')),
+    ('complete', re.compile(
+        r'Installation complete|The installation is complete|'
+        r'Power down|reboot: Power down')),
+    ]
+
+# Patterns giving the position inside a stage.
+COUNTER_PATTERNS = [
+    ('install', re.compile(
+        r'Installing (?P<message>\S+) \((?P<current>\d+)/(?P<total>\d+)\)')),
+    ('install', re.compile(
+        r'Packages completed:\s*(?P<current>\d+) of (?P<total>\d+)')),
+    ('download', re.compile(
+        r'Downloading \d+ RPMs, (?P<current>[\d.]+) MiB / '
+        r'(?P<total>[\d.]+) MiB')),
+    ]
+
+# Escape sequences written to the serial console by the installer.
+ESCAPE_PATTERN = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]|\x1b[()][0-9A-B]|\r')
+
+ProgressEvent = namedtuple(
+    'ProgressEvent',
+    ['stage', 'current', 'total', 'message', 'elapsed', 'eta'])
+
+
+class TimingHistory:
+    """Timings of previous installations, stored in the cache directory.
+
+    For each key the average total duration and the average time at
+    which every stage started are kept."""
+
+    # Number of runs after which older runs stop being weighted equally.
+    window = 10
+
+    def __init__(self, path=None):
+        if path is None:
+            path = utils.get_cache_path('timings.json')
+        self.path = path
+
+    def load(self):
+        """Return all recorded timings."""
+        try:
+            with open(self.path, 'r') as stream:
+                return json.load(stream)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, key):
+        """Return the recorded timings for key, or None."""
+        return self.load().get(key)
+
+    def record(self, key, total, stages):
+        """Merge the timings of a finished installation into the history."""
+        timings = self.load()
+        entry = timings.setdefault(
+            key, {'runs': 0, 'total': total, 'stages': {}})
+        entry['runs'] += 1
+        weight = 1.0 / min(entry['runs'], self.window)
+        entry['total'] += (total - entry['total']) * weight
+        for stage, offset in stages.items():
+            previous = entry['stages'].get(stage, offset)
+            entry['stages'][stage] = previous + (offset - previous) * weight
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as stream:
+            json.dump(timings, stream, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+
+class InstallProgress:
+    """Parses installer console output into `ProgressEvent`s.
+
+    :param history: timings of previous installations of the same kind,
+        as returned by `TimingHistory.get`, used to compute the ETA.
+    """
+
+    def __init__(self, history=None, start=None):
+        self.history = history
+        self.start = time.time() if start is None else start
+        self.stage = None
+        self.stages = {}
+        self.current = None
+        self.total = None
+
+    def feed(self, line, now=None):
+        """Parse one line of console output. Returns a `ProgressEvent` when
+        the line changed the progress, otherwise None."""
+        if now is None:
+            now = time.time()
+        line = ESCAPE_PATTERN.sub('', line).strip()
+        if not line:
+            return None
+        for stage, pattern in COUNTER_PATTERNS:
+            match = pattern.search(line)
+            if match is not None:
+                self.enter_stage(stage, now)
+                self.current = float(match.group('current'))
+                self.total = float(match.group('total'))
+                message = match.groupdict().get('message') or line
+                return self.event(message, now)
+        for stage, pattern in STAGE_PATTERNS:
+            if pattern.search(line) is not None:
+                if not self.enter_stage(stage, now):
+                    return None
+                return self.event(line, now)
+        return None
+
+    def enter_stage(self, stage, now):
+        """Move to stage, unless that would go backwards. Returns True when
+        the stage changed."""
+        if self.stage is not None:
+            if STAGES.index(stage) <= STAGES.index(self.stage):
+                return False
+        self.stage = stage
+        self.stages[stage] = now - self.start
+        self.current = None
+        self.total = None
+        return True
+
+    def fraction(self):
+        """Fraction of the current stage that has completed."""
+        if self.current is None or not self.total:
+            return 0.0
+        return min(self.current / self.total, 1.0)
+
+    def eta(self, now):
+        """Estimated number of seconds until the installation finishes, or
+        None when it cannot be estimated yet."""
+        elapsed = now - self.start
+        if self.history:
+            stages = self.history['stages']
+            total = self.history['total']
+            start = stages.get(self.stage, 0.0)
+            index = STAGES.index(self.stage)
+            following = [
+                stages[stage] for stage in STAGES[index + 1:]
+                if stage in stages
+                ]
+            end = following[0] if following else total
+            position = start + (end - start) * self.fraction()
+            if position <= 0:
+                return max(total - elapsed, 0.0)
+            # Scale by how fast this installation runs compared to the
+            # previous ones.
+            speed = min(max(elapsed / position, 0.5), 2.0)
+            return max(total - position, 0.0) * speed
+        if self.current:
+            stage_elapsed = elapsed - self.stages[self.stage]
+            rate = stage_elapsed / self.current
+            return rate * (self.total - self.current)
+        return None
+
+    def event(self, message, now):
+        """Return the `ProgressEvent` for the current state."""
+        return ProgressEvent(
+            stage=self.stage,
+            current=self.current,
+            total=self.total,
+            message=message,
+            elapsed=now - self.start,
+            eta=self.eta(now))
+
+
+def format_event(event):
+    """Return a human readable line for event."""
+    line = '[%s]' % event.stage
+    if event.current is not None and event.total:
+        line += ' %d/%d (%d%%)' % (
+            event.current, event.total, 100 * event.current / event.total)
+    line += ' %s' % event.message
+    if event.eta is not None:
+        line += ', ETA %dm%02ds' % divmod(int(event.eta), 60)
+    return line
+
+
+def log_event(event):
+    """Listener that logs event."""
+    LOG.info('%s', format_event(event))
+
+
+def replay(path, history=None):
+    """Parse a recorded console log. Returns the list of `ProgressEvent`s,
+    with the elapsed time counted in lines."""
+    parser = InstallProgress(history=history, start=0)
+    events = []
+    with open(path, 'r', errors='replace') as stream:
+        for lineno, line in enumerate(stream):
+            event = parser.feed(line, now=lineno)
+            if event is not None:
+                events.append(event)
+    return events
+
+
+class ConsoleFollower(threading.Thread):
+    """Follows a console log file as it is written, passing every line to
+    the listeners."""
+
+    interval = 1.0
+
+    def __init__(self, path, listeners):
+        super(ConsoleFollower, self).__init__(daemon=True)
+        self.path = path
+        self.listeners = listeners
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not os.path.exists(self.path):
+            if self.stopping.wait(self.interval):
+                return
+        with open(self.path, 'r', errors='replace') as stream:
+            buf = ''
+            while True:
+                stopping = self.stopping.is_set()
+                data = stream.read()
+                if data:
+                    buf += data
+                    lines = buf.split('\n')
+                    buf = lines.pop()
+                    for line in lines:
+                        self.dispatch(line)
+                elif stopping:
+                    break
+                else:
+                    self.stopping.wait(self.interval)
+            if buf:
+                self.dispatch(buf)
+
+    def dispatch(self, line):
+        """Passes line to all listeners."""
+        for listener in self.listeners:
+            try:
+                listener(line)
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception('Console listener failed.')
+
+    def stop(self):
+        """Reads the rest of the log and stops following it."""
+        self.stopping.set()
+        self.join()
+
+
+class InstallMonitor:
+    """Context manager that reports the progress of an installation from
+    its console log.
+
+    On a successful exit the stage timings are recorded in the history
+    under key, to improve the ETA of the next installation. Every raw line
+    is also passed to line_listeners.
+    """
+
+    def __init__(self, console_log, key, listeners=None, history=None,
+                 line_listeners=None):
+        self.console_log = console_log
+        self.key = key
+        self.history = TimingHistory() if history is None else history
+        self.listeners = [log_event] if listeners is None else listeners
+        self.line_listeners = line_listeners or []
+        self.progress = None
+        self.follower = None
+
+    def feed(self, line):
+        """Parses line, passing any resulting event to the listeners."""
+        event = self.progress.feed(line)
+        if event is not None:
+            for listener in self.listeners:
+                listener(event)
+
+    def __enter__(self):
+        self.progress = InstallProgress(history=self.history.get(self.key))
+        self.follower = ConsoleFollower(
+            self.console_log, [self.feed] + self.line_listeners)
+        self.follower.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.follower.stop()
+        if exc_type is None:
+            total = time.time() - self.progress.start
+            try:
+                self.history.record(self.key, total, self.progress.stages)
+            except (IOError, OSError):
+                LOG.warning('Unable to record installation timings.')
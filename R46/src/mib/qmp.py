@@ -0,0 +1,163 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Client of the QEMU Machine Protocol (QMP).
+
+qemu serves QMP on the socket given with -qmp. Every message is one line
+of JSON; asynchronous events, such as RESET when the guest reboots, are
+interleaved with the replies to the commands.
+"""
+
+import json
+import socket
+import threading
+import time
+
+
+class QMPError(Exception):
+    """Raised when the monitor cannot be reached or a command fails."""
+
+
+class QMPClient:
+    """Connection to the QMP monitor of a qemu process.
+
+    Commands may be executed from several threads; the events received
+    while waiting for their replies are kept until `get_events`.
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+        self.events = []
+        self.lock = threading.Lock()
+
+    def connect(self, process=None, wait=10):
+        """Connects to the monitor and negotiates the capabilities.
+
+        :param process: the qemu process serving the monitor. Stops
+            waiting for the socket when it exits.
+        :param wait: seconds to wait for the socket to be created.
+        """
+        deadline = time.time() + wait
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                break
+            except OSError as error:
+                sock.close()
+                exited = process is not None and process.poll() is not None
+                if exited or time.time() > deadline:
+                    raise QMPError(
+                        "Failed to connect to %s: %s" % (self.path, error))
+                time.sleep(0.1)
+        sock.settimeout(self.timeout)
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        greeting = self.read()
+        if 'QMP' not in greeting:
+            raise QMPError("%s is not a QMP monitor." % self.path)
+        self.execute('qmp_capabilities')
+
+    def close(self):
+        """Closes the connection."""
+        if self.sock is not None:
+            self.reader.close()
+            self.sock.close()
+            self.sock = None
+
+    def read(self):
+        """Returns the next message of the monitor."""
+        try:
+            line = self.reader.readline()
+        except OSError as error:
+            raise QMPError("Failed to read from %s: %s" % (self.path, error))
+        if not line:
+            raise QMPError("%s was closed." % self.path)
+        return json.loads(line.decode('utf-8'))
+
+    def execute(self, command, **arguments):
+        """Executes command with arguments.
+
+        :return: The return value of the command.
+        """
+        message = {'execute': command}
+        if arguments:
+            message['arguments'] = arguments
+        with self.lock:
+            if self.sock is None:
+                raise QMPError("%s is not connected." % self.path)
+            try:
+                self.sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+            except OSError as error:
+                raise QMPError(
+                    "Failed to write to %s: %s" % (self.path, error))
+            while True:
+                reply = self.read()
+                if 'event' in reply:
+                    self.events.append(reply)
+                elif 'error' in reply:
+                    raise QMPError("%s failed: %s" % (
+                        command, reply['error'].get('desc')))
+                elif 'return' in reply:
+                    return reply['return']
+
+    def get_events(self):
+        """Returns the events received since the last call, oldest first."""
+        with self.lock:
+            events, self.events = self.events, []
+        return events
+
+    def query_status(self):
+        """Returns the run state of the guest, such as 'running',
+        'paused', 'shutdown' or 'guest-panicked'."""
+        return self.execute('query-status')['status']
+
+    def screendump(self, path):
+        """Saves the screen of the guest to path, as a PPM image."""
+        self.execute('screendump', filename=path)
+
+    def system_powerdown(self):
+        """Presses the power button of the guest."""
+        self.execute('system_powerdown')
@@ -0,0 +1,112 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Builders known to maas-image-builder.
+
+The builders shipped with maas-image-builder are listed here, so the
+command line can be parsed without importing them, and only the builder
+that is used gets imported. Builders of other packages are found through
+the `mib.builder` entry points, which are only scanned for names that are
+not listed here.
+"""
+
+from collections import namedtuple
+from importlib import import_module
+
+BuilderInfo = namedtuple('BuilderInfo', ['name', 'path', 'help'])
+
+# Keep in sync with the mib.builder entry points in setup.py.
+BUILDERS = [
+    BuilderInfo(
+        'centos', 'mib.builders.centos:CentOSBuilder',
+        "Build CentOS 6 or 7 images."),
+    BuilderInfo(
+        'rhel', 'mib.builders.rhel:RHELBuilder',
+        "Build Red Hat Enterprise Linux 7 images."),
+    BuilderInfo(
+        'windows', 'mib.builders.windows:WindowsOSBuilder',
+        "Build Windows images."),
+    ]
+
+ENTRY_POINT_NAMESPACE = 'mib.builder'
+
+
+def get_info(name):
+    """Return the `BuilderInfo` of the builder called name, or None."""
+    for info in BUILDERS:
+        if info.name == name:
+            return info
+    return None
+
+
+def load_builder(name):
+    """Import and return the builder called name, or None when there is
+    no such builder."""
+    info = get_info(name)
+    if info is None:
+        return load_entry_point(name)
+    module_name, class_name = info.path.split(':')
+    return getattr(import_module(module_name), class_name)()
+
+
+def load_entry_point(name):
+    """Return the builder of another package called name, or None."""
+    from stevedore.driver import DriverManager
+    from stevedore.exception import NoMatches
+    try:
+        manager = DriverManager(
+            ENTRY_POINT_NAMESPACE, name, invoke_on_load=True)
+    except (NoMatches, RuntimeError):
+        return None
+    return manager.driver
+
+
+def load_all():
+    """Return all builders, including the ones of other packages."""
+    from stevedore.extension import ExtensionManager
+    builders = [load_builder(info.name) for info in BUILDERS]
+    manager = ExtensionManager(ENTRY_POINT_NAMESPACE, invoke_on_load=True)
+    builders.extend(
+        extension.obj
+        for extension in manager
+        if get_info(extension.name) is None)
+    return builders
@@ -0,0 +1,319 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Fake curtin package for running the contrib curtin hooks offline.
+
+The hooks import `curtin.block`, `curtin.util` and `curtin.net` from the
+curtin installer. `FakeCurtin` provides scripted versions of the parts the
+hooks use, records every external command they issue and emulates mount
+and umount with plain directories, so the hooks run against a synthetic
+target tree without root privileges.
+"""
+
+import os
+import shutil
+import sys
+import threading
+import types
+from collections import Counter
+from contextlib import contextmanager
+
+
+class FakeMounts:
+    """Emulates mounting block devices with directories.
+
+    Every device is backed by a directory. Mounting moves the contents of
+    the mountpoint aside and the contents of the device in; unmounting
+    does the reverse, so data written to a mounted device shows up the
+    next time it is mounted, like with a real filesystem. Mounting a
+    device that is already mounted shows the same files at both
+    mountpoints, again like a real filesystem.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.mounts = {}
+        self.lock = threading.Lock()
+
+    def get_device_path(self, device):
+        """Returns the backing directory of the device."""
+        path = os.path.join(self.root, 'devices', device.strip('/'))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @staticmethod
+    def move_contents(source, target):
+        """Moves every entry in source into target."""
+        os.makedirs(target, exist_ok=True)
+        for name in os.listdir(source):
+            os.rename(os.path.join(source, name), os.path.join(target, name))
+
+    def mount(self, device, mountpoint):
+        """Mounts the device at mountpoint."""
+        mountpoint = os.path.normpath(mountpoint)
+        with self.lock:
+            if mountpoint in self.mounts:
+                raise OSError('%s is already mounted' % mountpoint)
+            if not os.path.isdir(mountpoint):
+                raise OSError('mount point %s does not exist' % mountpoint)
+            hidden = os.path.join(
+                self.root, 'hidden', mountpoint.strip('/'))
+            shared = self.get_mountpoint(device)
+            if shared is not None:
+                os.makedirs(os.path.dirname(hidden), exist_ok=True)
+                os.rename(mountpoint, hidden)
+                os.symlink(shared, mountpoint)
+            else:
+                self.move_contents(mountpoint, hidden)
+                self.move_contents(self.get_device_path(device), mountpoint)
+            self.mounts[mountpoint] = (device, hidden)
+
+    def umount(self, mountpoint):
+        """Unmounts the device mounted at mountpoint."""
+        mountpoint = os.path.normpath(mountpoint)
+        with self.lock:
+            if mountpoint not in self.mounts:
+                raise OSError('%s is not mounted' % mountpoint)
+            device, hidden = self.mounts.pop(mountpoint)
+            if os.path.islink(mountpoint):
+                os.unlink(mountpoint)
+                os.rename(hidden, mountpoint)
+                return
+            self.move_contents(mountpoint, self.get_device_path(device))
+            self.move_contents(hidden, mountpoint)
+            shutil.rmtree(hidden)
+
+    def get_mountpoint(self, device):
+        """Returns where the device is mounted, or None."""
+        for mountpoint, (mounted, _) in self.mounts.items():
+            if mounted == device and not os.path.islink(mountpoint):
+                return mountpoint
+        return None
+
+    def is_mounted(self, mountpoint):
+        """Returns True when a device is mounted at mountpoint."""
+        return os.path.normpath(mountpoint) in self.mounts
+
+
+class FakeProcessError(Exception):
+    """Raised by the fake `subp` for commands scripted to fail."""
+
+    def __init__(self, args, exit_code, stdout='', stderr=''):
+        super(FakeProcessError, self).__init__(
+            'Command %s failed with exit code %d' % (args, exit_code))
+        self.cmd = args
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+class FakeCurtin:
+    """Scripted replacement for the curtin modules used by the hooks.
+
+    :param lsblock: Dictionary returned by `block._lsblock`, keyed by
+        device name like the real one.
+    :param environment: Dictionary returned by
+        `util.load_command_environment`.
+    :param uefi: Value of `util.is_uefi_bootable`.
+    :param responses: Dictionary mapping a command prefix tuple to the
+        (stdout, stderr) returned for it, or to a callable taking the
+        command arguments and returning them. Commands run in the chroot
+        are matched without the chroot prefix.
+    :param mounts: `FakeMounts` emulating mount and umount, or None to
+        treat them as any other command.
+    """
+
+    def __init__(self, lsblock, environment, uefi=False, responses=None,
+                 mounts=None):
+        self.lsblock = lsblock
+        self.environment = environment
+        self.uefi = uefi
+        self.responses = responses or {}
+        self.mounts = mounts
+        self.commands = []
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        """Counts a call to a fake curtin function."""
+        with self.lock:
+            self.calls[name] += 1
+
+    def run(self, args, chroot=None):
+        """Records the command and returns its scripted output."""
+        args = list(args)
+        with self.lock:
+            self.commands.append(
+                ['chroot', chroot] + args if chroot else args)
+        if chroot is None and self.mounts is not None:
+            if args[0] == 'mount':
+                self.mounts.mount(args[-2], args[-1])
+                return '', ''
+            elif args[0] == 'umount':
+                self.mounts.umount(args[-1])
+                return '', ''
+        for length in range(len(args), 0, -1):
+            response = self.responses.get(tuple(args[:length]))
+            if response is not None:
+                if callable(response):
+                    response = response(args)
+                return response
+        return '', ''
+
+    def build_block(self):
+        """Returns the fake `curtin.block` module."""
+        module = types.ModuleType('curtin.block')
+
+        def _lsblock(args=None):
+            self.count('block._lsblock')
+            self.run(['lsblk', '--pairs', '--bytes'])
+            return {
+                name: dict(info)
+                for name, info in self.lsblock.items()
+                }
+
+        def get_devices_for_mp(mountpoint):
+            self.count('block.get_devices_for_mp')
+            mountpoint = os.path.normpath(mountpoint)
+            return [
+                info['device_path']
+                for info in self.lsblock.values()
+                if info.get('MOUNTPOINT') == mountpoint
+                ]
+
+        def get_blockdev_for_partition(devpath):
+            self.count('block.get_blockdev_for_partition')
+            name = os.path.basename(devpath)
+            for parent, info in self.lsblock.items():
+                if name != parent and name.startswith(parent):
+                    return info['device_path'], int(name[len(parent):])
+            return devpath, None
+
+        module._lsblock = _lsblock
+        module.get_devices_for_mp = get_devices_for_mp
+        module.get_blockdev_for_partition = get_blockdev_for_partition
+        return module
+
+    def build_util(self):
+        """Returns the fake `curtin.util` module."""
+        module = types.ModuleType('curtin.util')
+        fake = self
+
+        def subp(args, data=None, rcs=None, env=None, capture=False,
+                 shell=False, target=None, **kwargs):
+            fake.count('util.subp')
+            return fake.run(args, chroot=target)
+
+        class RunInChroot:
+            """Fake of `curtin.util.RunInChroot`."""
+
+            def __init__(self, target, **kwargs):
+                self.target = target
+
+            def __enter__(self):
+                fake.count('util.RunInChroot')
+                return self
+
+            def __exit__(self, etype, value, trace):
+                return False
+
+            def __call__(self, args, **kwargs):
+                fake.count('util.RunInChroot.__call__')
+                return fake.run(args, chroot=self.target)
+
+        def load_command_environment(env=None, strict=False):
+            fake.count('util.load_command_environment')
+            return dict(fake.environment)
+
+        def is_uefi_bootable():
+            fake.count('util.is_uefi_bootable')
+            return fake.uefi
+
+        module.ProcessExecutionError = FakeProcessError
+        module.subp = subp
+        module.RunInChroot = RunInChroot
+        module.ChrootableTarget = RunInChroot
+        module.load_command_environment = load_command_environment
+        module.is_uefi_bootable = is_uefi_bootable
+        return module
+
+    def build_net(self):  # pylint: disable=no-self-use
+        """Returns the fake `curtin.net` module."""
+        return types.ModuleType('curtin.net')
+
+    @contextmanager
+    def installed(self):
+        """Context manager: makes `import curtin` load the fakes."""
+        package = types.ModuleType('curtin')
+        package.__path__ = []
+        block = self.build_block()
+        util = self.build_util()
+        net = self.build_net()
+        package.block = block
+        package.util = util
+        package.net = net
+        modules = {
+            'curtin': package,
+            'curtin.block': block,
+            'curtin.util': util,
+            'curtin.net': net,
+            }
+        saved = {name: sys.modules.get(name) for name in modules}
+        sys.modules.update(modules)
+        try:
+            yield self
+        finally:
+            for name, module in saved.items():
+                if module is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = module
+
+    def get_command_counts(self):
+        """Returns a Counter of the commands issued, by program name."""
+        counts = Counter()
+        for args in self.commands:
+            if args[0] == 'chroot':
+                counts['chroot %s' % args[2]] += 1
+            else:
+                counts[args[0]] += 1
+        return counts
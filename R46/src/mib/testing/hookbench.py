@@ -0,0 +1,630 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Offline benchmark of the contrib curtin hooks.
+
+Runs every curtin hook against a synthetic target tree with a fake curtin
+package (see `mib.testing.fakecurtin`), repeatedly, and reports the
+latency of each hook function and the external commands the hooks issue.
+A hook run that fails is reported and makes the benchmark exit non-zero,
+so this doubles as a smoke test of the hooks.
+
+    python3 -m mib.testing.hookbench --iterations 20
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import types
+from collections import Counter, namedtuple
+from functools import wraps
+
+from mib import utils
+from mib.testing.fakecurtin import FakeCurtin, FakeMounts
+
+
+class Scenario(namedtuple('Scenario', [
+        'name', 'os_name', 'hook_dir', 'hook', 'firmware', 'prebuilt'])):
+    """A hook script and the synthetic node it is run against.
+
+    firmware is 'bios', 'uefi', or 'uefi-mounted' when curtin mounted the
+    UEFI partition on /boot/efi before extracting the image onto it.
+    prebuilt is True when the image has the grub templates and generic
+    initramfs generated by maas-image-builder.
+    """
+
+    __slots__ = ()
+
+    @property
+    def uefi(self):
+        """True when the node boots with UEFI."""
+        return self.firmware != 'bios'
+
+
+SCENARIOS = [
+    Scenario('centos6', 'centos6', 'centos/centos6/curtin',
+             'curtin-hooks.py', 'bios', False),
+    Scenario('centos6-finalize', 'centos6', 'centos/centos6/curtin',
+             'finalize.py', 'bios', False),
+    Scenario('centos7', 'centos7', 'centos/centos7/curtin',
+             'curtin-hooks.py', 'bios', True),
+    Scenario('centos7-mkconfig', 'centos7', 'centos/centos7/curtin',
+             'curtin-hooks.py', 'bios', False),
+    Scenario('centos7-uefi', 'centos7', 'centos/centos7/curtin',
+             'curtin-hooks.py', 'uefi', True),
+    Scenario('centos7-uefi-mounted', 'centos7', 'centos/centos7/curtin',
+             'curtin-hooks.py', 'uefi-mounted', True),
+    Scenario('centos7-finalize', 'centos7', 'centos/centos7/curtin',
+             'finalize.py', 'bios', False),
+    Scenario('rhel', 'rhel', 'rhel/curtin',
+             'curtin-hooks.py', 'bios', True),
+    Scenario('rhel-mkconfig', 'rhel', 'rhel/curtin',
+             'curtin-hooks.py', 'bios', False),
+    Scenario('rhel-uefi', 'rhel', 'rhel/curtin',
+             'curtin-hooks.py', 'uefi', True),
+    Scenario('rhel-uefi-mounted', 'rhel', 'rhel/curtin',
+             'curtin-hooks.py', 'uefi-mounted', True),
+    Scenario('rhel-finalize', 'rhel', 'rhel/curtin',
+             'finalize.py', 'bios', False),
+    Scenario('windows-finalize', 'windows', 'windows/curtin',
+             'finalize.py', 'bios', False),
+    ]
+
+BOOT_MAC = '52:54:00:12:34:56'
+ROOT_UUID = '0b6d8a3e-6a4b-4c0e-9b51-2d7f6e1c5a10'
+KERNEL = '3.10.0-862.el7.x86_64'
+UEFI_DEVICE = '/dev/vda15'
+
+# EFI loaders of the image, which must end up on the UEFI partition.
+EFI_FILES = [
+    os.path.join('EFI', 'centos', 'shim.efi'),
+    os.path.join('EFI', 'centos', 'grubx64.efi'),
+    ]
+
+# Left on the UEFI partition by a previous installation.
+STALE_EFI_FILE = os.path.join('EFI', 'BOOT', 'stale.efi')
+
+# Scratch data earlier versions of the hooks left in the target.
+SCRATCH_PATHS = [
+    'yxp',
+    os.path.join('boot', 'efi_part'),
+    os.path.join('boot', '.efi-staging'),
+    ]
+
+MAAS_DEBCONF = (
+    'cloud-init cloud-init/maas-metadata-url string '
+    'http://maas.example.com:5240/MAAS/metadata/\n'
+    'cloud-init cloud-init/maas-metadata-credentials string '
+    'oauth_consumer_key=ckey&oauth_token_key=tkey&oauth_token_secret=tsecret\n'
+    )
+
+CURTIN_CONFIG = {
+    'debconf_selections': {'maas': MAAS_DEBCONF},
+    'license_key': None,
+    'network': {
+        'version': 1,
+        'config': [{
+            'type': 'physical',
+            'name': 'eth0',
+            'mac_address': BOOT_MAC,
+            'subnets': [{
+                'type': 'static',
+                'address': '10.0.0.5/24',
+                'gateway': '10.0.0.1',
+                }],
+            }],
+        },
+    }
+
+GRUB_DEFAULT = """\
+GRUB_TIMEOUT=5
+GRUB_DISTRIBUTOR="$(sed 's, release .*$,,g' /etc/system-release)"
+GRUB_DEFAULT=saved
+GRUB_DISABLE_SUBMENU=true
+GRUB_DISABLE_RECOVERY="true"
+"""
+
+GRUB_CFG_TEMPLATE = """\
+menuentry 'CentOS Linux ({kernel})' {{
+\tsearch --no-floppy --fs-uuid --set=root @ROOT_UUID@
+\tlinux16 /boot/vmlinuz-{kernel} root=UUID=@ROOT_UUID@ ro \
+@MAAS_KERNEL_PARAMS@
+\tinitrd16 /boot/initramfs-{kernel}.img
+}}
+"""
+
+# Output of the legacy grub shell for `find /boot/grub/stage1`.
+GRUB_FIND_OUTPUT = """\
+grub> find /boot/grub/stage1
+ (hd0,0)
+grub> quit
+"""
+
+
+def get_default_contrib_dir():
+    """Returns the contrib directory of the source tree when running from
+    it, otherwise the installed one."""
+    source_contrib = os.path.join(
+        os.path.dirname(__file__), os.pardir, os.pardir, os.pardir,
+        'contrib')
+    if os.path.isdir(source_contrib):
+        return os.path.abspath(source_contrib)
+    return utils.get_contrib_dir()
+
+
+def write_file(path, data=''):
+    """Writes data to path, creating the parent directories."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as stream:
+        stream.write(data)
+
+
+def make_host(root, target, scenario):
+    """Creates the synthetic /proc and /sys read by the hooks, for a node
+    with its root filesystem on vda1 mounted at target.
+
+    :return: lsblk information of the node, as returned by
+        `block._lsblock`.
+    """
+    write_file(
+        os.path.join(root, 'proc', 'cmdline'),
+        'BOOT_IMAGE=http://maas/boot-kernel nomodeset ro '
+        'root=squash:http://maas/squashfs ip=::::maas:BOOTIF '
+        'BOOTIF=01-%s -- console=ttyS0,115200\n' % BOOT_MAC.replace(':', '-'))
+    mounts = (
+        'proc /proc proc rw,nosuid,nodev,noexec,relatime 0 0\n'
+        '/dev/vda1 %s ext4 rw,relatime 0 0\n' % target)
+    if scenario.firmware == 'uefi-mounted':
+        mounts += '%s %s vfat rw,relatime 0 0\n' % (
+            UEFI_DEVICE, os.path.join(target, 'boot', 'efi'))
+    write_file(os.path.join(root, 'proc', 'mounts'), mounts)
+    block_dir = os.path.join(root, 'sys', 'class', 'block')
+    disk_dir = os.path.join(root, 'sys', 'devices', 'pci0000:00', 'vda')
+    os.makedirs(block_dir)
+    os.makedirs(disk_dir)
+    os.symlink(disk_dir, os.path.join(block_dir, 'vda'))
+    lsblock = {
+        'vda': {
+            'NAME': 'vda', 'KNAME': 'vda', 'TYPE': 'disk', 'LABEL': '',
+            'UUID': '', 'FSTYPE': '', 'MOUNTPOINT': '',
+            'device_path': '/dev/vda',
+            },
+        'vda1': {
+            'NAME': 'vda1', 'KNAME': 'vda1', 'TYPE': 'part',
+            'LABEL': 'root', 'UUID': ROOT_UUID, 'FSTYPE': 'ext4',
+            'MOUNTPOINT': target, 'device_path': '/dev/vda1',
+            },
+        }
+    partitions = ['vda1']
+    if scenario.uefi:
+        lsblock['vda15'] = {
+            'NAME': 'vda15', 'KNAME': 'vda15', 'TYPE': 'part',
+            'LABEL': 'uefi-boot', 'UUID': '5A1C-9F3E', 'FSTYPE': 'vfat',
+            'MOUNTPOINT': '', 'device_path': UEFI_DEVICE,
+            }
+        partitions.append('vda15')
+    for partition in partitions:
+        partition_dir = os.path.join(disk_dir, partition)
+        write_file(
+            os.path.join(partition_dir, 'partition'),
+            '%s\n' % partition[len('vda'):])
+        os.symlink(partition_dir, os.path.join(block_dir, partition))
+    net_dir = os.path.join(root, 'sys', 'class', 'net')
+    write_file(os.path.join(net_dir, 'lo', 'address'), '00:00:00:00:00:00\n')
+    write_file(os.path.join(net_dir, 'eth0', 'address'), BOOT_MAC + '\n')
+    return lsblock
+
+
+def make_linux_target(target, scenario):
+    """Creates a synthetic RHEL or CentOS root filesystem."""
+    write_file(
+        os.path.join(target, 'etc', 'fstab'), 'UUID=build / ext4 defaults\n')
+    write_file(
+        os.path.join(target, 'etc', 'selinux', 'config'),
+        'SELINUX=enforcing\nSELINUXTYPE=targeted\n')
+    for path in (
+            ('etc', 'sysconfig', 'network-scripts'),
+            ('etc', 'cloud', 'cloud.cfg.d'),
+            ('boot', 'efi'),
+            ):
+        os.makedirs(os.path.join(target, *path))
+    write_file(os.path.join(target, 'curtin', '.selinux-prelabeled'))
+    try:
+        os.setxattr(
+            os.path.join(target, 'etc', 'selinux', 'config'),
+            'security.selinux', b'system_u:object_r:selinux_config_t:s0\0')
+    except OSError:
+        # Without the privilege the hooks fall back to a relabel on first
+        # boot, as for a deployment that lost the labels.
+        pass
+    write_file(os.path.join(target, 'boot', 'vmlinuz-%s' % KERNEL))
+    write_file(os.path.join(target, 'boot', 'initramfs-%s.img' % KERNEL))
+    if scenario.os_name == 'centos6':
+        write_file(os.path.join(target, 'boot', 'grub', 'grub.conf'))
+        return
+    write_file(os.path.join(target, 'etc', 'default', 'grub'), GRUB_DEFAULT)
+    write_file(os.path.join(target, 'boot', 'grub2', 'grub.cfg'))
+    if scenario.uefi:
+        for path in EFI_FILES:
+            write_file(os.path.join(target, 'boot', 'efi', path), path)
+    modules_path = os.path.join(target, 'lib', 'modules', KERNEL)
+    write_file(
+        os.path.join(modules_path, 'modules.dep'),
+        'kernel/drivers/block/virtio_blk.ko.xz:\n'
+        'kernel/drivers/net/virtio_net.ko.xz:\n')
+    if scenario.prebuilt:
+        initramfs = os.path.join(target, 'boot', 'initramfs-%s.img' % KERNEL)
+        write_file(
+            os.path.join(target, 'curtin', 'initramfs.json'),
+            json.dumps({
+                'drivers': ['virtio_blk', 'virtio_net'],
+                'kernels': {KERNEL: {'size': os.path.getsize(initramfs)}},
+                }))
+        template_dir = os.path.join(target, 'curtin', 'grub')
+        write_file(
+            os.path.join(template_dir, 'default-grub'),
+            GRUB_DEFAULT + 'GRUB_CMDLINE_LINUX="@MAAS_KERNEL_PARAMS@"\n')
+        write_file(
+            os.path.join(template_dir, 'grub.cfg'),
+            GRUB_CFG_TEMPLATE.format(kernel=KERNEL))
+        write_file(
+            os.path.join(template_dir, 'kernels'), 'vmlinuz-%s\n' % KERNEL)
+        write_file(
+            os.path.join(template_dir, 'platform'),
+            'efi\n' if scenario.uefi else 'bios\n')
+
+
+def prepare_uefi_partition(mounts, target, scenario):
+    """Fills the UEFI partition of the node.
+
+    The partition holds a stale tree from a previous installation, unless
+    curtin mounted it on /boot/efi before extracting the image onto it.
+    """
+    efi_path = os.path.join(target, 'boot', 'efi')
+    device_path = mounts.get_device_path(UEFI_DEVICE)
+    if scenario.firmware == 'uefi-mounted':
+        mounts.move_contents(efi_path, device_path)
+        mounts.mount(UEFI_DEVICE, efi_path)
+    else:
+        write_file(os.path.join(device_path, STALE_EFI_FILE))
+
+
+def check_uefi_partition(fake, target, scenario):
+    """Returns the problems with the EFI installation in the target.
+
+    The EFI tree of the image must be on the UEFI partition, copied
+    through the staging directory with a single mount of the partition,
+    or left in place without mounting when curtin already mounted it.
+    """
+    problems = []
+    mounts = fake.mounts
+    efi_path = os.path.join(target, 'boot', 'efi')
+    expected_mounts = []
+    expected_calls = 1
+    if scenario.firmware == 'uefi-mounted':
+        expected_mounts.append(efi_path)
+        expected_calls = 0
+    if sorted(mounts.mounts) != expected_mounts:
+        problems.append(
+            'mounted after the hook: %s' % ', '.join(sorted(mounts.mounts)))
+    counts = fake.get_command_counts()
+    for command in ('mount', 'umount'):
+        if counts[command] != expected_calls:
+            problems.append(
+                '%s run %d times, expected %d' % (
+                    command, counts[command], expected_calls))
+    if mounts.is_mounted(efi_path):
+        partition = efi_path
+    else:
+        partition = mounts.get_device_path(UEFI_DEVICE)
+    for path in EFI_FILES:
+        try:
+            with open(os.path.join(partition, path), 'r') as stream:
+                data = stream.read()
+        except FileNotFoundError:
+            problems.append('%s missing from the UEFI partition' % path)
+        else:
+            if data != path:
+                problems.append(
+                    '%s differs from the image on the UEFI partition' % path)
+    if os.path.exists(os.path.join(partition, STALE_EFI_FILE)):
+        problems.append('stale EFI tree left on the UEFI partition')
+    for path in SCRATCH_PATHS:
+        if os.path.lexists(os.path.join(target, path)):
+            problems.append('scratch data left in the target: %s' % path)
+    return problems
+
+
+def make_windows_target(target):
+    """Creates a synthetic Windows root filesystem."""
+    cloudbase_init = os.path.join(
+        target, 'Program Files', 'Cloudbase Solutions', 'Cloudbase-Init')
+    write_file(os.path.join(cloudbase_init, 'conf', 'cloudbase-init.conf'))
+    write_file(os.path.join(
+        cloudbase_init, 'conf', 'cloudbase-init-unattend.conf'))
+    os.makedirs(os.path.join(cloudbase_init, 'LocalScripts'))
+
+
+class FunctionProfile:
+    """Latency of the functions of the hook modules."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.elapsed = Counter()
+        self.lock = threading.Lock()
+
+    def wrap(self, name, func):
+        """Returns func, recording its latency under name."""
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.calls[name] += 1
+                    self.elapsed[name] += elapsed
+        return wrapper
+
+    def instrument(self, module, prefix=''):
+        """Replaces the functions defined in the module with wrappers."""
+        for name, value in list(vars(module).items()):
+            if (isinstance(value, types.FunctionType) and
+                    value.__module__ == module.__name__):
+                setattr(module, name, self.wrap(prefix + name, value))
+
+
+def load_hook(path, name):
+    """Loads the hook script at path as a module called name.
+
+    The hook directory is put first on sys.path while loading, so the
+    hook imports the finalize module next to it.
+    """
+    hook_dir = os.path.dirname(path)
+    sys.modules.pop('finalize', None)
+    sys.path.insert(0, hook_dir)
+    try:
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        sys.path.remove(hook_dir)
+        sys.modules.pop('finalize', None)
+
+
+class ScenarioResult:
+    """Measurements of all the runs of one scenario."""
+
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.runs = 0
+        self.failures = []
+        self.wall = []
+        self.commands = Counter()
+        self.profile = FunctionProfile()
+
+    def to_dict(self):
+        """Returns the result as a JSON-serializable dictionary."""
+        runs = max(self.runs, 1)
+        return {
+            'scenario': self.scenario.name,
+            'hook': os.path.join(self.scenario.hook_dir, self.scenario.hook),
+            'runs': self.runs,
+            'failures': len(self.failures),
+            'mean_ms': 1000 * sum(self.wall) / runs,
+            'min_ms': 1000 * min(self.wall) if self.wall else 0,
+            'commands_per_run': sum(self.commands.values()) / runs,
+            'commands': {
+                command: count / runs
+                for command, count in sorted(self.commands.items())
+                },
+            'functions': {
+                name: {
+                    'calls_per_run': self.profile.calls[name] / runs,
+                    'mean_ms': (
+                        1000 * self.profile.elapsed[name] /
+                        self.profile.calls[name]),
+                    'total_ms_per_run': (
+                        1000 * self.profile.elapsed[name] / runs),
+                    }
+                for name in self.profile.calls
+                },
+            }
+
+
+def run_scenario(contrib_dir, scenario, iterations, verbose=False):
+    """Runs the hook of the scenario iterations times, each time against
+    a fresh synthetic target."""
+    result = ScenarioResult(scenario)
+    hook_path = os.path.join(contrib_dir, scenario.hook_dir, scenario.hook)
+    module_name = 'hookbench_%s' % scenario.name.replace('-', '_')
+    for _ in range(iterations):
+        with tempfile.TemporaryDirectory(prefix='hookbench-') as root:
+            target = os.path.join(root, 'target')
+            host = os.path.join(root, 'host')
+            lsblock = make_host(host, target, scenario)
+            mounts = FakeMounts(os.path.join(root, 'mounts'))
+            if scenario.os_name == 'windows':
+                make_windows_target(target)
+            else:
+                make_linux_target(target, scenario)
+            if scenario.uefi:
+                prepare_uefi_partition(mounts, target, scenario)
+            fstab = os.path.join(root, 'fstab')
+            write_file(fstab, 'UUID=%s / ext4 defaults 0 0\n' % ROOT_UUID)
+            config = os.path.join(root, 'config.json')
+            write_file(config, json.dumps(CURTIN_CONFIG))
+            fake = FakeCurtin(
+                lsblock,
+                {'target': target, 'fstab': fstab, 'config': config},
+                uefi=scenario.uefi,
+                responses={('grub', '--batch'): (GRUB_FIND_OUTPUT, '')},
+                mounts=mounts)
+            output = io.StringIO()
+            with fake.installed():
+                module = load_hook(hook_path, module_name)
+                for name, path in (
+                        ('PROC_CMDLINE', ('proc', 'cmdline')),
+                        ('PROC_MOUNTS', ('proc', 'mounts')),
+                        ('SYS_CLASS_BLOCK', ('sys', 'class', 'block')),
+                        ('SYS_CLASS_NET', ('sys', 'class', 'net'))):
+                    if hasattr(module, name):
+                        setattr(module, name, os.path.join(host, *path))
+                finalize = getattr(module, 'finalize', None)
+                if isinstance(finalize, types.ModuleType):
+                    result.profile.instrument(finalize, 'finalize.')
+                result.profile.instrument(module)
+                start = time.perf_counter()
+                try:
+                    with contextlib.redirect_stdout(output):
+                        module.main()
+                except SystemExit as error:
+                    if error.code:
+                        result.failures.append(
+                            'exited with %s\n%s' % (
+                                error.code, output.getvalue()))
+                except Exception:
+                    result.failures.append(
+                        traceback.format_exc() + output.getvalue())
+                else:
+                    if scenario.uefi:
+                        problems = check_uefi_partition(
+                            fake, target, scenario)
+                        if problems:
+                            result.failures.append('\n'.join(problems))
+                result.wall.append(time.perf_counter() - start)
+                sys.modules.pop(module_name, None)
+            if verbose:
+                sys.stderr.write(output.getvalue())
+            result.runs += 1
+            result.commands.update(fake.get_command_counts())
+    return result
+
+
+def format_result(result):
+    """Returns the human readable report of a scenario."""
+    data = result.to_dict()
+    lines = [
+        '%s (%s): %d runs, %d failed, %.2f ms mean, %.2f ms min' % (
+            data['scenario'], data['hook'], data['runs'], data['failures'],
+            data['mean_ms'], data['min_ms']),
+        '  %-44s %10s %10s %12s' % (
+            'function', 'calls/run', 'mean ms', 'total ms/run'),
+        ]
+    functions = sorted(
+        data['functions'].items(),
+        key=lambda item: item[1]['total_ms_per_run'], reverse=True)
+    for name, function in functions:
+        lines.append('  %-44s %10.1f %10.3f %12.3f' % (
+            name, function['calls_per_run'], function['mean_ms'],
+            function['total_ms_per_run']))
+    lines.append('  external commands per run: %.1f' % (
+        data['commands_per_run']))
+    for command, count in data['commands'].items():
+        lines.append('    %-42s %10.1f' % (command, count))
+    return '\n'.join(lines)
+
+
+def parse_args(args=None):
+    """Parses the command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the contrib curtin hooks offline.")
+    parser.add_argument(
+        '--contrib', default=get_default_contrib_dir(),
+        help="Path to the contrib directory. (Default: %(default)s)")
+    parser.add_argument(
+        '--iterations', type=int, default=10,
+        help="Runs of each hook. (Default: 10)")
+    parser.add_argument(
+        '--scenario', action='append', dest='scenarios',
+        choices=[scenario.name for scenario in SCENARIOS],
+        help="Scenario to run, can be repeated. (Default: all)")
+    parser.add_argument(
+        '--json', action='store_true',
+        help="Output the results as JSON.")
+    parser.add_argument(
+        '--verbose', action='store_true',
+        help="Show the output of the hooks.")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    """Runs the benchmark, returns the exit code."""
+    params = parse_args(args)
+    scenarios = [
+        scenario
+        for scenario in SCENARIOS
+        if not params.scenarios or scenario.name in params.scenarios
+        ]
+    results = [
+        run_scenario(
+            params.contrib, scenario, params.iterations,
+            verbose=params.verbose)
+        for scenario in scenarios
+        ]
+    if params.json:
+        print(json.dumps(
+            [result.to_dict() for result in results], indent=2,
+            sort_keys=True))
+    else:
+        print('\n\n'.join(format_result(result) for result in results))
+    failed = False
+    for result in results:
+        for failure in result.failures[:1]:
+            failed = True
+            sys.stderr.write(
+                '%s failed:\n%s\n' % (result.scenario.name, failure))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Replay of recorded installer console logs through the progress parser.
+
+Every log in the `consolelogs` directory has a JSON file next to it with
+the `ProgressEvent`s expected from it, replayed once without timing
+history and once with the history stored in that file, so changes to
+the stage, N-of-M and ETA parsing show up as differences. Exits non-zero
+when a log does not give the expected events.
+
+    python3 -m mib.testing.progressreplay
+
+After an intended change to the parser, or when adding a log, the
+expected events are rewritten with --update.
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+
+from mib import progress
+
+LOGS_DIR = os.path.join(os.path.dirname(__file__), 'consolelogs')
+
+
+def get_expected_path(log_path):
+    """Returns the path of the expected events of the log."""
+    return os.path.splitext(log_path)[0] + '.json'
+
+
+def get_events(log_path, history=None):
+    """Returns the events of the log as lists of their fields, without the
+    elapsed time. The ETA is rounded, so float noise does not count as a
+    difference."""
+    return [
+        [event.stage, event.current, event.total, event.message,
+         None if event.eta is None else round(event.eta, 2)]
+        for event in progress.replay(log_path, history=history)
+        ]
+
+
+def replay_log(log_path, history):
+    """Returns the events of the log by replay: without history, and with
+    history when there is one."""
+    replays = {'without-history': get_events(log_path)}
+    if history is not None:
+        replays['with-history'] = get_events(log_path, history=history)
+    return replays
+
+
+def check_stages(events, stages):
+    """Returns the problems with the order of the stages of the events."""
+    seen = []
+    for stage, _, _, _, _ in events:
+        if not seen or seen[-1] != stage:
+            seen.append(stage)
+    if seen != stages:
+        return ['stages %s, expected %s' % (
+            ', '.join(seen), ', '.join(stages))]
+    return []
+
+
+def compare_events(name, expected, actual):
+    """Returns the differences between the expected and actual events."""
+    problems = []
+    for index, (want, got) in enumerate(zip(expected, actual)):
+        if want != got:
+            problems.append(
+                '%s event %d: expected %s, got %s' % (
+                    name, index, json.dumps(want), json.dumps(got)))
+    if len(expected) != len(actual):
+        problems.append(
+            '%s: expected %d events, got %d' % (
+                name, len(expected), len(actual)))
+    return problems
+
+
+def check_log(log_path):
+    """Returns the problems with the events of the log."""
+    with open(get_expected_path(log_path), 'r') as stream:
+        expected = json.load(stream)
+    replays = replay_log(log_path, expected['history'])
+    problems = []
+    for name, events in sorted(replays.items()):
+        problems.extend(check_stages(events, expected['stages']))
+        problems.extend(
+            compare_events(name, expected['events'].get(name, []), events))
+    return problems
+
+
+def format_expected(expected):
+    """Returns the JSON of the expected events, one event per line."""
+    replays = []
+    for name, events in sorted(expected['events'].items()):
+        replays.append('    %s: [\n%s\n    ]' % (
+            json.dumps(name),
+            ',\n'.join('      %s' % json.dumps(event) for event in events)))
+    return (
+        '{\n'
+        '  "history": %s,\n'
+        '  "stages": %s,\n'
+        '  "events": {\n%s\n  }\n'
+        '}\n' % (
+            json.dumps(expected['history'], sort_keys=True),
+            json.dumps(expected['stages']),
+            ',\n'.join(replays)))
+
+
+def update_log(log_path):
+    """Rewrites the expected events of the log from the parser, keeping
+    its history."""
+    expected_path = get_expected_path(log_path)
+    history = None
+    if os.path.exists(expected_path):
+        with open(expected_path, 'r') as stream:
+            history = json.load(stream)['history']
+    replays = replay_log(log_path, history)
+    stages = []
+    for stage, _, _, _, _ in replays['without-history']:
+        if not stages or stages[-1] != stage:
+            stages.append(stage)
+    with open(expected_path, 'w') as stream:
+        stream.write(format_expected(
+            {'history': history, 'stages': stages, 'events': replays}))
+
+
+def parse_args(args=None):
+    """Returns the parsed command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Replay recorded installer console logs.")
+    parser.add_argument(
+        '--logs', default=LOGS_DIR,
+        help="Directory of the console logs. (Default: %(default)s)")
+    parser.add_argument(
+        '--update', action='store_true',
+        help="Rewrite the expected events from the parser.")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    """Replays the logs, returns the exit code."""
+    params = parse_args(args)
+    failed = False
+    for log_path in sorted(glob.glob(os.path.join(params.logs, '*.log'))):
+        name = os.path.basename(log_path)
+        if params.update:
+            update_log(log_path)
+            print('%s: updated' % name)
+            continue
+        problems = check_log(log_path)
+        if problems:
+            failed = True
+            sys.stderr.write('%s failed:\n%s\n' % (name, '\n'.join(problems)))
+        else:
+            print('%s: ok' % name)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Startup benchmark of the maas-image-builder command line.
+
+Runs the command line in a new interpreter repeatedly, the way the
+daemon and wrappers do, and reports how long it takes to get through
+argument parsing and how many modules are imported on the way. The
+`eager` scenario loads every builder through the entry points the way
+the command line used to, for comparison.
+
+    python3 -m mib.testing.startupbench --iterations 20
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+
+class Scenario(namedtuple('Scenario', ['name', 'args', 'script'])):
+    """Command line arguments given to `mib.core`, or a script run
+    instead of it when script is set."""
+
+    def get_script(self):
+        """Returns the Python code running the scenario."""
+        if self.script is not None:
+            return self.script
+        return RUN_CORE % (self.args,)
+
+
+# Loads and instantiates every builder before parsing the arguments.
+EAGER_SCRIPT = """\
+import sys
+from stevedore.extension import ExtensionManager
+from mib.parser import load_parser
+manager = ExtensionManager("mib.builder", invoke_on_load=True)
+load_parser([extension.obj for extension in manager])
+sys.exit(0)
+"""
+
+RUN_CORE = """\
+import runpy, sys
+sys.argv = ['maas-image-builder'] + %r
+runpy.run_module('mib.core', run_name='__main__', alter_sys=True)
+"""
+
+# Prepended to the script of the scenario to list the modules it imported
+# when it exits.
+LIST_MODULES = """\
+import atexit, json, sys
+atexit.register(lambda: sys.stderr.write(
+    '\\nmodules: %s\\n' % json.dumps(sorted(sys.modules))))
+"""
+
+SCENARIOS = [
+    Scenario('help', ['--help'], None),
+    Scenario('centos-help', ['centos', '--help'], None),
+    Scenario('rhel-help', ['rhel', '--help'], None),
+    Scenario('windows-help', ['windows', '--help'], None),
+    Scenario('bench-boot-help', ['bench-boot', '--help'], None),
+    Scenario('eager', None, EAGER_SCRIPT),
+    ]
+
+
+def get_source_dir():
+    """Returns the directory holding the mib package being benchmarked."""
+    return os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+
+
+def run_once(scenario, env, list_modules=False):
+    """Runs the scenario once.
+
+    :return: Seconds it took, the exit code and its stderr.
+    """
+    script = scenario.get_script()
+    if list_modules:
+        script = LIST_MODULES + script
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, '-c', script], env=env, stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    return elapsed, process.returncode, process.stderr.decode(
+        'utf-8', 'replace')
+
+
+def get_modules(stderr):
+    """Returns the modules listed by `LIST_MODULES`."""
+    for line in stderr.splitlines():
+        if line.startswith('modules: '):
+            return json.loads(line[len('modules: '):])
+    return []
+
+
+def run_scenario(scenario, iterations):
+    """Runs the scenario iterations times, returning its result."""
+    env = dict(os.environ, PYTHONPATH=get_source_dir())
+    result = {
+        'name': scenario.name,
+        'runs': [],
+        'failure': None,
+        }
+    for _ in range(iterations):
+        elapsed, returncode, stderr = run_once(scenario, env)
+        if returncode != 0:
+            result['failure'] = stderr.strip().splitlines()[-1:]
+            return result
+        result['runs'].append(elapsed)
+    _, _, stderr = run_once(scenario, env, list_modules=True)
+    modules = get_modules(stderr)
+    result['modules'] = len(modules)
+    result['mib_modules'] = [
+        name for name in modules if name.split('.')[0] == 'mib']
+    runs = result.pop('runs')
+    result['mean_ms'] = round(sum(runs) / len(runs) * 1000, 1)
+    result['min_ms'] = round(min(runs) * 1000, 1)
+    result['max_ms'] = round(max(runs) * 1000, 1)
+    return result
+
+
+def format_result(result):
+    """Returns the human readable report of a scenario."""
+    if result['failure'] is not None:
+        return '%-16s failed: %s' % (
+            result['name'], ' '.join(result['failure']))
+    return '%-16s %8.1f ms mean %8.1f ms min %6d modules (%s)' % (
+        result['name'], result['mean_ms'], result['min_ms'],
+        result['modules'], ', '.join(result['mib_modules']))
+
+
+def parse_args(args=None):
+    """Parses the command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the startup of the command line.")
+    parser.add_argument(
+        '--iterations', type=int, default=10,
+        help="Runs of each scenario. (Default: 10)")
+    parser.add_argument(
+        '--scenario', action='append', dest='scenarios',
+        choices=[scenario.name for scenario in SCENARIOS],
+        help="Scenario to run, can be repeated. (Default: all)")
+    parser.add_argument(
+        '--json', action='store_true',
+        help="Output the results as JSON.")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    """Runs the benchmark, returns the exit code."""
+    params = parse_args(args)
+    results = [
+        run_scenario(scenario, params.iterations)
+        for scenario in SCENARIOS
+        if not params.scenarios or scenario.name in params.scenarios
+        ]
+    if params.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print('\n'.join(format_result(result) for result in results))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
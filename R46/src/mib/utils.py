@@ -42,13 +42,18 @@
 
 """Utilities."""
 
+import hashlib
+import json
 import os
 import subprocess
 import sys
 import tempfile
 from contextlib import contextmanager
+from functools import partial
 from shutil import rmtree
 
+from mib import loop
+
 
 def get_contrib_dir():
     """Return path to the contrib directory."""
@@ -64,6 +69,37 @@ def get_contrib_path(name, path):
     return os.path.join(get_contrib_dir(), name, path)
 
 
+def get_cache_dir():
+    """Return path to the directory holding data reused between builds."""
+    return "/var/lib/maas-image-builder/cache"
+
+
+def get_cache_path(*paths):
+    """Return the full path of the file in the cache directory, creating
+    the directory that holds it."""
+    path = os.path.join(get_cache_dir(), *paths)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def digest_tree(path):
+    """Return a sha256 hex digest covering the names and contents of every
+    file under path."""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for filename in sorted(files):
+            file_path = os.path.join(root, filename)
+            digest.update((
+                '%s\0%d\0' % (
+                    os.path.relpath(file_path, path),
+                    os.path.getsize(file_path))).encode('utf-8'))
+            with open(file_path, 'rb') as stream:
+                for chunk in iter(partial(stream.read, 1024 * 1024), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
 def get_sudo_user():
     """Gets the name of the user, that launched sudo."""
     if 'SUDO_USER' not in os.environ:
@@ -190,43 +226,111 @@ def tempdir(
         rmtree(path, ignore_errors=True)
 
 
-def kpartx_add(src):
-    """Adds partition mappings for src into kpartx."""
-    subp(['kpartx', '-s', '-a', src])
-
-
-def kpartx_list(src):
-    """Lists the partition mappins for src in kpartx."""
-    out, _ = subp(['kpartx', '-l', src], capture=True)
-    return [
-        '/dev/mapper/%s' % line.split()[0]
-        for line in out.splitlines()
-        ]
-
+@contextmanager
+def chroot(root):
+    """Context manager: bind mounts /dev, /proc and /sys into root.
 
-def kpartx_del(src):
-    """Removes partition mappings for src from kpartx."""
-    subp(['kpartx', '-d', src])
+    Yields a function that runs a command chrooted into root, taking the
+    same arguments as `subp`.
+    """
+    mounted = []
+    try:
+        for path in ('/dev', '/proc', '/sys'):
+            target = os.path.join(root, path.lstrip('/'))
+            subp(['mount', '--bind', path, target])
+            mounted.append(target)
+        yield lambda args, **kwargs: subp(['chroot', root] + args, **kwargs)
+    finally:
+        for target in reversed(mounted):
+            subp(['umount', target])
 
 
 def mount_loop(src, target, idx=0):
-    """Mounts the source using loopback onto the target."""
-    kpartx_add(src)
-    devs = kpartx_list(src)
-    subp(['mount', '-o', 'loop', devs[idx], target])
+    """Mounts the partition at index idx of the disk image src onto the
+    target, attaching src to a loop device."""
+    device = loop.attach(src)
+    try:
+        subp(['mount', device.get_partition(idx + 1), target])
+    except (loop.LoopError, ProcessExecutionError):
+        loop.detach(src)
+        raise
 
 
 def umount_loop(src, target):
-    """Un-mounts the source using loopback."""
-    subp(['umount', target])
-    kpartx_del(src)
+    """Un-mounts the target and detaches src from its loop device."""
+    try:
+        subp(['umount', target])
+    finally:
+        loop.detach(src)
+
+
+def get_selinux_file_contexts(root):
+    """Return the path under root of the SELinux file contexts used by the
+    system at root, or None when SELinux is disabled there."""
+    config_path = os.path.join(root, 'etc', 'selinux', 'config')
+    if not os.path.exists(config_path):
+        return None
+    settings = {}
+    with open(config_path, 'r') as stream:
+        for line in stream:
+            line = line.strip()
+            if '=' in line and not line.startswith('#'):
+                key, value = line.split('=', 1)
+                settings[key.strip()] = value.strip()
+    if settings.get('SELINUX') == 'disabled':
+        return None
+    return os.path.join(
+        '/etc', 'selinux', settings.get('SELINUXTYPE', 'targeted'),
+        'contexts', 'files', 'file_contexts')
+
+
+def selinux_relabel(root):
+    """Labels every file under root using the file contexts of the system
+    at root. Returns False when SELinux is disabled there."""
+    file_contexts = get_selinux_file_contexts(root)
+    if file_contexts is None:
+        return False
+    subp([
+        'setfiles', '-F',
+        '-r', root,
+        os.path.join(root, file_contexts.lstrip('/')),
+        root,
+        ])
+    return True
 
 
-def fs_sync():
-    """Synchronize cached writes to persistent storage."""
-    subp(['sync'])
+def create_tarball(output, path):
+    """Creates a tarball from path and places into output, keeping the
+    SELinux labels and extended attributes."""
+    subp([
+        'tar', '--selinux', '--xattrs', '--xattrs-include=*',
+        '-zcpf', output, '-C', path, '.',
+        ])
 
 
-def create_tarball(output, path):
-    """Creates a tarball from path and places into output."""
-    subp(['tar', 'zcpf', output, '-C', path, '.'])
+def get_manifest_path(output):
+    """Returns the path of the manifest written next to the image at
+    output."""
+    return '%s.manifest.json' % output
+
+
+def read_manifest(output):
+    """Returns the manifest of the image at output, or an empty dict when
+    it has none."""
+    try:
+        with open(get_manifest_path(output), 'r') as stream:
+            return json.load(stream)
+    except (IOError, OSError):
+        return {}
+
+
+def update_manifest(output, values):
+    """Merges values into the manifest of the image at output."""
+    manifest = read_manifest(output)
+    manifest.update(values)
+    manifest_path = get_manifest_path(output)
+    tmp_path = '%s.tmp' % manifest_path
+    with open(tmp_path, 'w') as stream:
+        json.dump(manifest, stream, indent=4, sort_keys=True)
+        stream.write('\n')
+    os.rename(tmp_path, manifest_path)
@@ -42,8 +42,6 @@
 
 """Utilities for virt."""
 
-import subprocess
-
 from mib import utils
 
 # QEMU Architecture Mapping
@@ -63,68 +61,13 @@ def create_disk(path, size, disk_format='qcow2'):
     utils.subp(args)
 
 
-def install_location(name, ram, arch, vcpus, os_type, os_variant,
-                     disk, network, location, initrd_inject=None,
-                     extra_args=None, reboot=False, graphics=False,
-                     force=True):
-    """Spawns virt-install."""
-    if arch in ARCH_MAP:
-        arch = ARCH_MAP[arch]
-    args = [
-        'virt-install',
-        '--name', name,
-        '--ram', '%s' % ram,
-        '--arch', arch,
-        '--vcpus', vcpus,
-        '--os-type', os_type,
-        '--os-variant', os_variant,
-        '--disk', disk,
-        '--network', network,
-        '--location', location,
-        ]
-    if initrd_inject is not None:
-        args.append('--initrd-inject=%s' % initrd_inject)
-    if extra_args is not None:
-        args.append("--extra-args=%s" % extra_args)
-    if not reboot:
-        args.append('--noreboot')
-    if not graphics:
-        args.append('--nographics')
-    if force:
-        args.append('--force')
-    subprocess.check_call(args)
-
-
-def install_cdrom(
-        name, ram, arch, vcpus, os_type, os_variant,
-        disk, network, cdrom, reboot=False, graphics=False,
-        force=True):
-    """Spawns virt-install."""
-    if arch in ARCH_MAP:
-        arch = ARCH_MAP[arch]
-    args = [
-        'virt-install',
-        '--name', name,
-        '--ram', '%s' % ram,
-        '--arch', arch,
-        '--vcpus', vcpus,
-        '--os-type', os_type,
-        '--os-variant', os_variant,
-        '--disk', disk,
-        '--network', network,
-        '--cdrom', cdrom,
-        ]
-    if not reboot:
-        args.append('--noreboot')
-    if not graphics:
-        args.append('--nographics')
-    if force:
-        args.append('--force')
-    subprocess.check_call(args)
-
-
 def undefine(name):
     """Undefines the virtual machine from virsh without deleting
     the storage volume.
     """
     utils.subp(['virsh', 'undefine', name])
+
+
+def destroy(name):
+    """Forcefully stops the running virtual machine."""
+    utils.subp(['virsh', 'destroy', name])
@@ -0,0 +1,1047 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Virtual machines running the installations.
+
+A `Machine` describes the virtual machine of an installation. A backend
+runs it with virt-install, qemu or the libvirt API, so every builder can
+use any of them. The devices come from a shared `DeviceProfile`.
+"""
+
+import os
+import shutil
+import subprocess
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from xml.etree import ElementTree
+
+from mib import net, qmp, utils, virt
+
+DeviceProfile = namedtuple(
+    'DeviceProfile', ['disk_bus', 'cdrom_bus', 'nic_model', 'video'])
+
+PROFILES = {
+    'virtio': DeviceProfile('virtio', 'ide', 'virtio', 'std'),
+    'legacy': DeviceProfile('ide', 'ide', 'rtl8139', 'std'),
+    }
+
+# Cache modes of the disks, None keeps the default of the hypervisor.
+CACHE_MODES = ['none', 'writeback', 'writethrough', 'directsync', 'unsafe']
+
+# A disk of the machine. device is 'disk', 'cdrom' or 'floppy'; index is
+# its position on the bus, or None to use the next free one.
+Disk = namedtuple('Disk', ['path', 'device', 'index'])
+
+# Network of the machine. type is one of NETWORK_MODES; source is the
+# bridge, or None for the user-mode networks.
+Network = namedtuple('Network', ['type', 'source', 'mac'])
+
+# 'user' and 'passt' give the guest user-mode networking, without a bridge
+# or tap device on the host. passt needs the qemu backend.
+NETWORK_MODES = ['bridge', 'user', 'passt']
+
+# Address of the guest in the user-mode networks.
+USER_ADDRESS = '10.0.2.15'
+
+# cpu_quota is in percent of one CPU; iops limits the I/O of each disk.
+Limits = namedtuple('Limits', ['cpu_quota', 'iops'])
+
+NO_LIMITS = Limits(None, None)
+
+# Watching of a machine through its QMP monitor, with the qemu backend.
+# A screendump is saved into directory every interval seconds, and the
+# machine is powered off when the guest runs longer than phase_timeout
+# seconds without rebooting; None waits forever.
+Monitor = namedtuple('Monitor', ['directory', 'interval', 'phase_timeout'])
+
+# Run states of the guest in which it will not make any progress.
+FAILED_STATES = ['guest-panicked', 'internal-error', 'io-error']
+
+# Seconds the guest is given to power off before it is killed.
+POWERDOWN_TIMEOUT = 120
+
+# Kernel and initrd of an installation tree.
+BOOT_FILES = [
+    ('kernel', 'images/pxeboot/vmlinuz'),
+    ('initrd', 'images/pxeboot/initrd.img'),
+    ]
+
+
+class VMError(Exception):
+    """Raised when a virtual machine cannot be run."""
+
+
+class Machine:
+    """Virtual machine of an installation.
+
+    :param boot: 'location' to boot the kernel of the installation tree
+        or ISO at location, or 'cdrom' to boot the first cdrom.
+    :param reboot: the guest reboots during the installation, which only
+        ends when it powers off. Otherwise it ends on the first reboot.
+    :param timeout: seconds after which the machine is destroyed, None to
+        wait forever.
+    :param monitor: a `Monitor` watching the machine, or None.
+    :param status_log: file receiving the second serial port of the
+        guest, on which it reports its progress, or None.
+    """
+
+    def __init__(
+            self, name, arch, ram, vcpus, disks, network=None,
+            boot='cdrom', location=None, initrd_inject=None,
+            extra_args=None, os_type=None, os_variant=None,
+            console_log=None, profile='virtio', cache=None,
+            limits=NO_LIMITS, graphics=False, reboot=False, timeout=None,
+            monitor=None, status_log=None):
+        self.name = name
+        self.arch = virt.ARCH_MAP.get(arch, arch)
+        self.ram = ram
+        self.vcpus = vcpus
+        self.disks = disks
+        self.network = network
+        self.boot = boot
+        self.location = location
+        self.initrd_inject = initrd_inject
+        self.extra_args = extra_args
+        self.os_type = os_type
+        self.os_variant = os_variant
+        self.console_log = console_log
+        self.profile = PROFILES[profile]
+        self.cache = cache
+        self.limits = limits
+        self.graphics = graphics
+        self.reboot = reboot
+        self.timeout = timeout
+        self.monitor = monitor
+        self.status_log = status_log
+
+    def get_boot_order(self, disk):
+        """Returns the boot order of disk, or None when it is not booted
+        from. The first cdrom boots the installation, the first disk the
+        installed system."""
+        if self.boot != 'cdrom':
+            return None
+        for order, device in enumerate(['cdrom', 'disk'], 1):
+            first = [other for other in self.disks if other.device == device]
+            if first and first[0] is disk:
+                return order
+        return None
+
+    def get_bus(self, disk):
+        """Returns the bus of disk."""
+        if disk.device == 'floppy':
+            return 'fdc'
+        if disk.device == 'cdrom':
+            return self.profile.cdrom_bus
+        return self.profile.disk_bus
+
+
+def is_iso(location):
+    """Returns True when location is an ISO rather than a tree."""
+    return location.endswith('.iso')
+
+
+def is_url(location):
+    """Returns True when location is remote."""
+    return location.split(':', 1)[0] in ('http', 'https', 'ftp')
+
+
+def fetch(url, path):
+    """Downloads url to path."""
+    utils.subp(['wget', '-q', '-O', path, url])
+
+
+def get_location_iso(location):
+    """Returns the local path of the ISO at location, downloading it into
+    the cache when it is remote."""
+    if not is_url(location):
+        return location
+    path = utils.get_cache_path('isos', os.path.basename(location))
+    if not os.path.exists(path):
+        # Builds of the same location can download it at the same time.
+        tmp_path = '%s.%d.part' % (path, os.getpid())
+        try:
+            fetch(location, tmp_path)
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+    return path
+
+
+def append_initrd(initrd, path):
+    """Appends the file at path to the root of initrd, as virt-install
+    does with --initrd-inject."""
+    with open(initrd, 'ab') as stream:
+        process = subprocess.Popen(
+            ['cpio', '--quiet', '-o', '-H', 'newc'],
+            cwd=os.path.dirname(path), stdin=subprocess.PIPE, stdout=stream)
+        process.communicate(os.path.basename(path).encode('utf-8') + b'\n')
+    if process.returncode != 0:
+        raise VMError("Failed to add %s to the initrd." % path)
+
+
+def prepare_location(machine, workdir):
+    """Fetches the kernel and initrd of the installation at the location
+    of machine into workdir.
+
+    :return: The kernel, initrd, kernel command line and the ISO to
+        attach, or None when the location is a tree.
+    """
+    paths = {}
+    iso = None
+    repo = machine.location
+    if is_iso(machine.location):
+        iso = get_location_iso(machine.location)
+        repo = 'cdrom'
+        for name, path in BOOT_FILES:
+            paths[name] = os.path.join(workdir, os.path.basename(path))
+            with open(paths[name], 'wb') as stream:
+                subprocess.check_call(
+                    ['isoinfo', '-R', '-i', iso, '-x', '/' + path],
+                    stdout=stream)
+    else:
+        for name, path in BOOT_FILES:
+            paths[name] = os.path.join(workdir, os.path.basename(path))
+            source = '%s/%s' % (machine.location.rstrip('/'), path)
+            if is_url(machine.location):
+                fetch(source, paths[name])
+            else:
+                shutil.copyfile(source, paths[name])
+    if machine.initrd_inject is not None:
+        append_initrd(paths['initrd'], machine.initrd_inject)
+    cmdline = 'repo=%s' % repo
+    if machine.extra_args:
+        cmdline = '%s %s' % (machine.extra_args, cmdline)
+    return paths['kernel'], paths['initrd'], cmdline, iso
+
+
+class Backend:
+    """Runs virtual machines."""
+
+    name = None
+
+    # Whether the machines can be watched through a `Monitor`.
+    monitored = False
+
+    # Network types the backend can give to the machines.
+    network_types = ['bridge', 'user']
+
+    def check(self, machine):
+        """Raises `VMError` when machine cannot be run by this backend."""
+        if machine.monitor is not None and not self.monitored:
+            raise VMError("Monitoring needs the qemu backend.")
+        if machine.network is not None and (
+                machine.network.type not in self.network_types):
+            raise VMError(
+                "%s networking is not supported by the %s backend." % (
+                    machine.network.type, self.name))
+
+    def run(self, machine):
+        """Runs machine until the installation is done.
+
+        :return: Statistics of the run; at least the seconds it took.
+        :raises subprocess.CalledProcessError: when the machine failed,
+            or was destroyed.
+        :raises VMError: when the machine did not finish before its
+            timeout.
+        """
+        raise NotImplementedError()
+
+    def destroy(self, machine):
+        """Forcefully stops the running machine. Called from another
+        thread than `run`."""
+        raise NotImplementedError()
+
+    def cleanup(self, machine):
+        """Removes what is left of the machine once it stopped."""
+
+    @contextmanager
+    def removing(self, machine):
+        """Context manager: removes machine when leaving the context.
+
+        The machine is destroyed first when an exception, such as the
+        build being interrupted, leaves the context; libvirt runs it
+        outside of this process, so it would otherwise keep running.
+        """
+        try:
+            yield
+        except BaseException:
+            try:
+                self.destroy(machine)
+            except (utils.ProcessExecutionError, VMError):
+                # Already stopped.
+                pass
+            raise
+        finally:
+            self.cleanup(machine)
+
+
+class VirtInstallBackend(Backend):
+    """Runs the machines with virt-install, defining them in libvirt."""
+
+    name = 'virt-install'
+
+    def check(self, machine):
+        super().check(machine)
+        if machine.limits != NO_LIMITS:
+            raise VMError(
+                "Resource limits need the qemu or libvirt backend.")
+
+    def get_disk_arg(self, machine, disk):  # pylint: disable=no-self-use
+        """Returns the --disk argument of disk."""
+        arg = 'path=%s,format=raw,device=%s,bus=%s' % (
+            disk.path, disk.device, machine.get_bus(disk))
+        if machine.cache is not None and disk.device == 'disk':
+            arg += ',cache=%s' % machine.cache
+        boot_order = machine.get_boot_order(disk)
+        if machine.reboot and boot_order is not None:
+            arg += ',boot_order=%d' % boot_order
+        return arg
+
+    def get_args(self, machine):
+        """Returns the virt-install command running machine."""
+        args = [
+            'virt-install',
+            '--name', machine.name,
+            '--ram', '%s' % machine.ram,
+            '--arch', machine.arch,
+            '--vcpus', '%s' % machine.vcpus,
+            ]
+        if machine.os_type is not None:
+            args.extend(['--os-type', machine.os_type])
+        if machine.os_variant is not None:
+            args.extend(['--os-variant', machine.os_variant])
+        disks = list(machine.disks)
+        if machine.boot == 'location':
+            args.extend(['--location', machine.location])
+            if machine.initrd_inject is not None:
+                args.append('--initrd-inject=%s' % machine.initrd_inject)
+            if machine.extra_args is not None:
+                args.append('--extra-args=%s' % machine.extra_args)
+        elif machine.reboot:
+            # Boot the cdrom on every reboot, as qemu does with -boot d.
+            args.append('--import')
+        else:
+            cdrom = [disk for disk in disks if disk.device == 'cdrom'][0]
+            disks.remove(cdrom)
+            args.extend(['--cdrom', cdrom.path])
+        for disk in disks:
+            args.extend(['--disk', self.get_disk_arg(machine, disk)])
+        if machine.network is None:
+            args.append('--network=none')
+        else:
+            network = '%s=%s,model=%s' % (
+                machine.network.type, machine.network.source,
+                machine.profile.nic_model)
+            if machine.network.type == 'user':
+                network = 'user,model=%s' % machine.profile.nic_model
+            if machine.network.mac is not None:
+                network += ',mac=%s' % machine.network.mac
+            args.extend(['--network', network])
+        # The console goes to the first serial port, ttyS0, and the status
+        # to the second one.
+        if machine.console_log is not None:
+            args.extend(['--serial', 'file,path=%s' % machine.console_log])
+        elif machine.status_log is not None:
+            args.extend(['--serial', 'pty'])
+        if machine.status_log is not None:
+            args.extend(['--serial', 'file,path=%s' % machine.status_log])
+        if not machine.reboot:
+            args.append('--noreboot')
+        if machine.graphics:
+            args.extend(['--graphics', 'vnc,listen=127.0.0.1'])
+        else:
+            args.append('--nographics')
+        args.extend(['--force', '--noautoconsole', '--wait', '-1'])
+        return args
+
+    def run(self, machine):
+        start = time.time()
+        args = self.get_args(machine)
+        process = subprocess.Popen(args)
+        try:
+            returncode = process.wait(machine.timeout)
+        except subprocess.TimeoutExpired:
+            self.destroy(machine)
+            process.wait()
+            raise timeout_error(machine)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args)
+        return {'seconds': round(time.time() - start, 3)}
+
+    def destroy(self, machine):  # pylint: disable=no-self-use
+        virt.destroy(machine.name)
+
+    def cleanup(self, machine):  # pylint: disable=no-self-use
+        virt.undefine(machine.name)
+
+
+class QemuBackend(Backend):
+    """Runs the machines with qemu directly, without libvirt.
+
+    Machines with a `Monitor` get a QMP socket, through which their run
+    state is polled and their screen saved while they run."""
+
+    name = 'qemu'
+    monitored = True
+    network_types = NETWORK_MODES
+
+    # Seconds between two polls of the QMP monitor.
+    poll_interval = 2
+
+    # Number of screendumps kept of each machine.
+    screendumps = 20
+
+    def __init__(self):
+        self.processes = {}
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def get_drive_args(self, machine, disk):  # pylint: disable=no-self-use
+        """Returns the -drive arguments of disk."""
+        drive = 'file=%s,format=raw,if=%s' % (
+            disk.path, 'floppy' if disk.device == 'floppy' else (
+                machine.get_bus(disk)))
+        if disk.index is not None:
+            drive += ',index=%d' % disk.index
+        if disk.device == 'cdrom':
+            drive += ',media=cdrom'
+        elif disk.device == 'disk':
+            drive += ',media=disk'
+            if machine.cache is not None:
+                drive += ',cache=%s' % machine.cache
+            if machine.limits.iops is not None:
+                drive += ',throttling.iops-total=%d' % machine.limits.iops
+        return ['-drive', drive]
+
+    def get_args(
+            self, machine, workdir, tap=None, qmp_path=None,
+            passt_path=None):
+        """Returns the qemu command running machine."""
+        args = []
+        if machine.limits.cpu_quota is not None:
+            args.extend([
+                'systemd-run', '--scope', '--quiet',
+                '-p', 'CPUQuota=%d%%' % machine.limits.cpu_quota,
+                ])
+        args.extend([
+            'qemu-system-%s' % machine.arch,
+            '-name', machine.name,
+            '-machine', 'accel=kvm:tcg',
+            '-m', '%s' % machine.ram,
+            '-smp', '%s' % machine.vcpus,
+            '-vga', machine.profile.video,
+            '-k', 'en-us',
+            ])
+        disks = list(machine.disks)
+        if machine.boot == 'location':
+            kernel, initrd, cmdline, iso = prepare_location(
+                machine, workdir)
+            args.extend([
+                '-kernel', kernel, '-initrd', initrd, '-append', cmdline])
+            if iso is not None:
+                disks.append(Disk(iso, 'cdrom', None))
+        else:
+            args.extend(['-boot', 'd'])
+        for disk in disks:
+            args.extend(self.get_drive_args(machine, disk))
+        if machine.network is None:
+            args.extend(['-net', 'none'])
+        else:
+            mac = machine.network.mac or net.get_random_qemu_mac()
+            if tap is not None:
+                netdev = 'tap,id=net0,script=no,downscript=no,ifname=%s' % (
+                    tap)
+            elif passt_path is not None:
+                netdev = (
+                    'stream,id=net0,server=off,addr.type=unix,'
+                    'addr.path=%s' % passt_path)
+            else:
+                netdev = 'user,id=net0'
+            args.extend([
+                '-netdev', netdev,
+                '-device', '%s,netdev=net0,mac=%s' % (
+                    qemu_nic_model(machine.profile.nic_model), mac),
+                ])
+        if machine.console_log is not None:
+            args.extend(['-serial', 'file:%s' % machine.console_log])
+        elif machine.status_log is not None:
+            # Keep the status on the second serial port.
+            args.extend(['-serial', 'vc' if machine.graphics else 'null'])
+        if machine.status_log is not None:
+            args.extend(['-serial', 'file:%s' % machine.status_log])
+        if machine.graphics:
+            args.extend(['-vnc', '127.0.0.1:0,to=99'])
+        else:
+            args.extend(['-display', 'none'])
+        if qmp_path is not None:
+            args.extend(['-qmp', 'unix:%s,server=on,wait=off' % qmp_path])
+        if not machine.reboot:
+            args.append('-no-reboot')
+        return args
+
+    def start_passt(self, path):  # pylint: disable=no-self-use
+        """Starts passt serving the network of one qemu on the socket at
+        path, with the addresses qemu uses for user-mode networking.
+
+        :return: The passt process, which exits with qemu.
+        """
+        args = [
+            'passt', '--foreground', '--one-off', '--quiet',
+            '--socket', path,
+            '--address', USER_ADDRESS, '--netmask', '24',
+            '--gateway', net.USER_GATEWAY,
+            ]
+        try:
+            process = subprocess.Popen(args)
+        except OSError as error:
+            raise VMError("Failed to start passt: %s" % error)
+        deadline = time.time() + 10
+        while not os.path.exists(path):
+            if process.poll() is not None or time.time() > deadline:
+                process.kill()
+                process.wait()
+                raise VMError("passt failed to listen on %s." % path)
+            time.sleep(0.1)
+        return process
+
+    def run(self, machine):
+        tap = None
+        if machine.network is not None and machine.network.type == 'bridge':
+            tap = net.create_tap(machine.network.source)
+        passt = None
+        try:
+            with utils.tempdir() as workdir:
+                qmp_path = None
+                if machine.monitor is not None:
+                    qmp_path = os.path.join(workdir, 'qmp.sock')
+                passt_path = None
+                if machine.network is not None and (
+                        machine.network.type == 'passt'):
+                    passt_path = os.path.join(workdir, 'passt.sock')
+                    passt = self.start_passt(passt_path)
+                args = self.get_args(
+                    machine, workdir, tap=tap, qmp_path=qmp_path,
+                    passt_path=passt_path)
+                with self.lock:
+                    process = subprocess.Popen(args)
+                    self.processes[machine.name] = process
+                start = time.time()
+                stats = {}
+                try:
+                    if qmp_path is not None:
+                        stats = self.watch(machine, process, qmp_path, start)
+                    process.wait(machine.timeout)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+                    raise timeout_error(machine)
+                finally:
+                    with self.lock:
+                        self.processes.pop(machine.name, None)
+                if process.returncode != 0:
+                    raise subprocess.CalledProcessError(
+                        process.returncode, args)
+                stats['seconds'] = round(time.time() - start, 3)
+                return stats
+        finally:
+            if passt is not None and passt.poll() is None:
+                passt.kill()
+                passt.wait()
+            if tap is not None:
+                net.delete_tap(tap)
+
+    def watch(self, machine, process, qmp_path, start):
+        """Follows machine through its QMP monitor until qemu exits.
+
+        The guest is powered off when it fails, or when it runs past the
+        timeout of the machine or the phase timeout of its monitor.
+
+        :return: The statistics of the run: the seconds between the
+            reboots of the guest and the number of screendumps.
+        """
+        monitor = machine.monitor
+        client = qmp.QMPClient(qmp_path)
+        with self.lock:
+            self.clients[machine.name] = client
+        phases = []
+        phase_start = start
+        screendumps = []
+        try:
+            client.connect(process=process)
+            while process.poll() is None:
+                now = time.time()
+                for event in client.get_events():
+                    if event['event'] == 'RESET':
+                        phases.append(round(now - phase_start, 3))
+                        phase_start = now
+                status = client.query_status()
+                if not screendumps or (
+                        now - screendumps[-1][0] >= monitor.interval):
+                    screendumps.append(
+                        (now, self.screendump(client, machine, now - start)))
+                    if len(screendumps) > self.screendumps:
+                        os.unlink(screendumps.pop(0)[1])
+                error = None
+                if status in FAILED_STATES:
+                    error = VMError(
+                        "%s stopped with state %s." % (machine.name, status))
+                elif machine.timeout is not None and (
+                        now - start > machine.timeout):
+                    error = timeout_error(machine)
+                elif monitor.phase_timeout is not None and (
+                        now - phase_start > monitor.phase_timeout):
+                    error = VMError(
+                        "%s did not reboot within %d seconds." % (
+                            machine.name, monitor.phase_timeout))
+                if error is not None:
+                    self.screendump(client, machine, now - start)
+                    self.powerdown(machine)
+                    raise error
+                try:
+                    process.wait(self.poll_interval)
+                except subprocess.TimeoutExpired:
+                    pass
+        except qmp.QMPError as error:
+            # qemu closes the monitor when it exits.
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+                raise VMError(
+                    "Lost the monitor of %s: %s" % (machine.name, error))
+        finally:
+            with self.lock:
+                self.clients.pop(machine.name, None)
+            client.close()
+        phases.append(round(time.time() - phase_start, 3))
+        return {'phases': phases, 'screendumps': len(screendumps)}
+
+    def screendump(  # pylint: disable=no-self-use
+            self, client, machine, elapsed):
+        """Saves the screen of machine into the directory of its monitor.
+
+        :return: The path of the screendump.
+        """
+        path = os.path.join(
+            machine.monitor.directory, 'screen-%06d.ppm' % elapsed)
+        client.screendump(path)
+        return path
+
+    def powerdown(self, machine, timeout=POWERDOWN_TIMEOUT):
+        """Asks the guest of machine to power off, as when its power
+        button is pressed, and kills it when it is still running after
+        timeout seconds.
+
+        :return: True when the guest powered off by itself.
+        """
+        with self.lock:
+            process = self.processes.get(machine.name)
+            client = self.clients.get(machine.name)
+        if process is None:
+            return False
+        if client is not None:
+            try:
+                client.system_powerdown()
+                process.wait(timeout)
+                return True
+            except (qmp.QMPError, subprocess.TimeoutExpired):
+                pass
+        process.kill()
+        process.wait()
+        return False
+
+    def destroy(self, machine):
+        with self.lock:
+            process = self.processes.get(machine.name)
+        if process is not None:
+            process.kill()
+
+
+def timeout_error(machine):
+    """Returns the error raised when machine timed out."""
+    return VMError(
+        "%s did not finish within %d seconds." % (
+            machine.name, machine.timeout))
+
+
+def qemu_nic_model(model):
+    """Returns the qemu device of the libvirt NIC model."""
+    if model == 'virtio':
+        return 'virtio-net-pci'
+    return model
+
+
+class LibvirtBackend(Backend):
+    """Runs the machines as transient libvirt domains.
+
+    The end of the installation is noticed through the lifecycle events
+    of the domain, while the CPU and disk statistics of the domain are
+    sampled. Transient domains are removed by libvirt once they stop, so
+    there is nothing to clean up."""
+
+    name = 'libvirt'
+
+    # Seconds between samples of the domain statistics.
+    stats_interval = 2
+
+    # Runs the libvirt event loop, shared by all the connections.
+    event_thread = None
+    event_lock = threading.Lock()
+
+    def __init__(self, uri='qemu:///system'):
+        self.uri = uri
+        self.connection = None
+        self.domains = {}
+        self.destroyed = set()
+
+    @staticmethod
+    def get_module():
+        """Returns the libvirt module."""
+        try:
+            import libvirt  # pylint: disable=import-error
+        except ImportError:
+            raise VMError(
+                "The libvirt backend needs the libvirt Python module.")
+        return libvirt
+
+    @classmethod
+    def start_events(cls, libvirt):
+        """Starts the libvirt event loop, which must run before the first
+        connection is opened to receive events."""
+        with cls.event_lock:
+            if cls.event_thread is not None:
+                return
+            libvirt.virEventRegisterDefaultImpl()
+
+            def run_events():
+                while True:
+                    libvirt.virEventRunDefaultImpl()
+
+            cls.event_thread = threading.Thread(
+                target=run_events, name='libvirt-events', daemon=True)
+            cls.event_thread.start()
+
+    def connect(self):
+        """Returns the connection to libvirt."""
+        if self.connection is None:
+            libvirt = self.get_module()
+            self.start_events(libvirt)
+            self.connection = libvirt.open(self.uri)
+        return self.connection
+
+    def get_target(self, machine, disk, counts):  # pylint: disable=no-self-use
+        """Returns the target device name of disk."""
+        bus = machine.get_bus(disk)
+        prefix = {'virtio': 'vd', 'fdc': 'fd', 'sata': 'sd'}.get(bus, 'hd')
+        index = disk.index
+        if index is None:
+            index = counts.get(prefix, 0)
+        counts[prefix] = max(counts.get(prefix, 0), index + 1)
+        return '%s%s' % (prefix, chr(ord('a') + index))
+
+    def get_xml(
+            self, machine, disks, kernel=None, initrd=None, cmdline=None):
+        """Returns the domain XML of machine, with disks attached."""
+        # pylint: disable=too-many-locals
+        domain = ElementTree.Element(
+            'domain',
+            type='kvm' if os.access('/dev/kvm', os.R_OK) else 'qemu')
+        ElementTree.SubElement(domain, 'name').text = machine.name
+        ElementTree.SubElement(
+            domain, 'memory', unit='MiB').text = '%s' % machine.ram
+        ElementTree.SubElement(domain, 'vcpu').text = '%s' % machine.vcpus
+        os_element = ElementTree.SubElement(domain, 'os')
+        ElementTree.SubElement(
+            os_element, 'type', arch=machine.arch, machine='pc').text = 'hvm'
+        if kernel is not None:
+            ElementTree.SubElement(os_element, 'kernel').text = kernel
+            ElementTree.SubElement(os_element, 'initrd').text = initrd
+            ElementTree.SubElement(os_element, 'cmdline').text = cmdline
+        features = ElementTree.SubElement(domain, 'features')
+        ElementTree.SubElement(features, 'acpi')
+        ElementTree.SubElement(features, 'apic')
+        if machine.limits.cpu_quota is not None:
+            cputune = ElementTree.SubElement(domain, 'cputune')
+            ElementTree.SubElement(cputune, 'period').text = '100000'
+            ElementTree.SubElement(cputune, 'quota').text = '%d' % (
+                machine.limits.cpu_quota * 1000)
+        ElementTree.SubElement(domain, 'on_poweroff').text = 'destroy'
+        ElementTree.SubElement(domain, 'on_reboot').text = (
+            'restart' if machine.reboot else 'destroy')
+        ElementTree.SubElement(domain, 'on_crash').text = 'destroy'
+        devices = ElementTree.SubElement(domain, 'devices')
+        counts = {}
+        for disk in disks:
+            element = ElementTree.SubElement(
+                devices, 'disk', type='file', device=disk.device)
+            driver = ElementTree.SubElement(
+                element, 'driver', name='qemu', type='raw')
+            if machine.cache is not None and disk.device == 'disk':
+                driver.set('cache', machine.cache)
+            ElementTree.SubElement(element, 'source', file=disk.path)
+            boot_order = machine.get_boot_order(disk)
+            if boot_order is not None:
+                ElementTree.SubElement(
+                    element, 'boot', order='%d' % boot_order)
+            ElementTree.SubElement(
+                element, 'target', dev=self.get_target(machine, disk, counts),
+                bus=machine.get_bus(disk))
+            if disk.device == 'cdrom':
+                ElementTree.SubElement(element, 'readonly')
+            elif disk.device == 'disk' and machine.limits.iops is not None:
+                iotune = ElementTree.SubElement(element, 'iotune')
+                ElementTree.SubElement(iotune, 'total_iops_sec').text = (
+                    '%d' % machine.limits.iops)
+        if machine.network is not None:
+            element = ElementTree.SubElement(
+                devices, 'interface', type=machine.network.type)
+            if machine.network.type == 'bridge':
+                ElementTree.SubElement(
+                    element, 'source', bridge=machine.network.source)
+            if machine.network.mac is not None:
+                ElementTree.SubElement(
+                    element, 'mac', address=machine.network.mac)
+            ElementTree.SubElement(
+                element, 'model', type=machine.profile.nic_model)
+        serials = [machine.console_log]
+        if machine.status_log is not None:
+            serials.append(machine.status_log)
+        elif machine.console_log is None:
+            serials = []
+        for port, path in enumerate(serials):
+            if path is None:
+                # Keep the status on the second serial port.
+                serial = ElementTree.SubElement(devices, 'serial', type='pty')
+            else:
+                serial = ElementTree.SubElement(
+                    devices, 'serial', type='file')
+                ElementTree.SubElement(serial, 'source', path=path)
+            ElementTree.SubElement(serial, 'target', port='%d' % port)
+        if machine.graphics:
+            ElementTree.SubElement(
+                devices, 'graphics', type='vnc', autoport='yes',
+                listen='127.0.0.1')
+        video = ElementTree.SubElement(devices, 'video')
+        ElementTree.SubElement(
+            video, 'model',
+            type='vga' if machine.profile.video == 'std' else (
+                machine.profile.video))
+        return ElementTree.tostring(domain, encoding='unicode')
+
+    def run(self, machine):
+        libvirt = self.get_module()
+        connection = self.connect()
+        with utils.tempdir() as workdir:
+            utils.subp(['chmod', '755', workdir])
+            disks = list(machine.disks)
+            boot = {}
+            if machine.boot == 'location':
+                kernel, initrd, cmdline, iso = prepare_location(
+                    machine, workdir)
+                boot = {'kernel': kernel, 'initrd': initrd, 'cmdline': cmdline}
+                if iso is not None:
+                    disks.append(Disk(iso, 'cdrom', None))
+            stopped = threading.Event()
+            events = []
+
+            def lifecycle(_connection, _domain, event, detail, _opaque):
+                if event in (
+                        libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                        libvirt.VIR_DOMAIN_EVENT_CRASHED):
+                    events.append((event, detail))
+                    stopped.set()
+
+            start = time.time()
+            domain = connection.createXML(
+                self.get_xml(machine, disks, **boot), 0)
+            self.domains[machine.name] = domain
+            callback = connection.domainEventRegisterAny(
+                domain, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, lifecycle,
+                None)
+            try:
+                stats = self.wait(machine, domain, disks, stopped, start)
+            finally:
+                connection.domainEventDeregisterAny(callback)
+                self.domains.pop(machine.name, None)
+        failed = any(
+            event == libvirt.VIR_DOMAIN_EVENT_CRASHED or
+            detail in (
+                libvirt.VIR_DOMAIN_EVENT_STOPPED_CRASHED,
+                libvirt.VIR_DOMAIN_EVENT_STOPPED_FAILED)
+            for event, detail in events)
+        if machine.name in self.destroyed or failed:
+            self.destroyed.discard(machine.name)
+            raise subprocess.CalledProcessError(1, ['virDomainCreateXML'])
+        return stats
+
+    def wait(self, machine, domain, disks, stopped, start):
+        """Waits for the domain to stop, sampling its statistics.
+
+        :return: The statistics of the domain.
+        """
+        libvirt = self.get_module()
+        targets = [
+            element.get('dev')
+            for element in ElementTree.fromstring(
+                domain.XMLDesc(0)).findall('./devices/disk/target')
+            ]
+        disk_targets = [
+            target for target, disk in zip(targets, disks)
+            if disk.device == 'disk'
+            ]
+        stats = {}
+        while not stopped.is_set():
+            try:
+                stats.update(self.sample(domain, disk_targets))
+                if not domain.isActive():
+                    break
+            except libvirt.libvirtError:
+                # A transient domain is gone as soon as it stops.
+                break
+            elapsed = time.time() - start
+            if machine.timeout is not None and elapsed > machine.timeout:
+                self.destroy(machine)
+                self.destroyed.discard(machine.name)
+                raise timeout_error(machine)
+            stopped.wait(self.stats_interval)
+        stats['seconds'] = round(time.time() - start, 3)
+        return stats
+
+    def sample(self, domain, targets):  # pylint: disable=no-self-use
+        """Returns the current statistics of domain."""
+        _, max_memory, memory, vcpus, cpu_time = domain.info()
+        stats = {
+            'cpu_seconds': round(cpu_time / 1e9, 3),
+            'memory_kib': memory,
+            'max_memory_kib': max_memory,
+            'vcpus': vcpus,
+            'disks': {},
+            }
+        for target in targets:
+            rd_req, rd_bytes, wr_req, wr_bytes, errors = domain.blockStats(
+                target)
+            stats['disks'][target] = {
+                'read_requests': rd_req,
+                'read_bytes': rd_bytes,
+                'write_requests': wr_req,
+                'write_bytes': wr_bytes,
+                'errors': errors,
+                }
+        return stats
+
+    def destroy(self, machine):
+        domain = self.domains.get(machine.name)
+        if domain is not None:
+            self.destroyed.add(machine.name)
+            try:
+                domain.destroy()
+            except self.get_module().libvirtError:
+                # Already stopped.
+                pass
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in [VirtInstallBackend, QemuBackend, LibvirtBackend]
+    }
+
+
+def get_backend(name):
+    """Returns a new backend called name. 'auto' is the libvirt backend
+    when the libvirt Python module is installed, otherwise virt-install."""
+    if name == 'auto':
+        try:
+            LibvirtBackend.get_module()
+        except VMError:
+            name = 'virt-install'
+        else:
+            name = 'libvirt'
+    return BACKENDS[name]()
+
+
+def populate_parser(parser):
+    """Add the options choosing how the virtual machines are run."""
+    parser.add_argument(
+        '--vm-backend', choices=['auto'] + sorted(BACKENDS),
+        help="How the installation virtual machine is run. "
+             "Default: depends on the builder")
+    parser.add_argument(
+        '--device-profile', choices=sorted(PROFILES),
+        help="Devices of the installation virtual machine. "
+             "Default: depends on the builder")
+    parser.add_argument(
+        '--disk-cache', choices=CACHE_MODES,
+        help="Cache mode of the installation disk. "
+             "Default: the hypervisor default")
+    parser.add_argument(
+        '--cpu-quota', type=int,
+        help="Limit the installation to this percentage of one CPU.")
+    parser.add_argument(
+        '--disk-iops', type=int,
+        help="Limit the I/O operations per second of the installation disk.")
+    parser.add_argument(
+        '--install-timeout', default=0, type=int,
+        help=(
+            "Minutes after which the installation is aborted, 0 to wait "
+            "forever. Default: 0"))
+
+
+def get_network(params, mac=None):
+    """Returns the `Network` given on the command line."""
+    if params.network_mode == 'bridge':
+        return Network('bridge', params.interface, mac)
+    return Network(params.network_mode, None, mac)
+
+
+def get_limits(params):
+    """Returns the `Limits` given on the command line."""
+    return Limits(params.cpu_quota, params.disk_iops)
+
+
+def get_timeout(params):
+    """Returns the installation timeout given on the command line, in
+    seconds, or None."""
+    if not params.install_timeout:
+        return None
+    return params.install_timeout * 60
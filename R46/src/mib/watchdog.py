@@ -0,0 +1,141 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Watchdog aborting installations that failed or stopped progressing."""
+
+import logging
+import re
+import threading
+import time
+from collections import deque
+
+LOG = logging.getLogger(__name__)
+
+# Console messages after which anaconda will not finish on its own.
+FATAL_PATTERNS = [
+    re.compile(pattern) for pattern in [
+        r'There was an error running the kickstart script',
+        r'Error populating transaction',
+        r'Error checking software selection',
+        r'Error setting up (base )?(software|repositories|payload)',
+        r'Payload setup error',
+        r'The following software marked for installation has errors',
+        r'This package does not exist',
+        r'Unable to read package metadata',
+        r'Error downloading packages',
+        r'Kickstart insufficient',
+        r'An unknown error has occurred',
+        r'Pane is dead',
+        r'Please respond .yes. or .no.',
+        r'Press ENTER to exit',
+        ]
+    ]
+
+
+class InstallWatchdog:
+    """Watches the console of an installation for fatal errors and stalls.
+
+    Use as a console line listener inside a context. When a fatal message
+    is seen, or no console output arrived for stall_timeout seconds,
+    on_abort is called once and `failure` describes why.
+
+    :param on_abort: callable that stops the installation.
+    :param stall_timeout: seconds without console output before the
+        installation is aborted, 0 to disable.
+    """
+
+    interval = 10
+    excerpt_lines = 30
+
+    def __init__(self, on_abort, stall_timeout=0):
+        self.on_abort = on_abort
+        self.stall_timeout = stall_timeout
+        self.failure = None
+        self.lines = deque(maxlen=self.excerpt_lines)
+        self.last_activity = time.time()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def __call__(self, line):
+        """Checks one line of console output."""
+        self.last_activity = time.time()
+        self.lines.append(line.rstrip())
+        for pattern in FATAL_PATTERNS:
+            if pattern.search(line) is not None:
+                self.abort('Installer reported a fatal error')
+                return
+
+    def abort(self, reason):
+        """Stops the installation, only the first reason is kept."""
+        with self.lock:
+            if self.failure is not None:
+                return
+            self.failure = '%s:\n%s' % (reason, '\n'.join(self.lines))
+        LOG.error('%s, aborting installation.', reason)
+        try:
+            self.on_abort()
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception('Failed to abort installation.')
+
+    def watch_stall(self):
+        """Aborts the installation once the console stays silent for
+        longer than stall_timeout."""
+        while not self.stopping.wait(self.interval):
+            silent = time.time() - self.last_activity
+            if silent > self.stall_timeout:
+                self.abort(
+                    'No installer progress for %d minutes' % (silent // 60))
+                return
+
+    def __enter__(self):
+        self.last_activity = time.time()
+        if self.stall_timeout:
+            self.thread = threading.Thread(
+                target=self.watch_stall, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()